@@ -1,22 +1,47 @@
+import asyncio
 import base64
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
+import tempfile
 import time
-from io import BytesIO
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+from urllib.parse import quote
 
-from datasets import load_from_disk
-from fastapi import BackgroundTasks, FastAPI, File, Form, HTTPException, UploadFile
+import httpx
+from datasets import Image, load_from_disk
+from fastapi import BackgroundTasks, FastAPI, File, Form, HTTPException, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from openai import AsyncOpenAI
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
-from np_ocr.data import pdfs_to_hf_dataset
-from np_ocr.search import SearchClient, call_vllm
+from np_ocr.backends import VECTOR_BACKENDS, LanceBackend, QdrantBackend
+from np_ocr.cache import AnswerCache, LRUCache, QueryEmbeddingCache
+from np_ocr.data import (
+    build_page_index,
+    get_page_jpeg,
+    get_page_thumbnail_jpeg,
+    load_page_index,
+    lookup_page,
+    save_page_index,
+)
+from np_ocr.pipeline import ingest_pdfs
+from np_ocr.search import (
+    PROMPT_VERSION,
+    SearchClient,
+    aanswer_pages,
+    acall_vllm,
+    astream_vllm,
+    is_confident_answer,
+)
 
 
 class CustomRailwayLogFormatter(logging.Formatter):
@@ -41,7 +66,26 @@ def get_logger():
 
 logger = get_logger()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled client per upstream service for the lifetime of the process
+    colpali_client = search_client.colpali_client
+    colpali_client.open_async_client()
+    app.state.vllm_client = AsyncOpenAI(
+        base_url=settings.VLLM_URL,
+        api_key=settings.VLLM_API_KEY,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_POOL_SIZE, max_keepalive_connections=settings.HTTP_POOL_SIZE
+            ),
+        ),
+    )
+    yield
+    await colpali_client.aclose()
+    await app.state.vllm_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -56,13 +100,65 @@ class Settings(BaseSettings):
     STORAGE_DIR: str = "storage"
     CASE_INFO_FILENAME: str = "case_info.json"
     HF_DATASET_DIRNAME: str = "hf_dataset"
+    PAGE_INDEX_FILENAME: str = "page_index.json"
+    PDF_PAGE_BATCH_SIZE: int = 8
+    PIPELINE_QUEUE_SIZE: int = 32
+    RENDER_WORKERS: int = 1
+    RENDER_THREAD_COUNT: int = 1
+    EXTRACT_PAGE_TEXT: bool = False
     SEARCH_TOP_K: int = 3
+    SEARCH_BATCH_MAX_QUERIES: int = 64
+    SEARCH_FANOUT_WORKERS: int = 8
+    SEARCH_FANOUT_TIMEOUT: float = 10.0
+    ANSWER_MAX_PAGES: int = 20
+    ANSWER_MIN_CONFIDENCE: float = 0.8
+    ANSWER_CACHE: bool = True
+    ANSWER_CACHE_DIRNAME: str = ".answer_cache"
+    ANSWER_CACHE_TTL: Optional[float] = 7 * 24 * 3600
+    ANSWER_CACHE_SIZE_LIMIT: int = 2**30
     COLPALI_TOKEN: str
     VLLM_URL: str
     COLPALI_BASE_URL: str
     VECTOR_SIZE: int = 128
+    VECTOR_DTYPE: str = "float32"
+    SEARCH_RESCORE_FACTOR: int = 4
+    PAGE_POOLING: Optional[str] = None
+    POOLED_CLUSTERS: int = 8
+    PREFILTER_CANDIDATES: int = 64
+    TOKEN_BUDGET: int = 0
+    TOKEN_COMPRESSION: str = "cluster"
+    SEARCH_BACKEND: str = "auto"
+    NUMPY_SEARCH_MAX_PAGES: int = 1000
+    CASE_VECTORS_CACHE_SIZE: int = 4
+    EMBEDDING_STORE_DIRNAME: str = "embeddings"
+    WRITE_EMBEDDING_STORE: bool = True
+    COLPALI_BATCH_SIZE: int = 8
+    COLPALI_MAX_IN_FLIGHT: int = 4
+    COLPALI_MAX_RETRIES: int = 3
+    HTTP_POOL_SIZE: int = 32
+    COLPALI_TRANSPORT: str = "npy"
+    COLPALI_MODEL: str = "vidore/colqwen2-v1.0-merged"
+    QUERY_CACHE_SIZE: int = 1024
+    QUERY_CACHE_TTL: float = 3600
+    QUERY_CACHE_DIR: Optional[str] = None
     VLLM_API_KEY: str
     VLLM_MODEL: str = "Qwen2-VL-7B-Instruct"
+    DATASET_CACHE_SIZE: int = 16
+    PAGE_IMAGE_CACHE_CONTROL: str = "public, max-age=3600"
+    TABLE_CACHE_SIZE: int = 16
+    VECTOR_BACKEND: str = "lance"
+    LANCE_INDEX_TYPE: str = "IVF_PQ"
+    LANCE_INDEX_MIN_ROWS: int = 256
+    LANCE_FLAT_INDEX_MAX_ROWS: int = 4096
+    LANCE_NPROBES_FRACTION: float = 0.1
+    LANCE_REFINE_FACTOR: int = 5
+    QDRANT_HOST: str = "localhost"
+    QDRANT_PORT: int = 6333
+    QDRANT_HTTPS: bool = False
+    QDRANT_API_KEY: Optional[str] = None
+    QDRANT_PREFER_GRPC: bool = False
+    QDRANT_UPSERT_BATCH_SIZE: int = 16
+    QDRANT_INDEXING_THRESHOLD: int = 20000
 
     class Config:
         env_file = ".env"
@@ -75,14 +171,39 @@ class SearchResult(BaseModel):
     score: float
     pdf_name: str
     pdf_page: int
-    image_base64: str
+    image_base64: Optional[str] = None
+    image_url: Optional[str] = None
+    # set by multi-case search, where hits come from several cases
+    user_id: Optional[str] = None
+    case_name: Optional[str] = None
 
 class SearchResponse(BaseModel):
     search_results: List[SearchResult]
 
+class QuerySearchResults(BaseModel):
+    user_query: str
+    search_results: List[SearchResult]
+
+class BatchSearchResponse(BaseModel):
+    results: List[QuerySearchResults]
+
+class MultiCaseSearchResponse(BaseModel):
+    search_results: List[SearchResult]
+    # "user_id/case_name" of cases that failed or missed the deadline and are not in the results
+    incomplete_cases: List[str]
+
 class ImageAnswer(BaseModel):
     answer: str
 
+class PageAnswer(BaseModel):
+    pdf_name: str
+    pdf_page: int
+    # "answered", "error", or "cancelled" once a confident answer made the call unnecessary
+    status: str
+    answer: Optional[str] = None
+    confidence: Optional[float] = None
+    cached: Optional[bool] = None
+
 class CaseInfo(BaseModel):
     name: str
     status: str
@@ -99,7 +220,10 @@ class CaseInfo(BaseModel):
         self.save()
 
 
+COMMON_CASES_USER_ID = "common_cases"
+
 _SAFE_NAME_RE = re.compile(r"^[\w\-]+$")
+_MAX_FILENAME_LENGTH = 255
 
 
 def validate_identifier(value: str, field_name: str) -> None:
@@ -108,57 +232,204 @@ def validate_identifier(value: str, field_name: str) -> None:
         raise HTTPException(status_code=400, detail=f"Invalid {field_name} provided.")
 
 
+def validate_filename(value: str, field_name: str) -> None:
+    """
+    Ensure a single, non-hidden path component. Upload and serving share this rule, so any name
+    accepted by /create_case (e.g. 'Report (1).pdf') can be requested back from /page_image.
+    """
+    if (
+        not value
+        or len(value) > _MAX_FILENAME_LENGTH
+        or value.startswith(".")
+        or "/" in value
+        or "\\" in value
+        or any(ord(char) < 32 for char in value)
+    ):
+        raise HTTPException(status_code=400, detail=f"Invalid {field_name} provided.")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Evaluate an If-None-Match header (a list of strong or weak ETags, or '*') against ``etag``."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any(candidate == "*" or candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+def create_vector_backend():
+    """The vector store selected by VECTOR_BACKEND."""
+    if settings.VECTOR_BACKEND not in VECTOR_BACKENDS:
+        raise ValueError(f"VECTOR_BACKEND must be one of {VECTOR_BACKENDS}, got {settings.VECTOR_BACKEND}")
+    if settings.VECTOR_BACKEND == "qdrant":
+        return QdrantBackend(
+            host=settings.QDRANT_HOST,
+            port=settings.QDRANT_PORT,
+            https=settings.QDRANT_HTTPS,
+            api_key=settings.QDRANT_API_KEY,
+            prefer_grpc=settings.QDRANT_PREFER_GRPC,
+            vector_dtype=settings.VECTOR_DTYPE,
+            upsert_batch_size=settings.QDRANT_UPSERT_BATCH_SIZE,
+            indexing_threshold=settings.QDRANT_INDEXING_THRESHOLD,
+            rescore_factor=settings.SEARCH_RESCORE_FACTOR,
+            prefilter_candidates=settings.PREFILTER_CANDIDATES,
+        )
+    return LanceBackend(
+        settings.STORAGE_DIR,
+        table_cache_size=settings.TABLE_CACHE_SIZE,
+        rescore_factor=settings.SEARCH_RESCORE_FACTOR,
+        prefilter_candidates=settings.PREFILTER_CANDIDATES,
+        index_type=settings.LANCE_INDEX_TYPE,
+        min_index_rows=settings.LANCE_INDEX_MIN_ROWS,
+        flat_index_max_rows=settings.LANCE_FLAT_INDEX_MAX_ROWS,
+        nprobes_fraction=settings.LANCE_NPROBES_FRACTION,
+        refine_factor=settings.LANCE_REFINE_FACTOR,
+    )
+
+
 search_client = SearchClient(
     storage_dir=settings.STORAGE_DIR,
     vector_size=settings.VECTOR_SIZE,
     base_url=settings.COLPALI_BASE_URL,
     token=settings.COLPALI_TOKEN,
+    table_cache_size=settings.TABLE_CACHE_SIZE,
+    max_in_flight=settings.COLPALI_MAX_IN_FLIGHT,
+    max_retries=settings.COLPALI_MAX_RETRIES,
+    http_pool_size=settings.HTTP_POOL_SIZE,
+    transport=settings.COLPALI_TRANSPORT,
+    vector_dtype=settings.VECTOR_DTYPE,
+    rescore_factor=settings.SEARCH_RESCORE_FACTOR,
+    pooling=settings.PAGE_POOLING,
+    pooled_clusters=settings.POOLED_CLUSTERS,
+    prefilter_candidates=settings.PREFILTER_CANDIDATES,
+    token_budget=settings.TOKEN_BUDGET,
+    token_compression=settings.TOKEN_COMPRESSION,
+    search_backend=settings.SEARCH_BACKEND,
+    numpy_max_pages=settings.NUMPY_SEARCH_MAX_PAGES,
+    case_vectors_cache_size=settings.CASE_VECTORS_CACHE_SIZE,
+    embedding_store_dirname=settings.EMBEDDING_STORE_DIRNAME,
+    query_cache=QueryEmbeddingCache(
+        model_id=settings.COLPALI_MODEL,
+        max_size=settings.QUERY_CACHE_SIZE,
+        ttl=settings.QUERY_CACHE_TTL,
+        disk_dir=settings.QUERY_CACHE_DIR,
+    ),
+    backend=create_vector_backend(),
 )
 
+# the directory name starts with a dot, so it can never collide with a user_id under STORAGE_DIR
+answer_cache = (
+    AnswerCache(
+        os.path.join(settings.STORAGE_DIR, settings.ANSWER_CACHE_DIRNAME),
+        model_id=settings.VLLM_MODEL,
+        prompt_version=PROMPT_VERSION,
+        ttl=settings.ANSWER_CACHE_TTL,
+        size_limit=settings.ANSWER_CACHE_SIZE_LIMIT,
+    )
+    if settings.ANSWER_CACHE
+    else None
+)
+dataset_cache = LRUCache(settings.DATASET_CACHE_SIZE)
+page_index_cache = LRUCache(settings.DATASET_CACHE_SIZE)
 
-@app.post("/vllm_call")
-def vllm_call(
-    user_query: str = Form(...),
-    user_id: str = Form(...),
-    case_name: str = Form(...),
-    pdf_name: str = Form(...),
-    pdf_page: int = Form(...),
-) -> ImageAnswer:
-    logger.info("start vllm_call")
-    start_time = time.time()
 
-    """
-    Given a user ID, collection name, PDF name, and PDF page number, retrieve the corresponding image
-    from the HF dataset and call the VLLM function with this image.
-    """
-    validate_identifier(user_id, "user_id")
-    validate_identifier(case_name, "case_name")
-    validate_identifier(pdf_name, "pdf_name")
-    if pdf_page <= 0:
-        raise HTTPException(status_code=400, detail="pdf_page must be positive.")
+def open_page_dataset(dataset_path):
+    # Keep images as stored bytes: the serving path only needs the JPEG, never the decoded page.
+    return load_from_disk(dataset_path).cast_column("image", Image(decode=False))
+
 
+def load_case_dataset(user_id: str, case_name: str):
+    """Return the case's HF dataset, reusing an already opened handle when possible.
+
+    The ``image`` column is not decoded; use ``get_page_jpeg`` / ``get_page_thumbnail_jpeg`` on rows.
+    """
     dataset_path = os.path.join(settings.STORAGE_DIR, user_id, case_name, settings.HF_DATASET_DIRNAME)
     if not os.path.exists(dataset_path):
         raise HTTPException(status_code=404, detail="Dataset for this case not found.")
 
     try:
-        dataset = load_from_disk(dataset_path)
+        return dataset_cache.get_or_load((user_id, case_name), lambda: open_page_dataset(dataset_path))
     except Exception as exc:
         logger.error("Failed loading dataset: %s", exc)
         raise HTTPException(status_code=500, detail="Failed to load case dataset.") from exc
-    image_data = None
 
-    for data in dataset:
-        if data["pdf_name"] == pdf_name and data["pdf_page"] == pdf_page:
-            image_data = data["image"]
-            break
 
-    if image_data is None:
+def load_case_page_index(user_id: str, case_name: str, dataset):
+    def load():
+        page_index_path = os.path.join(settings.STORAGE_DIR, user_id, case_name, settings.PAGE_INDEX_FILENAME)
+        page_index = load_page_index(page_index_path)
+        if page_index is None:
+            # Cases ingested before the page index existed: build it from the metadata columns only.
+            page_index = build_page_index(dataset)
+        return page_index
+
+    return page_index_cache.get_or_load((user_id, case_name), load)
+
+
+def load_page_row(user_id: str, case_name: str, pdf_name: str, pdf_page: int):
+    """Return the dataset row of one page through the cached page index."""
+    dataset = load_case_dataset(user_id, case_name)
+    page_index = load_case_page_index(user_id, case_name, dataset)
+    row_idx = lookup_page(page_index, pdf_name, pdf_page)
+    if row_idx is None:
         raise HTTPException(
             status_code=404, detail="Image not found in the dataset for the given PDF name and page number."
         )
+    return dataset[row_idx]
+
+
+def invalidate_case_caches(user_id: str, case_name: str):
+    dataset_cache.invalidate((user_id, case_name))
+    page_index_cache.invalidate((user_id, case_name))
+    search_client.invalidate(user_id, case_name)
+    if answer_cache is not None:
+        answer_cache.invalidate_case(user_id, case_name)
+
+
+def load_vllm_page(user_id: str, case_name: str, pdf_name: str, pdf_page: int) -> bytes:
+    """Validate a /vllm_call page reference and return the JPEG thumbnail that is sent to vLLM."""
+    validate_identifier(user_id, "user_id")
+    validate_identifier(case_name, "case_name")
+    validate_filename(pdf_name, "pdf_name")
+    if pdf_page <= 0:
+        raise HTTPException(status_code=400, detail="pdf_page must be positive.")
+    return get_page_thumbnail_jpeg(load_page_row(user_id, case_name, pdf_name, pdf_page))
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/vllm_call")
+async def vllm_call(
+    request: Request,
+    user_query: str = Form(...),
+    user_id: str = Form(...),
+    case_name: str = Form(...),
+    pdf_name: str = Form(...),
+    pdf_page: int = Form(...),
+) -> ImageAnswer:
+    logger.info("start vllm_call")
+    start_time = time.time()
 
-    image_answer = call_vllm(image_data, user_query, settings.VLLM_URL, settings.VLLM_API_KEY, settings.VLLM_MODEL)
+    """
+    Given a user ID, collection name, PDF name, and PDF page number, retrieve the corresponding image
+    from the HF dataset and call the VLLM function with this image.
+    """
+    thumbnail_jpeg = await run_in_threadpool(load_vllm_page, user_id, case_name, pdf_name, pdf_page)
+
+    cached = None
+    if answer_cache is not None:
+        cached = await run_in_threadpool(answer_cache.get, user_id, case_name, thumbnail_jpeg, user_query)
+    if cached is not None:
+        image_answer = ImageAnswer(answer=cached["answer"])
+    else:
+        image_answer = await acall_vllm(
+            request.app.state.vllm_client, thumbnail_jpeg, user_query, settings.VLLM_MODEL
+        )
+        if answer_cache is not None:
+            await run_in_threadpool(
+                answer_cache.put, user_id, case_name, thumbnail_jpeg, user_query, image_answer.answer
+            )
 
     end_time = time.time()
     logger.info(f"done vllm_call, total time {end_time - start_time}")
@@ -166,14 +437,214 @@ def vllm_call(
     return image_answer
 
 
-@app.post("/search", response_model=SearchResponse)
-def ai_search(user_query: str = Form(...), user_id: str = Form(...), case_name: str = Form(...)):
+@app.post("/vllm_call_stream")
+async def vllm_call_stream(
+    request: Request,
+    user_query: str = Form(...),
+    user_id: str = Form(...),
+    case_name: str = Form(...),
+    pdf_name: str = Form(...),
+    pdf_page: int = Form(...),
+):
+    """
+    /vllm_call as server-sent events: "token" events carry the answer JSON as vLLM generates it, then a
+    single "answer" event carries the validated ImageAnswer, or an "error" event if generation failed or
+    the output did not validate. A cached answer is sent as the "answer" event right away.
+    """
+    logger.info("start vllm_call_stream")
+    start_time = time.time()
+
+    thumbnail_jpeg = await run_in_threadpool(load_vllm_page, user_id, case_name, pdf_name, pdf_page)
+    cached = None
+    if answer_cache is not None:
+        cached = await run_in_threadpool(answer_cache.get, user_id, case_name, thumbnail_jpeg, user_query)
+
+    async def stream_events():
+        if cached is not None:
+            yield sse_event("answer", ImageAnswer(answer=cached["answer"]).model_dump())
+            return
+        try:
+            async for item in astream_vllm(
+                request.app.state.vllm_client, thumbnail_jpeg, user_query, settings.VLLM_MODEL
+            ):
+                if isinstance(item, str):
+                    yield sse_event("token", {"delta": item})
+                    continue
+                if answer_cache is not None:
+                    await run_in_threadpool(
+                        answer_cache.put, user_id, case_name, thumbnail_jpeg, user_query, item.answer
+                    )
+                yield sse_event("answer", ImageAnswer(answer=item.answer).model_dump())
+        except Exception as exc:
+            # the 200 and the first tokens are already sent, so failures are reported in the stream
+            logger.error("Failed streaming vLLM answer: %s", exc)
+            yield sse_event("error", {"detail": "Failed to generate a valid answer."})
+
+        end_time = time.time()
+        logger.info(f"done vllm_call_stream, total time {end_time - start_time}")
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/answer")
+async def answer(
+    request: Request,
+    user_query: str = Form(...),
+    user_id: str = Form(...),
+    case_name: str = Form(...),
+    pdf_names: List[str] = Form(...),
+    pdf_pages: List[int] = Form(...),
+    stop_early: bool = Form(True),
+    min_confidence: Optional[float] = Form(None),
+):
+    """
+    Ask vLLM about all candidate pages (pdf_names[i], pdf_pages[i]), e.g. the hits of /search, concurrently.
+    Answers are streamed back as newline-delimited PageAnswer JSON in the order they arrive. With stop_early,
+    the first non-NA answer whose confidence reaches min_confidence (default ANSWER_MIN_CONFIDENCE) cancels
+    the calls still running, and those pages are streamed with status "cancelled".
+    """
+    logger.info("start answer")
+    start_time = time.time()
+
+    validate_identifier(user_id, "user_id")
+    validate_identifier(case_name, "case_name")
+    if len(pdf_names) != len(pdf_pages):
+        raise HTTPException(status_code=400, detail="pdf_names and pdf_pages must have the same length.")
+    pages = list(dict.fromkeys(zip(pdf_names, pdf_pages)))
+    if len(pages) > settings.ANSWER_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"At most {settings.ANSWER_MAX_PAGES} pages per request.")
+    for pdf_name, pdf_page in pages:
+        validate_filename(pdf_name, "pdf_name")
+        if pdf_page <= 0:
+            raise HTTPException(status_code=400, detail="pdf_page must be positive.")
+
+    def load_thumbnails():
+        return [
+            ((pdf_name, pdf_page), get_page_thumbnail_jpeg(load_page_row(user_id, case_name, pdf_name, pdf_page)))
+            for pdf_name, pdf_page in pages
+        ]
+
+    page_thumbnails = await run_in_threadpool(load_thumbnails)
+    threshold = None
+    if stop_early:
+        threshold = settings.ANSWER_MIN_CONFIDENCE if min_confidence is None else min_confidence
+
+    def lookup_cached():
+        if answer_cache is None:
+            return {}
+        cached = {
+            key: answer_cache.get(user_id, case_name, thumbnail, user_query) for key, thumbnail in page_thumbnails
+        }
+        return {key: answer for key, answer in cached.items() if answer is not None}
+
+    cached_answers = await run_in_threadpool(lookup_cached)
+    to_call = [(key, thumbnail) for key, thumbnail in page_thumbnails if key not in cached_answers]
+    thumbnails = dict(page_thumbnails)
+
+    async def stream_answers():
+        stop = False
+        for (pdf_name, pdf_page), cached in cached_answers.items():
+            page_answer = PageAnswer(pdf_name=pdf_name, pdf_page=pdf_page, status="answered", cached=True, **cached)
+            yield page_answer.model_dump_json(exclude_none=True) + "\n"
+            stop = stop or is_confident_answer(cached["answer"], cached["confidence"], threshold)
+        if stop:
+            # a cached answer is already good enough, no page needs a vLLM call
+            for (pdf_name, pdf_page), _ in to_call:
+                page_answer = PageAnswer(pdf_name=pdf_name, pdf_page=pdf_page, status="cancelled")
+                yield page_answer.model_dump_json(exclude_none=True) + "\n"
+            to_call.clear()
+
+        results = aanswer_pages(request.app.state.vllm_client, to_call, user_query, settings.VLLM_MODEL, threshold)
+        async for (pdf_name, pdf_page), result in results:
+            if isinstance(result, asyncio.CancelledError):
+                page_answer = PageAnswer(pdf_name=pdf_name, pdf_page=pdf_page, status="cancelled")
+            elif isinstance(result, BaseException):
+                page_answer = PageAnswer(pdf_name=pdf_name, pdf_page=pdf_page, status="error")
+            else:
+                image_answer, confidence = result
+                page_answer = PageAnswer(
+                    pdf_name=pdf_name,
+                    pdf_page=pdf_page,
+                    status="answered",
+                    answer=image_answer.answer,
+                    confidence=confidence,
+                )
+                if answer_cache is not None:
+                    await run_in_threadpool(
+                        answer_cache.put,
+                        user_id,
+                        case_name,
+                        thumbnails[(pdf_name, pdf_page)],
+                        user_query,
+                        image_answer.answer,
+                        confidence,
+                    )
+            yield page_answer.model_dump_json(exclude_none=True) + "\n"
+
+        end_time = time.time()
+        logger.info(f"done answer, total time {end_time - start_time}")
+
+    return StreamingResponse(stream_answers(), media_type="application/x-ndjson")
+
+
+def build_search_results(request: Request, search_results, user_id: str, case_name: str, return_urls: bool):
+    dataset = load_case_dataset(user_id, case_name)
+    search_results_data = []
+    for point in search_results:
+        logger.info(point)
+        score = point["_distance"]
+        row = dataset[point["index"]]
+        pdf_name = row["pdf_name"]
+        pdf_page = row["pdf_page"]
+
+        if return_urls:
+            # url_for inserts path params verbatim, so quote them to keep names like 'my report.pdf' valid.
+            image_url = request.url_for(
+                "page_image",
+                user_id=quote(user_id, safe=""),
+                case_name=quote(case_name, safe=""),
+                pdf_name=quote(pdf_name, safe=""),
+                pdf_page=pdf_page,
+            )
+            search_results_data.append(SearchResult(
+                score=score,
+                pdf_name=pdf_name,
+                pdf_page=pdf_page,
+                image_url=str(image_url),
+            ))
+            continue
+
+        # The JPEG is stored at ingest, so this is a copy rather than a decode and re-encode
+        img_b64_str = base64.b64encode(get_page_jpeg(row)).decode("utf-8")
+
+        search_results_data.append(SearchResult(
+            score=score,
+            pdf_name=pdf_name,
+            pdf_page=pdf_page,
+            image_base64=img_b64_str
+        ))
+    return search_results_data
+
+
+@app.post("/search", response_model=SearchResponse, response_model_exclude_none=True)
+async def ai_search(
+    request: Request,
+    user_query: str = Form(...),
+    user_id: str = Form(...),
+    case_name: str = Form(...),
+    return_urls: bool = Form(False),
+):
     logger.info("start ai_search")
     start_time = time.time()
 
     """
     Given a user query, user ID, and case name, search relevant images in the Qdrant index
     and return both the results and an LLM interpretation.
+    With return_urls the page images are returned as /page_image URLs instead of inline base64.
     """
     validate_identifier(user_id, "user_id")
     validate_identifier(case_name, "case_name")
@@ -192,7 +663,7 @@ def ai_search(user_query: str = Form(...), user_id: str = Form(...), case_name:
         logger.error("Failed to read case info: %s", exc)
         raise HTTPException(status_code=500, detail="Failed to read case info.") from exc
 
-    search_results = search_client.search_images_by_text(
+    search_results = await search_client.asearch_images_by_text(
         user_query,
         case_name=case_name,
         user_id=user_id,
@@ -201,36 +672,11 @@ def ai_search(user_query: str = Form(...), user_id: str = Form(...), case_name:
     if not search_results:
         return {"message": "No results found."}
 
-    dataset_path = os.path.join(settings.STORAGE_DIR, user_id, case_name, settings.HF_DATASET_DIRNAME)
-    if not os.path.exists(dataset_path):
-        raise HTTPException(status_code=404, detail="Dataset for this case not found.")
-
-    try:
-        dataset = load_from_disk(dataset_path)
-    except Exception as exc:
-        logger.error("Failed loading dataset: %s", exc)
-        raise HTTPException(status_code=500, detail="Failed to load case dataset.") from exc
-    search_results_data = []
     logger.info(search_results)
-    for point in search_results:
-        logger.info(point)
-        score = point["_distance"]
-        index = point["index"]
-        image_data = dataset[index]["image"]
-        pdf_name = dataset[index]["pdf_name"]
-        pdf_page = dataset[index]["pdf_page"]
-
-        # Convert image to base64 string
-        buffered = BytesIO()
-        image_data.save(buffered, format="JPEG")
-        img_b64_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-        search_results_data.append(SearchResult(
-            score=score,
-            pdf_name=pdf_name,
-            pdf_page=pdf_page,
-            image_base64=img_b64_str
-        ))
+    # dataset reads and base64 encoding are blocking, keep them off the event loop
+    search_results_data = await run_in_threadpool(
+        build_search_results, request, search_results, user_id, case_name, return_urls
+    )
 
     end_time = time.time()
     logger.info(f"done ai_search, total time {end_time - start_time}")
@@ -238,13 +684,205 @@ def ai_search(user_query: str = Form(...), user_id: str = Form(...), case_name:
     return SearchResponse(search_results=search_results_data)
 
 
+@app.post("/search_batch", response_model=BatchSearchResponse, response_model_exclude_none=True)
+async def ai_search_batch(
+    request: Request,
+    user_queries: List[str] = Form(...),
+    user_id: str = Form(...),
+    case_name: str = Form(...),
+    return_urls: bool = Form(False),
+):
+    """
+    Search one case with several queries at once: the queries are embedded in a single ColPali call and
+    scored together, and each query gets its own top SEARCH_TOP_K pages, in the order the queries were sent.
+    """
+    logger.info("start ai_search_batch")
+    start_time = time.time()
+
+    validate_identifier(user_id, "user_id")
+    validate_identifier(case_name, "case_name")
+    if len(user_queries) > settings.SEARCH_BATCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400, detail=f"At most {settings.SEARCH_BATCH_MAX_QUERIES} queries per batch."
+        )
+
+    case_info_path = os.path.join(settings.STORAGE_DIR, user_id, case_name, settings.CASE_INFO_FILENAME)
+    if not os.path.exists(case_info_path):
+        raise HTTPException(status_code=404, detail="Case info not found.")
+
+    search_results = await search_client.asearch_many(
+        user_queries, case_name=case_name, user_id=user_id, top_k=settings.SEARCH_TOP_K
+    )
+
+    def build_batch_results():
+        return [
+            QuerySearchResults(
+                user_query=user_query,
+                search_results=build_search_results(request, results, user_id, case_name, return_urls),
+            )
+            for user_query, results in zip(user_queries, search_results)
+        ]
+
+    # dataset reads and base64 encoding are blocking, keep them off the event loop
+    results = await run_in_threadpool(build_batch_results)
+
+    end_time = time.time()
+    logger.info(f"done ai_search_batch, total time {end_time - start_time}")
+
+    return BatchSearchResponse(results=results)
+
+
+def list_searchable_cases(user_id: str, include_common_cases: bool):
+    """(user_id, case_name) of the user's finished cases, and of the common cases when asked for."""
+    owners = [user_id, COMMON_CASES_USER_ID] if include_common_cases else [user_id]
+    cases = []
+    for owner in dict.fromkeys(owners):
+        owner_dir = os.path.join(settings.STORAGE_DIR, owner)
+        if not os.path.isdir(owner_dir):
+            continue
+        for case_name in sorted(os.listdir(owner_dir)):
+            case_info_path = os.path.join(owner_dir, case_name, settings.CASE_INFO_FILENAME)
+            try:
+                with open(case_info_path, "r") as json_file:
+                    status = json.load(json_file).get("status")
+            except (OSError, ValueError):
+                continue
+            if status == "done":
+                cases.append((owner, case_name))
+    return cases
+
+
+@app.post("/search_cases", response_model=MultiCaseSearchResponse, response_model_exclude_none=True)
+async def ai_search_cases(
+    request: Request,
+    user_query: str = Form(...),
+    user_id: str = Form(...),
+    case_names: Optional[List[str]] = Form(None),
+    include_common_cases: bool = Form(True),
+    return_urls: bool = Form(False),
+):
+    """
+    Search all of the user's finished cases, plus the common cases, and return the best SEARCH_TOP_K pages
+    overall. ``case_names`` narrows the search to those cases. Cases are searched concurrently on
+    SEARCH_FANOUT_WORKERS threads; cases that fail or take longer than SEARCH_FANOUT_TIMEOUT seconds are
+    skipped and listed in ``incomplete_cases``.
+    """
+    logger.info("start ai_search_cases")
+    start_time = time.time()
+
+    validate_identifier(user_id, "user_id")
+    for case_name in case_names or []:
+        validate_identifier(case_name, "case_name")
+
+    cases = await run_in_threadpool(list_searchable_cases, user_id, include_common_cases)
+    if case_names:
+        cases = [case for case in cases if case[1] in case_names]
+    if not cases:
+        raise HTTPException(status_code=404, detail="No cases found.")
+
+    hits, incomplete = await search_client.asearch_cases(
+        user_query,
+        cases,
+        top_k=settings.SEARCH_TOP_K,
+        max_workers=settings.SEARCH_FANOUT_WORKERS,
+        timeout=settings.SEARCH_FANOUT_TIMEOUT,
+    )
+    if incomplete:
+        logger.warning(f"search_cases skipped {incomplete}")
+
+    def build_multi_case_results():
+        return [
+            build_search_results(request, [hit], hit["user_id"], hit["case_name"], return_urls)[0].model_copy(
+                update={"user_id": hit["user_id"], "case_name": hit["case_name"]}
+            )
+            for hit in hits
+        ]
+
+    # dataset reads and base64 encoding are blocking, keep them off the event loop
+    search_results_data = await run_in_threadpool(build_multi_case_results)
+
+    end_time = time.time()
+    logger.info(f"done ai_search_cases, total time {end_time - start_time}")
+
+    return MultiCaseSearchResponse(
+        search_results=search_results_data,
+        incomplete_cases=[f"{owner}/{case_name}" for owner, case_name in incomplete],
+    )
+
+
+def parse_byte_range(range_header: str, size: int):
+    """Parse a single ``bytes=start-end`` range into inclusive offsets, or None when it cannot be satisfied."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # suffix range: the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+@app.get("/page_image/{user_id}/{case_name}/{pdf_name}/{pdf_page}")
+def page_image(request: Request, user_id: str, case_name: str, pdf_name: str, pdf_page: int, thumbnail: bool = False):
+    """
+    Serve the stored JPEG (or its 512px thumbnail) of one page, with ETag revalidation and byte ranges.
+    """
+    validate_identifier(user_id, "user_id")
+    validate_identifier(case_name, "case_name")
+    validate_filename(pdf_name, "pdf_name")
+
+    row = load_page_row(user_id, case_name, pdf_name, pdf_page)
+    content = get_page_thumbnail_jpeg(row) if thumbnail else get_page_jpeg(row)
+    etag = f'"{hashlib.md5(content).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": settings.PAGE_IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header:
+        byte_range = parse_byte_range(range_header, len(content))
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(content)}"})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+        return Response(content=content[start : end + 1], status_code=206, media_type="image/jpeg", headers=headers)
+
+    return Response(content=content, media_type="image/jpeg", headers=headers)
+
+
 def process_case(case_info: CaseInfo, user_id: str):
     logger.info("start post_process_case")
     start_time = time.time()
 
-    dataset = pdfs_to_hf_dataset(case_info.case_dir)
-    dataset.save_to_disk(case_info.case_dir /  settings.HF_DATASET_DIRNAME)
-    search_client.ingest(case_info.name, dataset, user_id)
+    invalidate_case_caches(user_id, case_info.name)
+    dataset_path = case_info.case_dir / settings.HF_DATASET_DIRNAME
+    pdf_files = sorted(case_info.case_dir.glob("*.pdf"))
+    with tempfile.TemporaryDirectory(dir=case_info.case_dir) as cache_dir:
+        ingest_pdfs(
+            pdf_files,
+            dataset_path,
+            cache_dir,
+            search_client,
+            case_info.name,
+            user_id,
+            page_batch_size=settings.PDF_PAGE_BATCH_SIZE,
+            embed_batch_size=settings.COLPALI_BATCH_SIZE,
+            queue_size=settings.PIPELINE_QUEUE_SIZE,
+            render_workers=settings.RENDER_WORKERS,
+            thread_count=settings.RENDER_THREAD_COUNT,
+            extract_text=settings.EXTRACT_PAGE_TEXT,
+        )
+    # a float16 store would be twice the size of an int8 case's codes, int8 candidates are reranked from the codes
+    if settings.WRITE_EMBEDDING_STORE and settings.VECTOR_DTYPE != "int8":
+        search_client.write_case_vectors(case_info.name, user_id)
+    dataset = load_from_disk(dataset_path)
+    save_page_index(build_page_index(dataset), case_info.case_dir / settings.PAGE_INDEX_FILENAME)
+    invalidate_case_caches(user_id, case_info.name)
 
     case_info.update_status("done")
 
@@ -278,6 +916,7 @@ def create_new_case(
     file_names = []
     for uploaded_file in files:
         filename = os.path.basename(uploaded_file.filename)
+        validate_filename(filename, "file name")
         if not filename.lower().endswith(".pdf"):
             raise HTTPException(status_code=400, detail=f"Unsupported file type: {filename}")
         file_path = case_dir / filename
@@ -332,7 +971,7 @@ def get_cases(user_id: str):
             case_data.append(case_info.dict())
 
     # Add common cases
-    common_cases_dir = os.path.join(settings.STORAGE_DIR, "common_cases")
+    common_cases_dir = os.path.join(settings.STORAGE_DIR, COMMON_CASES_USER_ID)
     if os.path.exists(common_cases_dir):
         common_cases = os.listdir(common_cases_dir)
         for case in common_cases:
@@ -363,7 +1002,9 @@ def get_case(user_id: str, case_name: str) -> CaseInfo:
     case_info_path = os.path.join(settings.STORAGE_DIR, user_id, case_name, settings.CASE_INFO_FILENAME)
     if not os.path.exists(case_info_path):
         # Check common cases
-        case_info_path = os.path.join(settings.STORAGE_DIR, "common_cases", case_name, settings.CASE_INFO_FILENAME)
+        case_info_path = os.path.join(
+            settings.STORAGE_DIR, COMMON_CASES_USER_ID, case_name, settings.CASE_INFO_FILENAME
+        )
         if not os.path.exists(case_info_path):
             raise HTTPException(status_code=404, detail="Case info not found.")
 
@@ -390,7 +1031,11 @@ def delete_case(user_id: str, case_name: str):
     case_dir = os.path.join(settings.STORAGE_DIR, user_id, case_name)
     if os.path.exists(case_dir):
         try:
+            # drop cached handles first, the embedding store is memory-mapped while cached
+            invalidate_case_caches(user_id, case_name)
+            search_client.delete_case(case_name, user_id)
             shutil.rmtree(case_dir)
+            invalidate_case_caches(user_id, case_name)
         except Exception as exc:
             logger.error("Failed to delete case: %s", exc)
             raise HTTPException(status_code=500, detail="Failed to delete case.") from exc
@@ -403,6 +1048,54 @@ def delete_case(user_id: str, case_name: str):
     return {"message": f"Case '{case_name}' has been deleted."}
 
 
+@app.post("/compression_report")
+def compression_report(
+    user_id: str = Form(...),
+    case_name: str = Form(...),
+    queries: List[str] = Form(...),
+    budgets: str = Form("32,64,128,256"),
+    top_k: int = Form(10),
+):
+    """
+    Recall@top_k versus stored size when the case's pages are compressed to each token budget
+    (comma separated), using the configured TOKEN_COMPRESSION method and the given sample queries.
+    Only available with TOKEN_BUDGET=0, when the stored pages are the full multivectors to compare with.
+    """
+    validate_identifier(user_id, "user_id")
+    validate_identifier(case_name, "case_name")
+    if settings.TOKEN_BUDGET > 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Pages are stored compressed (TOKEN_BUDGET > 0), there are no full multivectors to compare with.",
+        )
+
+    case_info_path = os.path.join(settings.STORAGE_DIR, user_id, case_name, settings.CASE_INFO_FILENAME)
+    if not os.path.exists(case_info_path):
+        raise HTTPException(status_code=404, detail="Case info not found.")
+    try:
+        budget_values = [int(budget) for budget in budgets.split(",") if budget.strip()]
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="budgets must be comma separated integers.") from exc
+    if not budget_values or min(budget_values) <= 0:
+        raise HTTPException(status_code=400, detail="budgets must be positive.")
+    if top_k <= 0:
+        raise HTTPException(status_code=400, detail="top_k must be positive.")
+
+    return {"report": search_client.compression_report(case_name, user_id, queries, budget_values, top_k)}
+
+
+@app.get("/cache_stats")
+def cache_stats():
+    return {
+        "datasets": dataset_cache.stats(),
+        "page_indexes": page_index_cache.stats(),
+        "tables": search_client.backend.stats(),
+        "query_embeddings": search_client.query_cache.stats(),
+        "case_vectors": search_client.case_vectors_cache.stats(),
+        "answers": answer_cache.stats() if answer_cache is not None else None,
+    }
+
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
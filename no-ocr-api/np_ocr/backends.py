@@ -0,0 +1,536 @@
+import abc
+import heapq
+import logging
+import math
+import queue
+import threading
+import time
+from typing import Optional
+
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+from np_ocr.cache import LRUCache
+from np_ocr.vectors import (
+    CaseVectors,
+    maxsim_distances,
+    multivector_array,
+    multivector_to_numpy,
+    page_multivectors,
+    rank_by_distance,
+    storage_dtype,
+)
+
+logger = logging.getLogger()
+
+VECTOR_BACKENDS = ("lance", "qdrant")
+LANCE_INDEX_TYPES = ("IVF_PQ", "IVF_HNSW_SQ", "IVF_HNSW_PQ")
+
+
+def lance_index_params(
+    num_rows: int,
+    num_vectors: int,
+    dim: int,
+    index_type: str = "IVF_PQ",
+    min_rows: int = 256,
+    flat_max_rows: int = 4096,
+) -> Optional[dict]:
+    """``create_index`` arguments for a table of ``num_rows`` pages holding ``num_vectors`` token vectors, None
+    when it is better left unindexed.
+
+    Below ``min_rows`` a brute-force scan is cheap, and PQ has too few vectors to train on. Up to
+    ``flat_max_rows`` an IVF_FLAT index keeps full vectors, above that ``index_type`` compresses them. A
+    multivector index partitions token vectors rather than pages, so the partition count grows with the square
+    root of ``num_vectors``.
+    """
+    if num_rows < min_rows:
+        return None
+    if num_rows <= flat_max_rows:
+        index_type = "IVF_FLAT"
+    params = {"index_type": index_type, "num_partitions": max(1, math.isqrt(num_vectors))}
+    if index_type.endswith("PQ"):
+        # sub-vectors of 8 dimensions, or the widest smaller width that divides dim
+        width = next(width for width in (8, 4, 2, 1) if dim % width == 0)
+        params["num_sub_vectors"] = dim // width
+    return params
+
+
+def lance_nprobes(num_partitions: int, fraction: float, min_nprobes: int = 20) -> int:
+    """Partitions to probe per query: ``fraction`` of them, at least ``min_nprobes`` and at most all."""
+    return min(num_partitions, max(min_nprobes, math.ceil(num_partitions * fraction)))
+
+
+class IndexBuilder:
+    """Runs index builds one at a time on a background thread, so ingestion returns before they finish.
+
+    Concurrent ingests queue up here instead of training indexes in parallel. ``wait`` blocks until the queue
+    is drained.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def schedule(self, *args):
+        """Queue ``build(*args)``."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="index-builder", daemon=True)
+                self._thread.start()
+        self._queue.put(args)
+
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self.build(*args)
+            except Exception as e:
+                logger.error(f"Error during index build: {e}")
+            finally:
+                self._queue.task_done()
+
+
+class VectorBackend(abc.ABC):
+    """Where the page multivectors of each case live and how they are searched.
+
+    A case is identified by (case_name, user_id). ``create`` returns a handle that ``add_batch`` and
+    ``build_index`` take; batches are Arrow tables laid out as ``SearchClient.table_schema``. ``search`` returns
+    dicts with ``index``, ``pdf_name``, ``pdf_page`` and ``_distance`` in LanceDB's cosine MaxSim convention
+    (``n_query_tokens - sum(max cosine)``, lower is better).
+    """
+
+    # whether int8 storage is done by the caller (vector_codes/vector_scales columns) or by the backend itself
+    int8_codes = False
+
+    @abc.abstractmethod
+    def create(self, case_name: str, user_id: str, schema: pa.Schema):
+        ...
+
+    @abc.abstractmethod
+    def add_batch(self, handle, table: pa.Table):
+        ...
+
+    @abc.abstractmethod
+    def build_index(self, handle, case_name: str, user_id: str):
+        ...
+
+    @abc.abstractmethod
+    def search(
+        self, multivector_query: np.ndarray, case_name: str, user_id: str, top_k: int,
+        store: Optional[CaseVectors] = None,
+    ):
+        """``store`` is the case's embedding store when one was written, backends may rerank from it."""
+
+    @abc.abstractmethod
+    def delete(self, case_name: str, user_id: str):
+        ...
+
+    @abc.abstractmethod
+    def count(self, case_name: str, user_id: str) -> int:
+        ...
+
+    @abc.abstractmethod
+    def iter_pages(self, case_name: str, user_id: str, batch_size: int = 256):
+        """Yield the stored pages as Arrow tables with the metadata and full vector columns, in index order."""
+
+    def invalidate(self, case_name: str, user_id: str):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class LanceBackend(VectorBackend):
+    """One LanceDB table per case, stored under ``storage_dir/user_id/case_name``.
+
+    Indexes are built in the background by an ``IndexBuilder`` with parameters from ``lance_index_params``.
+    Until a case's index exists its searches fall back to a brute-force scan.
+    """
+
+    int8_codes = True
+
+    def __init__(
+        self,
+        storage_dir: str,
+        table_cache_size: int = 16,
+        rescore_factor: int = 4,
+        prefilter_candidates: int = 64,
+        index_type: str = "IVF_PQ",
+        min_index_rows: int = 256,
+        flat_index_max_rows: int = 4096,
+        nprobes_fraction: float = 0.1,
+        refine_factor: int = 5,
+    ):
+        if index_type not in LANCE_INDEX_TYPES:
+            raise ValueError(f"index_type must be one of {LANCE_INDEX_TYPES}, got {index_type}")
+        self.storage_dir = storage_dir
+        self.table_cache = LRUCache(table_cache_size)
+        self.index_params = LRUCache(table_cache_size)
+        self.rescore_factor = rescore_factor
+        self.prefilter_candidates = prefilter_candidates
+        self.index_type = index_type
+        self.min_index_rows = min_index_rows
+        self.flat_index_max_rows = flat_index_max_rows
+        self.nprobes_fraction = nprobes_fraction
+        self.refine_factor = refine_factor
+        self.index_builder = IndexBuilder(self._build_index)
+
+    def connect(self, case_name: str, user_id: str):
+        return lancedb.connect(f"{self.storage_dir}/{user_id}/{case_name}")
+
+    def open_table(self, case_name: str, user_id: str):
+        """Return an open LanceDB table for the case, cached per (user_id, case_name)."""
+        return self.table_cache.get_or_load(
+            (user_id, case_name), lambda: self.connect(case_name, user_id).open_table(case_name)
+        )
+
+    def invalidate(self, case_name: str, user_id: str):
+        self.table_cache.invalidate((user_id, case_name))
+        self.index_params.invalidate((user_id, case_name))
+
+    def stats(self):
+        return {**self.table_cache.stats(), "pending_index_builds": self.index_builder.pending()}
+
+    def create(self, case_name: str, user_id: str, schema: pa.Schema):
+        """Create the case's table, replacing an existing one as QdrantBackend replaces its collection."""
+        self.invalidate(case_name, user_id)
+        return self.connect(case_name, user_id).create_table(case_name, schema=schema, mode="overwrite")
+
+    def add_batch(self, tbl, table: pa.Table):
+        tbl.add(table)
+
+    def build_index(self, tbl, case_name: str, user_id: str):
+        """Queue the index build, the case is searchable by brute force in the meantime."""
+        self.index_builder.schedule(tbl, case_name, user_id)
+
+    @staticmethod
+    def _index_column(schema: pa.Schema) -> Optional[str]:
+        if "pooled_vector" in schema.names:
+            # two-stage search only looks up the pooled column, the full multivectors are read for candidates
+            return "pooled_vector"
+        if "vector_codes" in schema.names:
+            # LanceDB cannot index int8 multivectors, int8 tables written without pooled_vector are scanned
+            return None
+        return "vector"
+
+    def _params_for(self, tbl, num_rows: int, column: str) -> Optional[dict]:
+        if num_rows < self.min_index_rows:
+            return None
+        # token vectors per page vary, so they are counted from the list lengths
+        num_vectors = 0
+        for batch in tbl.search().select([column]).limit(None).to_batches(4096):
+            num_vectors += int(np.diff(batch.column(0).offsets.to_numpy()).sum())
+        dim = tbl.schema.field(column).type.value_type.list_size
+        return lance_index_params(
+            num_rows, num_vectors, dim, self.index_type, self.min_index_rows, self.flat_index_max_rows
+        )
+
+    def _build_index(self, tbl, case_name: str, user_id: str):
+        column = self._index_column(tbl.schema)
+        if column is None:
+            return
+        num_rows = tbl.count_rows()
+        params = self._params_for(tbl, num_rows, column)
+        if params is None:
+            logger.info(f"skip build_index for {num_rows} rows, searches scan the table")
+            return
+        logger.info("start build_index")
+        start_time = time.time()
+        tbl.create_index(metric="cosine", vector_column_name=column, **params)
+        # open handles never see an index created through another handle, searches reopen the table to use it
+        self.table_cache.invalidate((user_id, case_name))
+        self.index_params.put((user_id, case_name), params)
+        end_time = time.time()
+        logger.info(f"done build_index {params} for {num_rows} rows, total time {end_time - start_time}")
+
+    def query_index_params(self, tbl, case_name: str, user_id: str) -> Optional[dict]:
+        """Parameters of the case's built index, None while there is none yet.
+
+        Only built indexes are cached, so a case whose build is still queued is looked up again next time.
+        """
+        key = (user_id, case_name)
+        params = self.index_params.get(key)
+        if params is None:
+            column = self._index_column(tbl.schema)
+            indexes = [index for index in tbl.list_indices() if column in index.columns] if column else []
+            if not indexes:
+                return None
+            num_rows = tbl.index_stats(indexes[0].name).num_indexed_rows
+            params = self._params_for(tbl, num_rows, column)
+            if params is None:
+                return None
+            self.index_params.put(key, params)
+        return params
+
+    def _vector_query(self, tbl, multivector_query, params: Optional[dict], column: str = "vector"):
+        """A vector query on ``column`` probing the index per ``params``, or a brute-force scan when it is None."""
+        # the cosine metric the indexes are built with, distance_type needs the pinned lancedb 0.40
+        query = tbl.search(multivector_query, vector_column_name=column).distance_type("cosine")
+        if params is None:
+            return query.bypass_vector_index()
+        query = query.nprobes(lance_nprobes(params["num_partitions"], self.nprobes_fraction))
+        if params["index_type"].endswith("PQ"):
+            query = query.refine_factor(self.refine_factor)
+        return query
+
+    def delete(self, case_name: str, user_id: str):
+        self.invalidate(case_name, user_id)
+        self.connect(case_name, user_id).drop_table(case_name, ignore_missing=True)
+
+    def count(self, case_name: str, user_id: str) -> int:
+        return self.open_table(case_name, user_id).count_rows()
+
+    @staticmethod
+    def _full_columns(tbl):
+        return ["vector_codes", "vector_scales"] if storage_dtype(tbl.schema) == "int8" else ["vector"]
+
+    def iter_pages(self, case_name: str, user_id: str, batch_size: int = 256):
+        tbl = self.open_table(case_name, user_id)
+        pages = tbl.search().select(["index", "pdf_name", "pdf_page", *self._full_columns(tbl)]).limit(None)
+        for batch in pages.to_batches(batch_size):
+            yield pa.Table.from_batches([batch])
+
+    def search(self, multivector_query, case_name: str, user_id: str, top_k: int, store=None):
+        tbl = self.open_table(case_name, user_id)
+        if "pooled_vector" in tbl.schema.names:
+            params = self.query_index_params(tbl, case_name, user_id)
+            return self._search_two_stage(tbl, multivector_query, top_k, store, params)
+        dtype = storage_dtype(tbl.schema)
+        if dtype == "int8":
+            if store is not None:
+                return store.search(multivector_query, top_k)
+            return self._scan_quantized(tbl, multivector_query, top_k)
+        params = self.query_index_params(tbl, case_name, user_id)
+        if dtype == "float16":
+            return self._search_and_rescore(tbl, multivector_query, top_k, store, params)
+        query = self._vector_query(tbl, multivector_query, params)
+        return query.limit(top_k).select(["index", "pdf_name", "pdf_page"]).to_list()
+
+    def _rerank(self, tbl, candidates_query, multivector_query, top_k: int, store):
+        """Exact MaxSim over LanceDB candidates; full vectors come from the embedding store when there is one."""
+        columns = ["index", "pdf_name", "pdf_page"]
+        if store is None:
+            columns += self._full_columns(tbl)
+        candidates = candidates_query.select(columns).to_arrow()
+        if store is not None:
+            positions = store.positions_of(candidates.column("index").to_numpy())
+            distances = store.distances_for(multivector_query, positions)
+        else:
+            flat, lengths = page_multivectors(candidates)
+            distances = maxsim_distances(multivector_query, flat, lengths)
+        return rank_by_distance(candidates, distances, top_k)
+
+    def _search_and_rescore(self, tbl, multivector_query, top_k: int, store, params: Optional[dict] = None):
+        """Take ``rescore_factor * top_k`` candidates from LanceDB and re-rank them with exact float32 MaxSim."""
+        candidates_query = self._vector_query(tbl, multivector_query, params).limit(top_k * self.rescore_factor)
+        return self._rerank(tbl, candidates_query, multivector_query, top_k, store)
+
+    def _scan_quantized(self, tbl, multivector_query, top_k: int, batch_size: int = 256):
+        """Exact MaxSim against every dequantized page of an int8 table without ``pooled_vector``.
+
+        Pages are read ``batch_size`` at a time and only the running top-k is kept, so memory does not grow
+        with the case.
+        """
+        columns = ["index", "pdf_name", "pdf_page", "vector_codes", "vector_scales"]
+        best = []
+        for batch in tbl.search().select(columns).limit(None).to_batches(batch_size):
+            pages = pa.Table.from_batches([batch])
+            flat, lengths = page_multivectors(pages)
+            hits = rank_by_distance(pages, maxsim_distances(multivector_query, flat, lengths), top_k)
+            best = heapq.nsmallest(top_k, best + hits, key=lambda hit: hit["_distance"])
+        return best
+
+    def _search_two_stage(self, tbl, multivector_query, top_k: int, store, params: Optional[dict] = None):
+        """Prefilter pages on ``pooled_vector``, then rank the ``prefilter_candidates`` best by exact MaxSim."""
+        candidates_query = self._vector_query(tbl, multivector_query, params, column="pooled_vector").limit(
+            max(self.prefilter_candidates, top_k)
+        )
+        return self._rerank(tbl, candidates_query, multivector_query, top_k, store)
+
+
+class QdrantBackend(VectorBackend):
+    """One Qdrant collection per case with MAX_SIM multivectors.
+
+    float16 maps to Qdrant's FLOAT16 datatype and int8 to scalar quantization kept in RAM, with the originals
+    on disk for rescoring. Pooled page vectors become a second named vector used as a prefetch stage. Indexing
+    is disabled while a case is uploaded and enabled by ``build_index``.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6333,
+        https: bool = False,
+        api_key: Optional[str] = None,
+        prefer_grpc: bool = False,
+        vector_dtype: str = "float32",
+        upsert_batch_size: int = 16,
+        indexing_threshold: int = 20000,
+        quantile: float = 0.99,
+        rescore_factor: int = 4,
+        prefilter_candidates: int = 64,
+    ):
+        try:
+            from qdrant_client import QdrantClient, models
+        except ImportError as exc:
+            raise ImportError("VECTOR_BACKEND=qdrant needs qdrant-client, pip install qdrant-client") from exc
+
+        self.models = models
+        self.client = QdrantClient(host=host, port=port, https=https, api_key=api_key, prefer_grpc=prefer_grpc)
+        self.vector_dtype = vector_dtype
+        self.upsert_batch_size = upsert_batch_size
+        self.indexing_threshold = indexing_threshold
+        self.quantile = quantile
+        self.rescore_factor = rescore_factor
+        self.prefilter_candidates = prefilter_candidates
+        self._pooled = {}
+
+    @staticmethod
+    def collection_name(case_name: str, user_id: str) -> str:
+        # identifiers cannot contain dots, so the name is unambiguous
+        return f"{user_id}.{case_name}"
+
+    def _vector_params(self, size: int, quantized: bool):
+        models = self.models
+        params = dict(
+            size=size,
+            distance=models.Distance.COSINE,
+            multivector_config=models.MultiVectorConfig(comparator=models.MultiVectorComparator.MAX_SIM),
+        )
+        if self.vector_dtype == "float16":
+            params["datatype"] = models.Datatype.FLOAT16
+        if quantized and self.vector_dtype == "int8":
+            params["on_disk"] = True
+            params["quantization_config"] = models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(
+                    type=models.ScalarType.INT8, quantile=self.quantile, always_ram=True
+                )
+            )
+        return models.VectorParams(**params)
+
+    def create(self, case_name: str, user_id: str, schema: pa.Schema):
+        name = self.collection_name(case_name, user_id)
+        size = schema.field("vector").type.value_type.list_size
+        vectors_config = {"vector": self._vector_params(size, quantized=True)}
+        if "pooled_vector" in schema.names:
+            vectors_config["pooled_vector"] = self._vector_params(size, quantized=False)
+        if self.client.collection_exists(name):
+            self.client.delete_collection(name)
+        self.client.create_collection(
+            collection_name=name,
+            vectors_config=vectors_config,
+            on_disk_payload=True,
+            # bulk upload first, index once in build_index
+            optimizers_config=self.models.OptimizersConfigDiff(indexing_threshold=0),
+        )
+        self._pooled[name] = "pooled_vector" in schema.names
+        return name
+
+    def add_batch(self, name: str, table: pa.Table):
+        flat, lengths = page_multivectors(table)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        pooled = None
+        if "pooled_vector" in table.schema.names:
+            pooled_flat, pooled_lengths = multivector_to_numpy(table.column("pooled_vector"))
+            pooled_offsets = np.concatenate([[0], np.cumsum(pooled_lengths)])
+            pooled = [pooled_flat[pooled_offsets[i] : pooled_offsets[i + 1]] for i in range(table.num_rows)]
+
+        rows = table.select(["index", "pdf_name", "pdf_page"]).to_pylist()
+        points = []
+        for i, row in enumerate(rows):
+            vector = {"vector": flat[offsets[i] : offsets[i + 1]].tolist()}
+            if pooled is not None:
+                vector["pooled_vector"] = pooled[i].tolist()
+            points.append(self.models.PointStruct(id=row["index"], vector=vector, payload=row))
+
+        for start in range(0, len(points), self.upsert_batch_size):
+            self.client.upsert(collection_name=name, points=points[start : start + self.upsert_batch_size], wait=True)
+
+    def build_index(self, name: str, case_name: str, user_id: str):
+        self.client.update_collection(
+            collection_name=name,
+            optimizers_config=self.models.OptimizersConfigDiff(indexing_threshold=self.indexing_threshold),
+        )
+
+    def _has_pooled(self, name: str) -> bool:
+        if name not in self._pooled:
+            vectors = self.client.get_collection(name).config.params.vectors
+            self._pooled[name] = "pooled_vector" in vectors
+        return self._pooled[name]
+
+    def search(self, multivector_query, case_name: str, user_id: str, top_k: int, store=None):
+        models = self.models
+        name = self.collection_name(case_name, user_id)
+        query = np.asarray(multivector_query, dtype=np.float32).tolist()
+        prefetch = None
+        if self._has_pooled(name):
+            prefetch = models.Prefetch(
+                query=query, using="pooled_vector", limit=max(self.prefilter_candidates, top_k)
+            )
+        search_params = None
+        if self.vector_dtype == "int8":
+            search_params = models.SearchParams(
+                quantization=models.QuantizationSearchParams(rescore=True, oversampling=self.rescore_factor)
+            )
+        response = self.client.query_points(
+            collection_name=name,
+            query=query,
+            using="vector",
+            prefetch=prefetch,
+            limit=top_k,
+            search_params=search_params,
+            with_payload=["index", "pdf_name", "pdf_page"],
+        )
+        # Qdrant returns the MaxSim similarity, convert to the LanceDB distance used everywhere else
+        return [
+            {
+                "index": point.payload["index"],
+                "pdf_name": point.payload["pdf_name"],
+                "pdf_page": point.payload["pdf_page"],
+                "_distance": float(len(query) - point.score),
+            }
+            for point in response.points
+        ]
+
+    def delete(self, case_name: str, user_id: str):
+        name = self.collection_name(case_name, user_id)
+        self._pooled.pop(name, None)
+        if self.client.collection_exists(name):
+            self.client.delete_collection(name)
+
+    def count(self, case_name: str, user_id: str) -> int:
+        return self.client.count(self.collection_name(case_name, user_id), exact=True).count
+
+    def iter_pages(self, case_name: str, user_id: str, batch_size: int = 256):
+        name = self.collection_name(case_name, user_id)
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=name, limit=batch_size, offset=offset, with_payload=True, with_vectors=["vector"]
+            )
+            if points:
+                vectors = [np.asarray(point.vector["vector"], dtype=np.float32) for point in points]
+                lengths = np.array([len(vector) for vector in vectors], dtype=np.int64)
+                flat = np.concatenate(vectors)
+                yield pa.table(
+                    {
+                        "index": [point.payload["index"] for point in points],
+                        "pdf_name": [point.payload["pdf_name"] for point in points],
+                        "pdf_page": [point.payload["pdf_page"] for point in points],
+                        "vector": multivector_array(flat, lengths, flat.shape[1]),
+                    }
+                )
+            if offset is None:
+                return
+
+    def invalidate(self, case_name: str, user_id: str):
+        self._pooled.pop(self.collection_name(case_name, user_id), None)
@@ -0,0 +1,215 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import diskcache
+
+
+class LRUCache:
+    """Thread-safe, bounded LRU mapping with hit/miss counters.
+
+    With ``ttl`` (seconds) entries older than that are treated as missing.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                value, expires_at = self._data[key]
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is None:
+            # Loading happens outside the lock so a slow load does not block other keys.
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def normalize_query(query_text: str) -> str:
+    """Canonical form of a query for cache keys: NFC unicode, trimmed, runs of whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFC", query_text).split())
+
+
+class QueryEmbeddingCache:
+    """Query multivectors keyed by (model id, normalized query), in memory with an optional disk tier.
+
+    The memory tier is an LRU with TTL; the disk tier (``disk_dir``) survives restarts and is shared by workers.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        max_size: int,
+        ttl: Optional[float] = None,
+        disk_dir: Optional[str] = None,
+        disk_size_limit: int = 2**30,
+    ):
+        self.model_id = model_id
+        self.ttl = ttl
+        self.memory = LRUCache(max_size, ttl=ttl)
+        self.disk = diskcache.Cache(disk_dir, size_limit=disk_size_limit) if disk_dir else None
+        self.disk_hits = 0
+
+    def _key(self, query_text: str) -> str:
+        return f"{self.model_id}\n{normalize_query(query_text)}"
+
+    def get(self, query_text: str):
+        key = self._key(query_text)
+        embedding = self.memory.get(key)
+        if embedding is None and self.disk is not None:
+            embedding = self.disk.get(key)
+            if embedding is not None:
+                self.disk_hits += 1
+                self.memory.put(key, embedding)
+        return embedding
+
+    def put(self, query_text: str, embedding):
+        key = self._key(query_text)
+        self.memory.put(key, embedding)
+        if self.disk is not None:
+            self.disk.set(key, embedding, expire=self.ttl)
+
+    def stats(self):
+        memory = self.memory.stats()
+        lookups = memory["hits"] + memory["misses"]
+        hits = memory["hits"] + self.disk_hits
+        return {
+            "memory": memory,
+            "disk_hits": self.disk_hits,
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+class AnswerCache:
+    """VLM page answers on disk, keyed by (case, page content hash, model, prompt version, normalized query).
+
+    Entries expire after ``ttl`` seconds and the least recently used ones are evicted beyond ``size_limit``
+    bytes. Every entry is tagged with its case, so ``invalidate_case`` drops all of a case's answers at once.
+    """
+
+    def __init__(
+        self, directory: str, model_id: str, prompt_version: str, ttl: Optional[float] = None, size_limit: int = 2**30
+    ):
+        self.directory = directory
+        self.model_id = model_id
+        self.prompt_version = prompt_version
+        self.ttl = ttl
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        self._disk = None
+        self._lock = threading.Lock()
+
+    @property
+    def disk(self) -> diskcache.Cache:
+        # opened on first use, so importing the API does not create the cache directory
+        with self._lock:
+            if self._disk is None:
+                self._disk = diskcache.Cache(
+                    self.directory,
+                    size_limit=self.size_limit,
+                    eviction_policy="least-recently-used",
+                    tag_index=True,
+                )
+            return self._disk
+
+    @staticmethod
+    def _tag(user_id: str, case_name: str) -> str:
+        return f"{user_id}/{case_name}"
+
+    def _key(self, user_id: str, case_name: str, image_data: bytes, query_text: str):
+        page_hash = hashlib.sha256(image_data).hexdigest()
+        return (user_id, case_name, page_hash, self.model_id, self.prompt_version, normalize_query(query_text))
+
+    def get(self, user_id: str, case_name: str, image_data: bytes, query_text: str) -> Optional[dict]:
+        """The cached ``{"answer", "confidence"}`` for the page image and query, None on a miss."""
+        answer = self.disk.get(self._key(user_id, case_name, image_data, query_text))
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def put(
+        self,
+        user_id: str,
+        case_name: str,
+        image_data: bytes,
+        query_text: str,
+        answer: str,
+        confidence: Optional[float] = None,
+    ):
+        self.disk.set(
+            self._key(user_id, case_name, image_data, query_text),
+            {"answer": answer, "confidence": confidence},
+            expire=self.ttl,
+            tag=self._tag(user_id, case_name),
+        )
+
+    def invalidate_case(self, user_id: str, case_name: str):
+        self.disk.evict(self._tag(user_id, case_name))
+
+    def clear(self):
+        self.disk.clear()
+
+    def stats(self):
+        disk = self.disk
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(disk),
+                "volume": disk.volume(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
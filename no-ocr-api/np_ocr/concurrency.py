@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
+
+logger = logging.getLogger()
+
+# fan_out calls may be abandoned while still running, so they share one fixed pool: a hung call ties up one of
+# these threads until it returns instead of leaking a fresh thread per request
+FAN_OUT_POOL_SIZE = 32
+
+_fan_out_pool: Optional[ThreadPoolExecutor] = None
+_fan_out_pool_lock = threading.Lock()
+
+
+def _shared_fan_out_pool() -> ThreadPoolExecutor:
+    global _fan_out_pool
+    with _fan_out_pool_lock:
+        if _fan_out_pool is None:
+            _fan_out_pool = ThreadPoolExecutor(max_workers=FAN_OUT_POOL_SIZE, thread_name_prefix="fan-out")
+        return _fan_out_pool
+
+
+def ordered_concurrent_map(fn, items, max_in_flight: int, executor_factory=ThreadPoolExecutor):
+    """Yield ``fn(item)`` for every item in input order, keeping at most ``max_in_flight`` calls running.
+
+    Results that finish early are buffered until everything before them is done. The buffer is bounded too,
+    so a single slow call holds back at most ``max_in_flight`` finished results instead of stalling the pool.
+    ``executor_factory(max_workers=...)`` picks the pool; pass a process pool for CPU-bound work.
+    """
+    max_in_flight = max(1, max_in_flight)
+    items = iter(items)
+    pending = {}
+    done = {}
+    next_submit = 0
+    next_yield = 0
+    exhausted = False
+
+    with executor_factory(max_workers=max_in_flight) as executor:
+        while True:
+            while not exhausted and len(pending) < max_in_flight and next_submit - next_yield < 2 * max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(fn, item)] = next_submit
+                next_submit += 1
+
+            while next_yield in done:
+                yield done.pop(next_yield)
+                next_yield += 1
+
+            if not pending:
+                if exhausted:
+                    return
+                continue
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done[pending.pop(future)] = future.result()
+
+
+def fan_out(fn, items, max_workers: int, timeout: Optional[float] = None):
+    """Run ``fn(item)`` for every item, at most ``max_workers`` at a time, for at most ``timeout`` seconds.
+
+    Returns ``(results, incomplete)``: results of the calls that finished in time, keyed by item, and the
+    items whose call raised, missed the deadline or never started. Calls run on a shared pool of
+    ``FAN_OUT_POOL_SIZE`` threads; late calls are abandoned rather than waited for, so one slow item cannot
+    hold up the rest, and items not yet started when the deadline passes are never run.
+    """
+    items = list(items)
+    results = {}
+    incomplete = []
+    if not items:
+        return results, incomplete
+    pool = _shared_fan_out_pool()
+    limit = max(1, min(max_workers, len(items)))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    queued = iter(items)
+    running = {}
+    exhausted = False
+
+    while True:
+        while not exhausted and len(running) < limit:
+            try:
+                item = next(queued)
+            except StopIteration:
+                exhausted = True
+                break
+            running[pool.submit(fn, item)] = item
+        if not running:
+            break
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            break
+        done, _ = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            item = running.pop(future)
+            if future.exception() is not None:
+                logger.error(f"Error during fan out for {item}: {future.exception()}")
+                incomplete.append(item)
+            else:
+                results[item] = future.result()
+
+    for future, item in running.items():
+        future.cancel()
+        incomplete.append(item)
+    incomplete.extend(queued)
+    return results, incomplete
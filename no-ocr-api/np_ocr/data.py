@@ -1,79 +1,193 @@
+import functools
+import io
+import json
 import logging
-import time
-import tracemalloc
+import multiprocessing
+import resource
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-from datasets import Dataset
-from pdf2image import convert_from_path
+from datasets import Features, Image, Value
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image as PILImage
 from pypdf import PdfReader
 from tqdm import tqdm
 
+from np_ocr.concurrency import ordered_concurrent_map
+
 logger = logging.getLogger()
 
 
-def get_pdf_images(pdf_path):
-    logger.info("start get_pdf_images")
-    start_time = time.time()
+PAGE_FEATURES = Features(
+    {
+        "image": Image(),
+        "index": Value("int64"),
+        "pdf_name": Value("string"),
+        "pdf_page": Value("int64"),
+        "page_text": Value("string"),
+        "thumbnail_jpeg": Value("binary"),
+    }
+)
 
-    reader = PdfReader(pdf_path)
-    page_texts = []
-    for page_number in range(len(reader.pages)):
-        page = reader.pages[page_number]
-        text = page.extract_text()
-        page_texts.append(text)
-    # Convert to PIL images
-    images = convert_from_path(
-        pdf_path, dpi=150, fmt="jpeg", jpegopt={"quality": 100, "progressive": True, "optimize": True}
+THUMBNAIL_SIZE = (512, 512)
+
+
+def encode_jpeg(pil_image) -> bytes:
+    buffered = io.BytesIO()
+    pil_image.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def make_thumbnail_jpeg(pil_image) -> bytes:
+    thumbnail = pil_image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    return encode_jpeg(thumbnail)
+
+
+def encode_page_row(row):
+    """Encode a rendered page once at ingest: full-size JPEG bytes for the ``image`` column plus a thumbnail."""
+    pil_image = row["image"]
+    row["image"] = {"bytes": encode_jpeg(pil_image), "path": None}
+    row["thumbnail_jpeg"] = make_thumbnail_jpeg(pil_image)
+    return row
+
+
+def _stored_image(image):
+    """Return a PIL image from either a decoded image or a ``decode=False`` ``{"bytes", "path"}`` dict."""
+    if isinstance(image, dict):
+        return PILImage.open(io.BytesIO(image["bytes"]) if image["bytes"] else image["path"])
+    return image
+
+
+def get_page_jpeg(row) -> bytes:
+    """Full-size JPEG of a dataset row, without decoding when the stored bytes are already JPEG."""
+    image = row["image"]
+    if isinstance(image, dict) and image["bytes"] and image["bytes"][:2] == b"\xff\xd8":
+        return image["bytes"]
+    return encode_jpeg(_stored_image(image).convert("RGB"))
+
+
+def get_page_thumbnail_jpeg(row) -> bytes:
+    """Precomputed thumbnail of a dataset row; rows ingested before thumbnails existed get one on the fly."""
+    if row.get("thumbnail_jpeg"):
+        return row["thumbnail_jpeg"]
+    return make_thumbnail_jpeg(_stored_image(row["image"]).convert("RGB"))
+
+
+def get_pdf_page_count(pdf_path) -> int:
+    return pdfinfo_from_path(pdf_path)["Pages"]
+
+
+def get_pdf_images(pdf_path, first_page: int, last_page: int, thread_count: int = 1):
+    """Render pages ``first_page..last_page`` (1-based, inclusive) of a PDF to PIL images."""
+    return convert_from_path(
+        pdf_path,
+        dpi=150,
+        fmt="jpeg",
+        jpegopt={"quality": 100, "progressive": True, "optimize": True},
+        first_page=first_page,
+        last_page=last_page,
+        thread_count=thread_count,
     )
-    assert len(images) == len(page_texts)
 
-    end_time = time.time()
-    logger.info(f"done get_pdf_images, total time {end_time - start_time}")
 
-    return images, page_texts
+def iter_page_ranges(pdf_files, page_batch_size: int = 8):
+    """Split every PDF into ``(pdf_path, first_page, last_page)`` render jobs of at most ``page_batch_size`` pages."""
+    for pdf_file in pdf_files:
+        page_count = get_pdf_page_count(str(pdf_file))
+        for first_page in range(1, page_count + 1, page_batch_size):
+            yield str(pdf_file), first_page, min(first_page + page_batch_size - 1, page_count)
 
 
-def pdfs_to_hf_dataset(path_to_folder):
-    logger.info("start pdfs_to_hf_dataset")
-    start_time = time.time()
+def render_page_range(job, thread_count: int = 1):
+    pdf_path, first_page, last_page = job
+    images = get_pdf_images(pdf_path, first_page, last_page, thread_count=thread_count)
+    assert len(images) == last_page - first_page + 1
+    return job, images
 
-    tracemalloc.start()  # Start tracing memory allocations
 
-    data = []
-    global_index = 0
+def extract_page_texts(pdf_path):
+    reader = PdfReader(pdf_path)
+    return [page.extract_text() for page in reader.pages]
+
+
+def log_peak_memory(label: str):
+    """Log the process peak RSS; unlike tracemalloc this needs no global tracing in the serving process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+    logger.info(f"{label}: Peak memory usage is {peak}MB")
+
 
-    folder_path = Path(path_to_folder)
-    pdf_files = list(folder_path.glob("*.pdf"))
-    for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
-        images, page_texts = get_pdf_images(str(pdf_file))
+def iter_pdf_rows(
+    pdf_files, page_batch_size: int = 8, render_workers: int = 1, thread_count: int = 1, extract_text: bool = False
+):
+    """Yield one dataset row per page of ``pdf_files``, numbering pages globally in file order.
 
-        for page_number, (image, text) in enumerate(zip(images, page_texts)):
-            data.append(
-                {
+    With ``render_workers > 1`` page ranges of all PDFs are rasterized on a process pool, so large PDFs are split
+    across cores too. Results are consumed in job order, which keeps ``index`` assignment deterministic.
+
+    ``page_text`` is only filled when ``extract_text`` is set. Extraction then runs on a background thread while
+    pages render, instead of as a second pass over every PDF.
+    """
+    text_executor = ThreadPoolExecutor(max_workers=1) if extract_text else None
+    page_texts = {}
+    if text_executor is not None:
+        for pdf_file in pdf_files:
+            page_texts[str(pdf_file)] = text_executor.submit(extract_page_texts, str(pdf_file))
+
+    jobs = iter_page_ranges(pdf_files, page_batch_size)
+    render = functools.partial(render_page_range, thread_count=thread_count)
+    if render_workers > 1:
+        executor_factory = functools.partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn"))
+        rendered = ordered_concurrent_map(render, jobs, render_workers, executor_factory=executor_factory)
+    else:
+        rendered = map(render, jobs)
+
+    global_index = 0
+    current_pdf = None
+    texts = None
+    try:
+        for (pdf_path, first_page, _), images in tqdm(rendered, desc="Processing page ranges"):
+            if pdf_path != current_pdf:
+                if current_pdf is not None:
+                    log_peak_memory(f"PDF {Path(current_pdf).name}")
+                current_pdf = pdf_path
+                texts = page_texts[pdf_path].result() if text_executor is not None else None
+
+            for pdf_page, image in enumerate(images, start=first_page):
+                yield {
                     "image": image,
                     "index": global_index,
-                    "pdf_name": pdf_file.name,
-                    "pdf_page": page_number + 1,
-                    "page_text": text,
+                    "pdf_name": Path(pdf_path).name,
+                    "pdf_page": pdf_page,
+                    "page_text": texts[pdf_page - 1] if texts is not None else None,
                 }
-            )
-            global_index += 1
-            # Print memory usage after processing each image
-            current, peak = tracemalloc.get_traced_memory()
+                global_index += 1
+    finally:
+        if text_executor is not None:
+            text_executor.shutdown(cancel_futures=True)
+        log_peak_memory("TOTAL")
+
+
+def build_page_index(dataset):
+    """Map every (pdf_name, pdf_page) of a dataset to its row index without decoding images."""
+    page_index = {}
+    for row_idx, (pdf_name, pdf_page) in enumerate(zip(dataset["pdf_name"], dataset["pdf_page"])):
+        page_index.setdefault(pdf_name, {})[str(pdf_page)] = row_idx
+    return page_index
+
 
-        # Print memory usage after processing each PDF
-        current, peak = tracemalloc.get_traced_memory()
-        logger.info(f"PDF: Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
+def save_page_index(page_index, path):
+    with open(path, "w") as json_file:
+        json.dump(page_index, json_file)
 
-    current, peak = tracemalloc.get_traced_memory()
-    logger.info(f"TOTAL: Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
-    tracemalloc.stop()  # Stop tracing memory allocations
 
-    logger.info("Done processing")
-    dataset = Dataset.from_list(data)
-    logger.info("Done converting to dataset")
+def load_page_index(path):
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path, "r") as json_file:
+        return json.load(json_file)
 
-    end_time = time.time()
-    logger.info(f"done pdfs_to_hf_dataset, total time {end_time - start_time}")
 
-    return dataset
+def lookup_page(page_index, pdf_name: str, pdf_page: int):
+    return page_index.get(pdf_name, {}).get(str(pdf_page))
@@ -0,0 +1,172 @@
+import logging
+import queue
+import threading
+import time
+
+from datasets import Dataset
+
+from np_ocr.data import PAGE_FEATURES, encode_page_row, iter_pdf_rows
+
+logger = logging.getLogger()
+
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _put(out: queue.Queue, item, stop: threading.Event) -> bool:
+    """Blocking put that gives up once ``stop`` is set, so producers never hang on a dead consumer."""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class _StoppedError(Exception):
+    """Raised in a stage once another stage failed and set ``stop``."""
+
+
+def iter_queue(source: queue.Queue, stop: threading.Event):
+    """Yield items from a stage queue until the producer finishes, re-raising the producer's error.
+
+    Raises ``_StoppedError`` when ``stop`` is set while waiting, so a stage never hangs on a dead producer.
+    """
+    while True:
+        try:
+            item = source.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                raise _StoppedError()
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, _Failed):
+            raise item.exc
+        yield item
+
+
+def start_stage(iterable, maxsize: int, stop: threading.Event, name: str) -> queue.Queue:
+    """Drain ``iterable`` on a background thread into a bounded queue and return that queue.
+
+    ``iterable`` should be lazy (a generator), so the work it does runs on the stage thread. It is closed as soon
+    as ``stop`` is set, so no more work is done for a failed pipeline.
+    """
+    out = queue.Queue(maxsize=maxsize)
+
+    def run():
+        try:
+            for item in iterable:
+                if not _put(out, item, stop):
+                    return
+        except BaseException as exc:
+            _put(out, _Failed(exc), stop)
+            return
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        _put(out, _DONE, stop)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return out
+
+
+def encode_rows(rows):
+    """JPEG-encode each rendered page once; the bytes feed both the HF dataset and the embedding requests."""
+    for row in rows:
+        yield encode_page_row(row)
+
+
+def ingest_pdfs(
+    pdf_files,
+    dataset_path,
+    cache_dir,
+    search_client,
+    case_name: str,
+    user_id: str,
+    page_batch_size: int = 8,
+    embed_batch_size: int = 8,
+    queue_size: int = 32,
+    render_workers: int = 1,
+    thread_count: int = 1,
+    extract_text: bool = False,
+):
+    """Render, encode, embed and store a case with every stage running concurrently.
+
+    render -> JPEG-encode -> append to HF dataset -> embed -> append to LanceDB. Stages are connected by queues of
+    ``queue_size`` items, so a fast stage blocks instead of buffering the case, and total time approaches the
+    time of the slowest stage.
+    """
+    logger.info("start ingest_pdfs")
+    start_time = time.time()
+
+    stop = threading.Event()
+    to_embed = queue.Queue(maxsize=queue_size)
+    errors = []
+    tbl = search_client.create_table(case_name, user_id)
+
+    def embed():
+        try:
+            search_client.ingest_rows(tbl, iter_queue(to_embed, stop), embed_batch_size=embed_batch_size)
+        except _StoppedError:
+            pass
+        except BaseException as exc:
+            errors.append(exc)
+            # stop rendering, encoding and the dataset writer instead of finishing a case that cannot be stored
+            stop.set()
+
+    embed_thread = threading.Thread(target=embed, name="embed", daemon=True)
+    embed_thread.start()
+
+    rendered = start_stage(
+        iter_pdf_rows(
+            pdf_files,
+            page_batch_size,
+            render_workers=render_workers,
+            thread_count=thread_count,
+            extract_text=extract_text,
+        ),
+        queue_size,
+        stop,
+        "render",
+    )
+    encoded = start_stage(encode_rows(iter_queue(rendered, stop)), queue_size, stop, "encode")
+
+    def dataset_rows():
+        for row in iter_queue(encoded, stop):
+            page = {
+                "index": row["index"],
+                "pdf_name": row["pdf_name"],
+                "pdf_page": row["pdf_page"],
+                "image_jpeg": row["image"]["bytes"],
+            }
+            if not _put(to_embed, page, stop):
+                raise _StoppedError()
+            yield row
+
+    try:
+        dataset = Dataset.from_generator(
+            dataset_rows, features=PAGE_FEATURES, cache_dir=cache_dir, writer_batch_size=page_batch_size
+        )
+        dataset.save_to_disk(dataset_path)
+    except BaseException:
+        stop.set()
+        # a failed embedder stopped the writer, its error is the one to report
+        if not errors:
+            raise
+    finally:
+        _put(to_embed, _DONE, stop)
+        stop.set()
+        embed_thread.join()
+
+    if errors:
+        raise errors[0]
+    search_client.build_index(tbl, case_name, user_id)
+
+    end_time = time.time()
+    logger.info(f"done ingest_pdfs, total time {end_time - start_time}")
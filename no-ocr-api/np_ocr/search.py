@@ -1,21 +1,40 @@
+import asyncio
 import base64
+import heapq
 import io
+import itertools
 import json
 import logging
 import time
-from io import BytesIO
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple, Union
 
-import lancedb
+import httpx
 import numpy as np
 import PIL
 import pyarrow as pa
 import requests
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from pydantic import BaseModel
 from tqdm import tqdm
 
+from np_ocr.backends import LanceBackend, VectorBackend
+from np_ocr.cache import LRUCache, QueryEmbeddingCache
+from np_ocr.concurrency import fan_out, ordered_concurrent_map
+from np_ocr.data import encode_jpeg, get_page_jpeg, make_thumbnail_jpeg
+from np_ocr.vectors import (
+    COMPRESSION_METHODS,
+    POOLING_METHODS,
+    SEARCH_BACKENDS,
+    VECTOR_DTYPES,
+    CaseVectors,
+    CaseVectorsWriter,
+    compress_multivectors,
+    compression_report,
+    embeddings_to_arrow,
+    page_multivectors,
+)
+
 logger = logging.getLogger()
 
 class ImageAnswer(BaseModel):
@@ -39,111 +58,523 @@ class CaseInfo(BaseModel):
 
 
 
+def decode_npy_embeddings(content: bytes, lengths_header: str):
+    """Split an ``application/x-npy`` /process_images body into (flat token matrix, tokens per page)."""
+    flat = np.load(io.BytesIO(content), allow_pickle=False)
+    lengths = np.array([int(length) for length in lengths_header.split(",") if length], dtype=np.int64)
+    if lengths.sum() != len(flat):
+        raise ValueError(f"embedding lengths {lengths.sum()} do not match {len(flat)} rows in the response")
+    return flat, lengths
+
+
+def stack_embeddings(embeddings):
+    """Nested-list embeddings from a JSON response as (flat token matrix, tokens per item)."""
+    embeddings = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+    return np.concatenate(embeddings), np.array([len(embedding) for embedding in embeddings], dtype=np.int64)
+
+
+def split_embeddings(flat: np.ndarray, lengths: np.ndarray) -> List[np.ndarray]:
+    return np.split(flat, np.cumsum(lengths)[:-1])
+
+
 class ColPaliClient:
-    def __init__(self, base_url: str, token: str):
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        max_retries: int = 3,
+        timeout: float = 300,
+        pool_size: int = 10,
+        transport: str = "npy",
+        wire_dtype: str = "float32",
+    ):
         self.base_url = base_url
         self.headers = {"Authorization": f"Bearer {token}"}
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # "npy" asks for binary page embeddings, "json" for nested float lists
+        self.transport = transport
+        self.wire_dtype = wire_dtype
+        # keep-alive connections shared by the ingest threads
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        # pooled client for async request handlers, see open_async_client
+        self.async_client: Optional[httpx.AsyncClient] = None
+
+    def open_async_client(self):
+        self.async_client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=self.headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+        )
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+    def _post(self, path: str, **kwargs):
+        return self._post_response(path, **kwargs).json()
+
+    def _post_response(self, path: str, **kwargs):
+        """POST with exponential backoff on connection errors and 5xx responses."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(
+                    f"{self.base_url}{path}", headers=self.headers, timeout=self.timeout, **kwargs
+                )
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} from {path}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = exc
+            if attempt < self.max_retries:
+                logger.warning(f"ColPali call {path} failed ({error}), retry {attempt + 1}/{self.max_retries}")
+                time.sleep(min(2**attempt, 30))
+        raise error
+
+    async def _apost(self, path: str, **kwargs):
+        """Async counterpart of _post on the pooled httpx client."""
+        return (await self._apost_response(path, **kwargs)).json()
+
+    async def _apost_response(self, path: str, **kwargs):
+        if self.async_client is None:
+            self.open_async_client()
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.async_client.post(path, **kwargs)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response
+                error = httpx.HTTPStatusError(
+                    f"{response.status_code} from {path}", request=response.request, response=response
+                )
+            except httpx.TransportError as exc:
+                error = exc
+            if attempt < self.max_retries:
+                logger.warning(f"ColPali call {path} failed ({error}), retry {attempt + 1}/{self.max_retries}")
+                await asyncio.sleep(min(2**attempt, 30))
+        raise error
 
     def query_text(self, query_text: str):
-        response = requests.post(f"{self.base_url}/query", headers=self.headers, params={"query_text": query_text})
-        response.raise_for_status()
-        return response.json()
+        return self._post("/query", params={"query_text": query_text})
+
+    async def aquery_text(self, query_text: str):
+        return await self._apost("/query", params={"query_text": query_text})
+
+    async def aembed_queries(self, query_texts: List[str]):
+        """Embed several queries with one request and one forward pass, as (flat token matrix, tokens per query)."""
+        if self.transport == "json":
+            return stack_embeddings((await self._apost("/queries", json=query_texts))["embeddings"])
+        params = {"format": "npy", "dtype": self.wire_dtype}
+        response = await self._apost_response("/queries", json=query_texts, params=params)
+        return decode_npy_embeddings(response.content, response.headers["X-Embedding-Lengths"])
 
     def process_image(self, image_path: str):
         with open(image_path, "rb") as image_file:
             files = {"image": image_file}
-            response = requests.post(f"{self.base_url}/process_image", files=files, headers=self.headers)
+            response = self.session.post(f"{self.base_url}/process_image", files=files, headers=self.headers)
             response.raise_for_status()
             return response.json()
 
     def process_pil_image(self, pil_image):
-        buffered = io.BytesIO()
-        pil_image.save(buffered, format="JPEG")
-        files = {"image": buffered.getvalue()}
-        response = requests.post(f"{self.base_url}/process_image", files=files, headers=self.headers)
+        files = {"image": encode_jpeg(pil_image)}
+        response = self.session.post(f"{self.base_url}/process_image", files=files, headers=self.headers)
         response.raise_for_status()
         return response.json()
 
+    def process_jpeg_images(self, jpeg_images: List[bytes]):
+        files = [("images", ("page.jpeg", jpeg_image, "image/jpeg")) for jpeg_image in jpeg_images]
+        return self._post("/process_images", files=files)
+
+    def embed_jpeg_images(self, jpeg_images: List[bytes]):
+        """Embed pages and return (flat token matrix, tokens per page) in the configured transport."""
+        if self.transport == "json":
+            return stack_embeddings(self.process_jpeg_images(jpeg_images)["embeddings"])
+
+        files = [("images", ("page.jpeg", jpeg_image, "image/jpeg")) for jpeg_image in jpeg_images]
+        params = {"format": "npy", "dtype": self.wire_dtype}
+        response = self._post_response("/process_images", files=files, params=params)
+        return decode_npy_embeddings(response.content, response.headers["X-Embedding-Lengths"])
+
 class SearchClient:
-    def __init__(self, storage_dir: str, vector_size: int,  base_url: str, token: str):
+    def __init__(
+        self,
+        storage_dir: str,
+        vector_size: int,
+        base_url: str,
+        token: str,
+        table_cache_size: int = 16,
+        max_in_flight: int = 4,
+        max_retries: int = 3,
+        http_pool_size: int = 32,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        transport: str = "npy",
+        vector_dtype: str = "float32",
+        rescore_factor: int = 4,
+        pooling: Optional[str] = None,
+        pooled_clusters: int = 8,
+        prefilter_candidates: int = 64,
+        token_budget: int = 0,
+        token_compression: str = "cluster",
+        search_backend: str = "index",
+        numpy_max_pages: int = 1000,
+        case_vectors_cache_size: int = 4,
+        embedding_store_dirname: str = "embeddings",
+        backend: Optional[VectorBackend] = None,
+    ):
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"vector_dtype must be one of {VECTOR_DTYPES}, got {vector_dtype}")
+        if pooling is not None and pooling not in POOLING_METHODS:
+            raise ValueError(f"pooling must be one of {POOLING_METHODS}, got {pooling}")
+        if token_compression not in COMPRESSION_METHODS:
+            raise ValueError(f"token_compression must be one of {COMPRESSION_METHODS}, got {token_compression}")
+        if search_backend not in SEARCH_BACKENDS:
+            raise ValueError(f"search_backend must be one of {SEARCH_BACKENDS}, got {search_backend}")
         self.storage_dir = storage_dir
         self.vector_size = vector_size
-        self.colpali_client = ColPaliClient(base_url, token)
-
-    def ingest(self, case_name: str, dataset, user_id: str, batch_size: int = 50):
-        """Ingest a dataset of images into LanceDB in batches."""
-        logger.info("start ingest")
+        # float16 on the wire is enough for both reduced precision formats
+        self.colpali_client = ColPaliClient(
+            base_url,
+            token,
+            max_retries=max_retries,
+            pool_size=http_pool_size,
+            transport=transport,
+            wire_dtype="float32" if vector_dtype == "float32" else "float16",
+        )
+        self.vector_dtype = vector_dtype
+        # where case multivectors are stored and searched, LanceDB files next to the case unless given
+        self.backend = backend or LanceBackend(
+            storage_dir, table_cache_size, rescore_factor=rescore_factor, prefilter_candidates=prefilter_candidates
+        )
+        if pooling is None and vector_dtype == "int8" and self.backend.int8_codes:
+            # int8 codes cannot be indexed, pooled page vectors give their searches an indexed candidate stage
+            pooling = "cluster"
+        # two-stage retrieval: a pooled summary per page is searched first, MaxSim then reranks the candidates
+        self.pooling = pooling
+        self.pooled_clusters = pooled_clusters
+        # pages are reduced to at most token_budget vectors before storage, 0 keeps every patch vector
+        self.token_budget = token_budget
+        self.token_compression = token_compression
+        # "index" searches the vector backend, "numpy" scores in process with CaseVectors and "auto" does the
+        # latter for cases with an embedding store and up to numpy_max_pages pages
+        self.search_backend = search_backend
+        self.numpy_max_pages = numpy_max_pages
+        self.case_vectors_cache = LRUCache(case_vectors_cache_size)
+        # page counts that pick the auto backend, so a search does not cost an extra count request
+        self.page_counts = LRUCache(table_cache_size)
+        self.embedding_store_dirname = embedding_store_dirname
+        self.max_in_flight = max_in_flight
+        self.query_cache = query_cache
+
+    def invalidate(self, user_id: str, case_name: str):
+        self.backend.invalidate(case_name, user_id)
+        self.case_vectors_cache.invalidate((user_id, case_name))
+        self.page_counts.invalidate((user_id, case_name))
+
+    def delete_case(self, case_name: str, user_id: str):
+        """Drop the case's vectors from the backend and every cached handle on them."""
+        self.invalidate(user_id, case_name)
+        self.backend.delete(case_name, user_id)
+
+    def case_vectors_path(self, case_name: str, user_id: str) -> Path:
+        return Path(self.storage_dir) / user_id / case_name / self.embedding_store_dirname
+
+    def write_case_vectors(self, case_name: str, user_id: str, batch_size: int = 256):
+        """Export a case's page vectors from the vector backend into the memory-mapped embedding store."""
+        logger.info("start write_case_vectors")
         start_time = time.time()
 
-        schema = pa.schema(
-            [
-                pa.field("index", pa.int64()),
-                pa.field("pdf_name", pa.string()),
-                pa.field("pdf_page", pa.int64()),
-                pa.field("vector", pa.list_(pa.list_(pa.float32(), self.vector_size))),
-            ]
-        )
-        lance_client = lancedb.connect(f"{self.storage_dir}/{user_id}/{case_name}")
-        tbl = lance_client.create_table(case_name, schema=schema)
+        writer = CaseVectorsWriter(self.case_vectors_path(case_name, user_id), self.vector_size)
+        for pages in self.backend.iter_pages(case_name, user_id, batch_size):
+            writer.append(pages)
+        writer.close()
+        self.case_vectors_cache.invalidate((user_id, case_name))
 
-        with tqdm(total=len(dataset), desc="Indexing Progress") as pbar:
+        end_time = time.time()
+        logger.info(f"done write_case_vectors, total time {end_time - start_time}")
+
+    def stored_case_vectors(self, case_name: str, user_id: str) -> Optional[CaseVectors]:
+        """The case's memory-mapped embedding store, or None when it was not written."""
+        if not self.case_vectors_path(case_name, user_id).exists():
+            return None
+        return self.load_case_vectors(case_name, user_id)
+
+    def load_case_vectors(self, case_name: str, user_id: str) -> CaseVectors:
+        """All page vectors of a case for the numpy backend, cached.
+
+        The on-disk embedding store is memory-mapped when present, otherwise the vectors are read from the backend.
+        """
+
+        def load():
+            path = self.case_vectors_path(case_name, user_id)
+            if path.exists():
+                return CaseVectors.open(path)
+            logger.info("start load_case_vectors")
+            start_time = time.time()
+            pages = pa.concat_tables(self.backend.iter_pages(case_name, user_id))
+            case_vectors = CaseVectors.from_arrow(pages)
+            end_time = time.time()
+            logger.info(f"done load_case_vectors, total time {end_time - start_time}")
+            return case_vectors
+
+        return self.case_vectors_cache.get_or_load((user_id, case_name), load)
+
+    def use_numpy_backend(self, case_name: str, user_id: str) -> bool:
+        if self.search_backend != "auto":
+            return self.search_backend == "numpy"
+        if not self.case_vectors_path(case_name, user_id).exists():
+            # without the memory-mapped store the case would be read into the heap, int8 cases never write one
+            return False
+        count = self.page_counts.get_or_load(
+            (user_id, case_name), lambda: self.backend.count(case_name, user_id)
+        )
+        return count <= self.numpy_max_pages
+
+    def table_schema(self) -> pa.Schema:
+        """Case table schema for ``vector_dtype``.
+
+        float32 and float16 store the multivector as ``vector``. int8 stores ``vector_codes`` with one scale per
+        token vector in ``vector_scales``, about a quarter of the float32 size, unless the backend quantizes by
+        itself. With ``pooling`` set, the pooled page summary for two-stage search goes to ``pooled_vector``;
+        int8 codes always get one.
+        """
+        fields = [
+            pa.field("index", pa.int64()),
+            pa.field("pdf_name", pa.string()),
+            pa.field("pdf_page", pa.int64()),
+        ]
+        if self.vector_dtype == "int8" and self.backend.int8_codes:
+            fields += [
+                pa.field("vector_codes", pa.list_(pa.list_(pa.int8(), self.vector_size))),
+                pa.field("vector_scales", pa.list_(pa.float32())),
+            ]
+        else:
+            value_type = pa.float16() if self.vector_dtype == "float16" else pa.float32()
+            fields.append(pa.field("vector", pa.list_(pa.list_(value_type, self.vector_size))))
+        if self.pooling is not None:
+            fields.append(pa.field("pooled_vector", pa.list_(pa.list_(pa.float32(), self.vector_size))))
+        return pa.schema(fields)
+
+    def create_table(self, case_name: str, user_id: str):
+        return self.backend.create(case_name, user_id, self.table_schema())
+
+    def build_index(self, tbl, case_name: str, user_id: str):
+        self.backend.build_index(tbl, case_name, user_id)
+
+    def _embed_rows(self, rows):
+        jpeg_images = [row["image_jpeg"] if "image_jpeg" in row else get_page_jpeg(row) for row in rows]
+        flat, lengths = self.colpali_client.embed_jpeg_images(jpeg_images)
+        if self.token_budget > 0:
+            flat, lengths = compress_multivectors(flat, lengths, self.token_compression, self.token_budget)
+        return embeddings_to_arrow(rows, flat, lengths, self.table_schema(), self.pooling, self.pooled_clusters)
+
+    def ingest_rows(self, tbl, rows, total=None, batch_size: int = 50, embed_batch_size: int = 8):
+        """Embed an iterable of page rows and append them to ``tbl``.
+
+        Each row carries ``index``, ``pdf_name``, ``pdf_page`` and either a PIL ``image`` or the page already
+        encoded as ``image_jpeg`` bytes. ``rows`` is consumed lazily, so it can be fed by another pipeline stage.
+        """
+        chunks = iter(lambda: list(itertools.islice(rows, embed_batch_size)), [])
+
+        with tqdm(total=total, desc="Indexing Progress") as pbar:
             batch = []
-            for i in range(len(dataset)):
-                image = dataset[i]["image"]
-                response = self.colpali_client.process_pil_image(image)
-                image_embedding = response["embedding"]
-
-                batch.append(
-                    {
-                        "index": dataset[i]["index"],
-                        "pdf_name": dataset[i]["pdf_name"],
-                        "pdf_page": dataset[i]["pdf_page"],
-                        "vector": image_embedding,
-                    }
-                )
+            batch_rows = 0
+            # results come back in page order, so rows are appended to the backend sorted by index
+            for chunk_table in ordered_concurrent_map(self._embed_rows, chunks, self.max_in_flight):
+                batch.append(chunk_table)
+                batch_rows += chunk_table.num_rows
 
-                if len(batch) >= batch_size:
+                if batch_rows >= batch_size:
                     try:
-                        tbl.add(batch)
+                        self.backend.add_batch(tbl, pa.concat_tables(batch))
                     except Exception as e:
                         logger.error(f"Error during upsert: {e}")
                     batch = []
-                pbar.update(1)
+                    batch_rows = 0
+                pbar.update(chunk_table.num_rows)
 
             if batch:
                 try:
-                    tbl.add(batch)
+                    self.backend.add_batch(tbl, pa.concat_tables(batch))
                 except Exception as e:
                     logger.error(f"Error during upsert: {e}")
 
-        tbl.create_index(metric="cosine")
+    def compression_report(self, case_name: str, user_id: str, queries: List[str], budgets: List[int], top_k: int = 10):
+        """Recall-vs-size of ``token_compression`` at each budget, measured on a case's stored pages.
+
+        The baseline is the stored vectors, which are the full multivectors only when ``token_budget`` is 0.
+        """
+        logger.info("start compression_report")
+        start_time = time.time()
+
+        flat, lengths = page_multivectors(pa.concat_tables(self.backend.iter_pages(case_name, user_id)))
+        query_embeddings = [np.array(self.query_embedding(query)["embedding"]) for query in queries]
+        report = compression_report(flat, lengths, query_embeddings, budgets, self.token_compression, top_k)
 
-        logger.info("Indexing complete!")
         end_time = time.time()
-        logger.info(f"done ingest, total time {end_time - start_time}")
+        logger.info(f"done compression_report, total time {end_time - start_time}")
+        return report
+
+    def query_embedding(self, query_text: str):
+        """ColPali embedding of a query, served from ``query_cache`` when it was asked before."""
+        if self.query_cache is not None:
+            query_embedding = self.query_cache.get(query_text)
+            if query_embedding is not None:
+                return query_embedding
+        query_embedding = self.colpali_client.query_text(query_text)
+        if self.query_cache is not None:
+            self.query_cache.put(query_text, query_embedding)
+        return query_embedding
+
+    async def aquery_embedding(self, query_text: str):
+        if self.query_cache is not None:
+            query_embedding = await asyncio.to_thread(self.query_cache.get, query_text)
+            if query_embedding is not None:
+                return query_embedding
+        query_embedding = await self.colpali_client.aquery_text(query_text)
+        if self.query_cache is not None:
+            await asyncio.to_thread(self.query_cache.put, query_text, query_embedding)
+        return query_embedding
+
+    def _cached_query_embeddings(self, query_texts: List[str]):
+        """Cached query multivectors by position, and the distinct queries that still need embedding."""
+        embeddings = [None] * len(query_texts)
+        if self.query_cache is not None:
+            for i, query_text in enumerate(query_texts):
+                cached = self.query_cache.get(query_text)
+                if cached is not None:
+                    embeddings[i] = np.asarray(cached["embedding"], dtype=np.float32)
+        missing = list(dict.fromkeys(text for text, embedding in zip(query_texts, embeddings) if embedding is None))
+        return embeddings, missing
+
+    def _fill_query_embeddings(self, query_texts: List[str], embeddings, embedded):
+        for query_text, embedding in embedded.items():
+            if self.query_cache is not None:
+                self.query_cache.put(query_text, {"embedding": embedding.tolist()})
+        return [embedded[text] if embedding is None else embedding for text, embedding in zip(query_texts, embeddings)]
+
+    async def aquery_embeddings(self, query_texts: List[str]) -> List[np.ndarray]:
+        """Multivectors of several queries; those not in ``query_cache`` are embedded in one ColPali call."""
+        embeddings, missing = await asyncio.to_thread(self._cached_query_embeddings, query_texts)
+        embedded = {}
+        if missing:
+            embedded = dict(zip(missing, split_embeddings(*await self.colpali_client.aembed_queries(missing))))
+        return await asyncio.to_thread(self._fill_query_embeddings, query_texts, embeddings, embedded)
+
+    def _search_table(self, query_embedding, case_name: str, user_id: str, top_k: int):
+        multivector_query = np.array(query_embedding["embedding"])
+        if self.use_numpy_backend(case_name, user_id):
+            return self.load_case_vectors(case_name, user_id).search(multivector_query, top_k)
+        store = self.stored_case_vectors(case_name, user_id)
+        return self.backend.search(multivector_query, case_name, user_id, top_k, store=store)
 
     def search_images_by_text(self, query_text, case_name: str, user_id: str,top_k: int):
         logger.info("start search_images_by_text")
         start_time = time.time()
 
-        lance_client = lancedb.connect(f"{self.storage_dir}/{user_id}/{case_name}")
-        tbl = lance_client.open_table(case_name)
-
-        query_embedding = self.colpali_client.query_text(query_text)
-        multivector_query = np.array(query_embedding["embedding"])
-        search_result = tbl.search(multivector_query).limit(top_k).select(["index", "pdf_name", "pdf_page"]).to_list()
+        query_embedding = self.query_embedding(query_text)
+        search_result = self._search_table(query_embedding, case_name, user_id, top_k)
 
         end_time = time.time()
         logger.info(f"done search_images_by_text, total time {end_time - start_time}")
 
         return search_result
 
+    def _search_table_many(self, multivector_queries: List[np.ndarray], case_name: str, user_id: str, top_k: int):
+        if self.use_numpy_backend(case_name, user_id):
+            return self.load_case_vectors(case_name, user_id).search_many(multivector_queries, top_k)
+        # too large to score every query exactly in process, the backend searches them on its cached handle
+        store = self.stored_case_vectors(case_name, user_id)
+        return [
+            self.backend.search(query, case_name, user_id, top_k, store=store) for query in multivector_queries
+        ]
+
+    async def asearch_many(self, query_texts: List[str], case_name: str, user_id: str, top_k: int):
+        """Per-query top-k for several queries against one case, embedded in one batch and scored together."""
+        logger.info("start asearch_many")
+        start_time = time.time()
 
-def call_vllm(image_data: PIL.Image.Image, user_query: str, base_url: str, api_key: str, model: str) -> ImageAnswer:
-    logger.info("start call_vllm")
-    start_time = time.time()
+        multivector_queries = await self.aquery_embeddings(query_texts)
+        search_results = await asyncio.to_thread(
+            self._search_table_many, multivector_queries, case_name, user_id, top_k
+        )
+
+        end_time = time.time()
+        logger.info(f"done asearch_many for {len(query_texts)} queries, total time {end_time - start_time}")
+
+        return search_results
+
+    def _search_cases(
+        self, query_embedding, cases: List[Tuple[str, str]], top_k: int, max_workers: int, timeout: Optional[float]
+    ):
+        def search_case(case):
+            user_id, case_name = case
+            return self._search_table(query_embedding, case_name, user_id, top_k)
+
+        results, incomplete = fan_out(search_case, cases, max_workers, timeout)
+        # distances of one query are comparable across cases, so the best pages overall are a global top-k
+        hits = [
+            {**hit, "user_id": user_id, "case_name": case_name}
+            for (user_id, case_name), case_hits in results.items()
+            for hit in case_hits
+        ]
+        return heapq.nsmallest(top_k, hits, key=lambda hit: hit["_distance"]), incomplete
+
+    async def asearch_cases(
+        self,
+        query_text: str,
+        cases: List[Tuple[str, str]],
+        top_k: int,
+        max_workers: int = 8,
+        timeout: Optional[float] = None,
+    ):
+        """Search several (user_id, case_name) cases with one query embedding and merge them into one top-k.
+
+        Cases are searched on at most ``max_workers`` threads. Returns ``(hits, incomplete)``; each hit carries
+        its ``user_id`` and ``case_name``, and ``incomplete`` lists the cases that failed or missed the
+        ``timeout`` deadline, which are left out of the hits.
+        """
+        logger.info("start asearch_cases")
+        start_time = time.time()
+
+        query_embedding = await self.aquery_embedding(query_text)
+        search_result = await asyncio.to_thread(
+            self._search_cases, query_embedding, cases, top_k, max_workers, timeout
+        )
+
+        end_time = time.time()
+        logger.info(f"done asearch_cases over {len(cases)} cases, total time {end_time - start_time}")
+
+        return search_result
+
+    async def asearch_images_by_text(self, query_text, case_name: str, user_id: str, top_k: int):
+        """Async search: the query embedding uses the pooled client, the LanceDB scan runs in a worker thread."""
+        logger.info("start asearch_images_by_text")
+        start_time = time.time()
 
+        query_embedding = await self.aquery_embedding(query_text)
+        search_result = await asyncio.to_thread(self._search_table, query_embedding, case_name, user_id, top_k)
 
+        end_time = time.time()
+        logger.info(f"done asearch_images_by_text, total time {end_time - start_time}")
+
+        return search_result
+
+
+# part of the answer cache key, bump it whenever the prompt below changes
+PROMPT_VERSION = "1"
+
+
+def build_vllm_messages(image_data: Union[PIL.Image.Image, bytes], user_query: str):
+    """Chat messages asking whether the page answers ``user_query``.
+
+    ``image_data`` is either a PIL page (thumbnailed and encoded here) or an already encoded JPEG thumbnail.
+    """
     prompt = f"""
     Based on the user's query:
     ###
@@ -161,27 +592,36 @@ def call_vllm(image_data: PIL.Image.Image, user_query: str, base_url: str, api_k
     """
 
     logger.info(prompt)
-    buffered = BytesIO()
-    max_size = (512, 512)
-    image_data.thumbnail(max_size)
-    image_data.save(buffered, format="JPEG")
-    img_b64_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    if isinstance(image_data, bytes):
+        thumbnail_jpeg = image_data
+    else:
+        thumbnail_jpeg = make_thumbnail_jpeg(image_data)
+    img_b64_str = base64.b64encode(thumbnail_jpeg).decode("utf-8")
+
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/jpeg;base64,{img_b64_str}"},
+                },
+            ],
+        }
+    ]
+
+
+def call_vllm(
+    image_data: Union[PIL.Image.Image, bytes], user_query: str, base_url: str, api_key: str, model: str
+) -> ImageAnswer:
+    logger.info("start call_vllm")
+    start_time = time.time()
 
     client = OpenAI(base_url=base_url, api_key=api_key)
     completion = client.beta.chat.completions.parse(
         model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_b64_str}"},
-                    },
-                ],
-            }
-        ],
+        messages=build_vllm_messages(image_data, user_query),
         response_format=ImageAnswer,
         extra_body=dict(guided_decoding_backend="outlines"),
     )
@@ -192,3 +632,133 @@ def call_vllm(image_data: PIL.Image.Image, user_query: str, base_url: str, api_k
     logger.info(f"done call_vllm, total time {end_time - start_time}")
 
     return result
+
+
+async def acall_vllm(
+    client: AsyncOpenAI, image_data: Union[PIL.Image.Image, bytes], user_query: str, model: str
+) -> ImageAnswer:
+    """Async call_vllm on a shared, connection-pooled AsyncOpenAI client."""
+    logger.info("start acall_vllm")
+    start_time = time.time()
+
+    completion = await client.beta.chat.completions.parse(
+        model=model,
+        messages=build_vllm_messages(image_data, user_query),
+        response_format=ImageAnswer,
+        extra_body=dict(guided_decoding_backend="outlines"),
+    )
+    result = completion.choices[0].message.parsed
+
+    end_time = time.time()
+    logger.info(f"done acall_vllm, total time {end_time - start_time}")
+
+    return result
+
+
+async def astream_vllm(
+    client: AsyncOpenAI, image_data: Union[PIL.Image.Image, bytes], user_query: str, model: str
+):
+    """Streaming acall_vllm: yield the answer JSON text deltas as vLLM generates them, then the ImageAnswer.
+
+    The same schema constrains generation as in acall_vllm; the complete text is validated into an
+    ImageAnswer only once the stream ends, which raises ``pydantic.ValidationError`` if it does not parse.
+    """
+    logger.info("start astream_vllm")
+    start_time = time.time()
+
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=build_vllm_messages(image_data, user_query),
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "ImageAnswer", "schema": ImageAnswer.model_json_schema(), "strict": True},
+        },
+        extra_body=dict(guided_decoding_backend="outlines"),
+        stream=True,
+    )
+    parts = []
+    async with stream:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+    result = ImageAnswer.model_validate_json("".join(parts))
+
+    end_time = time.time()
+    logger.info(f"done astream_vllm, total time {end_time - start_time}")
+
+    yield result
+
+
+def answer_confidence(logprobs) -> Optional[float]:
+    """Geometric mean probability of the generated tokens, from chat completion ``logprobs``.
+
+    Tokens forced by guided decoding (the JSON scaffolding) have probability close to 1, so this mostly
+    reflects how sure the model was about the answer text. None when the server returned no logprobs.
+    """
+    if logprobs is None or not logprobs.content:
+        return None
+    return float(np.exp(np.mean([token.logprob for token in logprobs.content])))
+
+
+def is_confident_answer(answer: str, confidence: Optional[float], min_confidence: Optional[float]) -> bool:
+    """Whether an answer is a real (non-NA) one with at least ``min_confidence``; never when that is None."""
+    if min_confidence is None or answer.strip().upper() == "NA":
+        return False
+    return (confidence or 0.0) >= min_confidence
+
+
+async def acall_vllm_with_confidence(
+    client: AsyncOpenAI, image_data: Union[PIL.Image.Image, bytes], user_query: str, model: str
+) -> Tuple[ImageAnswer, Optional[float]]:
+    """acall_vllm that also asks for token logprobs and returns the answer with its ``answer_confidence``."""
+    completion = await client.beta.chat.completions.parse(
+        model=model,
+        messages=build_vllm_messages(image_data, user_query),
+        response_format=ImageAnswer,
+        extra_body=dict(guided_decoding_backend="outlines"),
+        logprobs=True,
+    )
+    choice = completion.choices[0]
+    return choice.message.parsed, answer_confidence(choice.logprobs)
+
+
+async def aanswer_pages(
+    client: AsyncOpenAI, pages, user_query: str, model: str, min_confidence: Optional[float] = None
+):
+    """Ask vLLM about every ``(key, image_data)`` page concurrently and yield ``(key, result)`` as calls finish.
+
+    ``result`` is ``(ImageAnswer, confidence)``, or the exception the call raised. With ``min_confidence``,
+    the first non-NA answer at least that confident ends the run and the calls still in flight are cancelled;
+    their keys are yielded last with ``asyncio.CancelledError`` as the result.
+    """
+    tasks = {
+        asyncio.create_task(acall_vllm_with_confidence(client, image_data, user_query, model)): key
+        for key, image_data in pages
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            stop = False
+            for task in done:
+                if task.exception() is not None:
+                    logger.error(f"Error during vLLM call for {tasks[task]}: {task.exception()}")
+                    yield tasks[task], task.exception()
+                    continue
+                answer, confidence = task.result()
+                yield tasks[task], (answer, confidence)
+                if is_confident_answer(answer.answer, confidence, min_confidence):
+                    stop = True
+            if stop and pending:
+                logger.info(f"confident answer found, cancelling {len(pending)} vLLM calls")
+                for task in pending:
+                    task.cancel()
+                for task in pending:
+                    yield tasks[task], asyncio.CancelledError()
+                pending = set()
+    finally:
+        # the consumer may stop early too, e.g. when the client disconnects
+        for task in pending:
+            task.cancel()
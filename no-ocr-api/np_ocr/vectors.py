@@ -0,0 +1,391 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pyarrow as pa
+
+SEARCH_BACKENDS = ("index", "numpy", "auto")
+VECTOR_DTYPES = ("float32", "float16", "int8")
+POOLING_METHODS = ("mean", "cluster")
+COMPRESSION_METHODS = ("cluster", "norm")
+
+
+def quantize_int8(vectors: np.ndarray):
+    """Symmetric scalar quantization: int8 codes plus one float32 scale per vector (``vector ~= codes * scale``)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def maxsim_distances(query: np.ndarray, flat: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Exact late-interaction distance of ``query`` to every page, in float32.
+
+    ``flat`` holds the token vectors of all pages back to back, ``lengths`` the number of tokens per page.
+    Uses LanceDB's cosine multivector convention, ``n_query_tokens - sum(max cosine similarity)``, so scores are
+    comparable with ``_distance`` from ``tbl.search``.
+    """
+    query = normalize(query)
+    return segment_maxsim_distances(normalize(flat) @ query.T, lengths, len(query))
+
+
+def segment_maxsim_distances(similarities: np.ndarray, lengths: np.ndarray, n_query_tokens: int) -> np.ndarray:
+    """Turn a (tokens, query tokens) similarity matrix into one distance per page with a segmented max."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    distances = np.full(len(lengths), float(n_query_tokens), dtype=np.float32)
+    non_empty = lengths > 0
+    if not non_empty.any():
+        return distances
+    starts = (np.cumsum(lengths) - lengths)[non_empty]
+    distances[non_empty] -= np.maximum.reduceat(similarities, starts, axis=0).sum(axis=1)
+    return distances
+
+
+def cluster_pool(vectors: np.ndarray, n_clusters: int, iterations: int = 10) -> np.ndarray:
+    """Spherical k-means centroids of one page's token vectors, at most ``n_clusters`` of them."""
+    vectors = normalize(vectors)
+    if len(vectors) <= n_clusters:
+        return vectors
+    # deterministic init from tokens spread over the page, so re-ingesting gives the same centroids
+    centroids = vectors[np.linspace(0, len(vectors) - 1, n_clusters).astype(np.int64)]
+    for _ in range(iterations):
+        assignment = (vectors @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        centroids[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
+    return normalize(centroids)
+
+
+def pool_multivectors(flat: np.ndarray, lengths: np.ndarray, method: str, n_clusters: int = 8):
+    """Summarize each page's token vectors for the prefilter stage.
+
+    ``mean`` keeps one normalized mean vector per page, ``cluster`` up to ``n_clusters`` k-means centroids.
+    Returns (pooled token matrix, pooled vectors per page) in the same layout as the input.
+    """
+    if method not in POOLING_METHODS:
+        raise ValueError(f"pooling must be one of {POOLING_METHODS}, got {method}")
+    pooled = []
+    start = 0
+    for length in lengths:
+        page = flat[start : start + length]
+        start += length
+        if method == "mean":
+            pooled.append(normalize(normalize(page).mean(axis=0, keepdims=True)))
+        else:
+            pooled.append(cluster_pool(page, n_clusters))
+    pooled_lengths = np.array([len(page) for page in pooled], dtype=np.int64)
+    dim = flat.shape[1]
+    return np.concatenate(pooled) if pooled else np.zeros((0, dim), dtype=np.float32), pooled_lengths
+
+
+def prune_by_residual_norm(vectors: np.ndarray, budget: int) -> np.ndarray:
+    """Keep the ``budget`` token vectors that stand out most from the page average.
+
+    ColQwen2 vectors are unit length, so the norm used is that of each normalized vector minus the page mean;
+    near-duplicate background patches sit close to the mean and are dropped first.
+    """
+    vectors = normalize(vectors)
+    if len(vectors) <= budget:
+        return vectors
+    residual_norms = np.linalg.norm(vectors - vectors.mean(axis=0), axis=1)
+    keep = np.sort(np.argsort(-residual_norms, kind="stable")[:budget])
+    return vectors[keep]
+
+
+def compress_multivectors(flat: np.ndarray, lengths: np.ndarray, method: str, budget: int):
+    """Reduce every page to at most ``budget`` token vectors with ``cluster`` pooling or ``norm`` pruning."""
+    if method not in COMPRESSION_METHODS:
+        raise ValueError(f"compression must be one of {COMPRESSION_METHODS}, got {method}")
+    compressed = []
+    start = 0
+    for length in lengths:
+        page = flat[start : start + length]
+        start += length
+        if method == "cluster":
+            compressed.append(cluster_pool(page, budget))
+        else:
+            compressed.append(prune_by_residual_norm(page, budget))
+    compressed_lengths = np.array([len(page) for page in compressed], dtype=np.int64)
+    dim = flat.shape[1]
+    return np.concatenate(compressed) if compressed else np.zeros((0, dim), dtype=np.float32), compressed_lengths
+
+
+def compression_report(flat: np.ndarray, lengths: np.ndarray, queries, budgets, method: str, top_k: int = 10):
+    """Recall@top_k and size of the compressed pages for each token budget, relative to ``flat`` itself.
+
+    ``queries`` are query multivectors; recall is the share of each query's exact top_k pages that the
+    compressed pages still rank in their top_k, averaged over queries.
+    """
+    exact_top = [set(np.argsort(maxsim_distances(query, flat, lengths), kind="stable")[:top_k]) for query in queries]
+    report = []
+    for budget in budgets:
+        compressed, compressed_lengths = compress_multivectors(flat, lengths, method, budget)
+        recalls = []
+        for query, expected in zip(queries, exact_top):
+            found = np.argsort(maxsim_distances(query, compressed, compressed_lengths), kind="stable")[:top_k]
+            recalls.append(len(expected.intersection(found)) / len(expected))
+        report.append(
+            {
+                "method": method,
+                "token_budget": budget,
+                "tokens_per_page": float(compressed_lengths.mean()) if len(lengths) else 0.0,
+                "size_ratio": float(compressed_lengths.sum() / max(lengths.sum(), 1)),
+                "recall_at_k": float(np.mean(recalls)) if recalls else 0.0,
+            }
+        )
+    return report
+
+
+def multivector_to_numpy(column, dtype=np.float32):
+    """Flatten a ``list<fixed_size_list<...>>`` Arrow column into (token matrix, tokens per row)."""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    dim = column.type.value_type.list_size
+    lengths = np.diff(column.offsets.to_numpy())
+    values = column.flatten().flatten().to_numpy(zero_copy_only=False)
+    return values.reshape(-1, dim).astype(dtype, copy=False), lengths
+
+
+def page_multivectors(table: pa.Table):
+    """Full-precision (token matrix, tokens per page) of a case table slice in any of VECTOR_DTYPES."""
+    if "vector_codes" in table.schema.names:
+        codes, lengths = multivector_to_numpy(table.column("vector_codes"), dtype=np.int8)
+        scales = table.column("vector_scales").combine_chunks().flatten().to_numpy()
+        return dequantize_int8(codes, scales), lengths
+    return multivector_to_numpy(table.column("vector"))
+
+
+def storage_dtype(schema: pa.Schema) -> str:
+    """Which of VECTOR_DTYPES a case table was written with."""
+    if "vector_codes" in schema.names:
+        return "int8"
+    value_type = schema.field("vector").type.value_type.value_type
+    return "float16" if value_type == pa.float16() else "float32"
+
+
+def multivector_offsets(lengths: np.ndarray) -> pa.Array:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    return pa.array(offsets)
+
+
+def multivector_array(flat: np.ndarray, lengths: np.ndarray, dim: int) -> pa.ListArray:
+    """Wrap a contiguous token matrix as a ``list<fixed_size_list>`` Arrow array without copying it."""
+    values = pa.FixedSizeListArray.from_arrays(pa.array(flat.reshape(-1)), dim)
+    return pa.ListArray.from_arrays(multivector_offsets(lengths), values)
+
+
+def embeddings_to_arrow(
+    rows, flat: np.ndarray, lengths: np.ndarray, schema: pa.Schema, pooling: Optional[str] = None, n_clusters: int = 8
+) -> pa.Table:
+    """Page rows plus their multivectors as an Arrow table matching ``schema``.
+
+    Float vector columns wrap ``flat`` without copying once it has the storage dtype; int8 tables get quantized
+    codes and per-vector scales instead. Schemas with ``pooled_vector`` also get the ``pooling`` summary of
+    every page.
+    """
+    columns = {
+        "index": [row["index"] for row in rows],
+        "pdf_name": [row["pdf_name"] for row in rows],
+        "pdf_page": [row["pdf_page"] for row in rows],
+    }
+    if "vector_codes" in schema.names:
+        codes, scales = quantize_int8(flat)
+        columns["vector_codes"] = multivector_array(codes, lengths, codes.shape[1])
+        columns["vector_scales"] = pa.ListArray.from_arrays(multivector_offsets(lengths), pa.array(scales))
+    else:
+        value_type = schema.field("vector").type.value_type
+        stored = np.ascontiguousarray(flat, dtype=value_type.value_type.to_pandas_dtype())
+        columns["vector"] = multivector_array(stored, lengths, value_type.list_size)
+    if "pooled_vector" in schema.names:
+        pooled, pooled_lengths = pool_multivectors(flat, lengths, pooling, n_clusters)
+        columns["pooled_vector"] = multivector_array(pooled, pooled_lengths, pooled.shape[1])
+    return pa.table(columns, schema=schema)
+
+
+def rank_by_distance(table: pa.Table, distances: np.ndarray, top_k: int):
+    """The ``top_k`` closest rows of ``table`` as search results, with ``_distance`` set to ``distances``."""
+    order = np.argsort(distances, kind="stable")[:top_k]
+    results = table.select(["index", "pdf_name", "pdf_page"]).take(pa.array(order)).to_pylist()
+    for result, position in zip(results, order):
+        result["_distance"] = float(distances[position])
+    return results
+
+
+class CaseVectors:
+    """Every token vector of a case as one contiguous, normalized float16 matrix plus a page offset index.
+
+    Scoring a query is one matmul per block of ``block_tokens`` token vectors and a segmented max, with no
+    database round trip, which is the fast path for small and medium cases.
+    """
+
+    def __init__(self, vectors: np.ndarray, offsets: np.ndarray, index, pdf_name, pdf_page):
+        self.vectors = vectors
+        self.offsets = offsets
+        self.index = np.asarray(index, dtype=np.int64)
+        self.pdf_name = np.asarray(pdf_name, dtype=object)
+        self.pdf_page = np.asarray(pdf_page, dtype=np.int64)
+
+    @classmethod
+    def from_arrow(cls, table: pa.Table) -> "CaseVectors":
+        """Build from a case table slice with index, pdf_name, pdf_page and the stored multivector columns."""
+        flat, lengths = page_multivectors(table)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(
+            normalize(flat).astype(np.float16),
+            offsets,
+            table.column("index").to_numpy(),
+            table.column("pdf_name").to_pylist(),
+            table.column("pdf_page").to_numpy(),
+        )
+
+    @classmethod
+    def open(cls, path) -> "CaseVectors":
+        """Open a store written by CaseVectorsWriter; the token matrix is memory-mapped, not read into the heap."""
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text())
+        shape = (meta["n_tokens"], meta["dim"])
+        if meta["n_tokens"]:
+            vectors = np.memmap(path / "vectors.f16", dtype=np.float16, mode="r", shape=shape)
+        else:
+            vectors = np.zeros(shape, dtype=np.float16)
+        return cls(
+            vectors,
+            np.load(path / "offsets.npy"),
+            np.load(path / "index.npy"),
+            json.loads((path / "pdf_name.json").read_text()),
+            np.load(path / "pdf_page.npy"),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def positions_of(self, indexes) -> np.ndarray:
+        """Store positions of pages given their dataset ``index`` values."""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        order = np.argsort(self.index, kind="stable")
+        found = np.searchsorted(self.index, indexes, sorter=order)
+        if (found >= len(self)).any() or not np.array_equal(self.index[order[found]], indexes):
+            raise KeyError("pages missing from the embedding store")
+        return order[found]
+
+    def distances_for(self, query: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """MaxSim distances of just the pages at ``positions``; only their rows of the matrix are read."""
+        query = normalize(query)
+        starts, ends = self.offsets[positions], self.offsets[np.asarray(positions) + 1]
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.zeros(0, np.int64)])
+        block = self.vectors[rows].astype(np.float32)
+        return segment_maxsim_distances(block @ query.T, ends - starts, len(query))
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.offsets.nbytes
+
+    def distances(self, query: np.ndarray, block_tokens: int = 1 << 16) -> np.ndarray:
+        return self.distances_many([query], block_tokens)[0]
+
+    def distances_many(self, queries: List[np.ndarray], block_tokens: Optional[int] = None) -> np.ndarray:
+        """(queries, pages) MaxSim distances, with all queries stacked into one matmul per block.
+
+        By default blocks are sized so the block's similarity matrix stays around 8 MB however many query
+        tokens there are.
+        """
+        queries = [normalize(query) for query in queries]
+        query_lengths = np.array([len(query) for query in queries], dtype=np.int64)
+        query_starts = np.cumsum(query_lengths) - query_lengths
+        stacked = np.concatenate(queries)
+        if block_tokens is None:
+            block_tokens = max(1, (1 << 21) // len(stacked))
+        distances = np.empty((len(queries), len(self)), dtype=np.float32)
+        page = 0
+        while page < len(self):
+            # whole pages per block, so the segmented max never straddles two blocks
+            end = int(np.searchsorted(self.offsets, self.offsets[page] + block_tokens, side="right")) - 1
+            end = min(max(end, page + 1), len(self))
+            block = self.vectors[self.offsets[page] : self.offsets[end]].astype(np.float32)
+            lengths = np.diff(self.offsets[page : end + 1])
+            # best matching page token per query token, pages without tokens match nothing
+            page_max = np.zeros((end - page, len(stacked)), dtype=np.float32)
+            non_empty = lengths > 0
+            if non_empty.any():
+                starts = (np.cumsum(lengths) - lengths)[non_empty]
+                page_max[non_empty] = np.maximum.reduceat(block @ stacked.T, starts, axis=0)
+            distances[:, page:end] = query_lengths[:, None] - np.add.reduceat(page_max, query_starts, axis=1).T
+            page = end
+        return distances
+
+    def _results(self, distances: np.ndarray, top_k: int):
+        order = np.argsort(distances, kind="stable")[:top_k]
+        return [
+            {
+                "index": int(self.index[position]),
+                "pdf_name": self.pdf_name[position],
+                "pdf_page": int(self.pdf_page[position]),
+                "_distance": float(distances[position]),
+            }
+            for position in order
+        ]
+
+    def search(self, query: np.ndarray, top_k: int):
+        return self._results(self.distances(query), top_k)
+
+    def search_many(self, queries: List[np.ndarray], top_k: int):
+        """Top ``top_k`` pages for each query, scored together in one pass over the case."""
+        return [self._results(distances, top_k) for distances in self.distances_many(queries)]
+
+
+class CaseVectorsWriter:
+    """Write a case's page vectors in the on-disk layout that CaseVectors.open memory-maps.
+
+    ``vectors.f16`` holds the normalized token vectors back to back, ``offsets.npy`` the page boundaries and
+    ``index.npy``, ``pdf_name.json`` and ``pdf_page.npy`` the page metadata. Pages are appended in slices, so a
+    case never has to fit in memory, and the store only replaces ``path`` on ``close``.
+    """
+
+    def __init__(self, path, dim: int):
+        self.path = Path(path)
+        self.dim = dim
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path.mkdir(parents=True)
+        self._vectors = open(self.tmp_path / "vectors.f16", "wb")
+        self.offsets = [0]
+        self.index = []
+        self.pdf_name = []
+        self.pdf_page = []
+
+    def append(self, table: pa.Table):
+        flat, lengths = page_multivectors(table)
+        self._vectors.write(normalize(flat).astype(np.float16).tobytes())
+        self.offsets.extend((self.offsets[-1] + np.cumsum(lengths)).tolist())
+        self.index.extend(table.column("index").to_pylist())
+        self.pdf_name.extend(table.column("pdf_name").to_pylist())
+        self.pdf_page.extend(table.column("pdf_page").to_pylist())
+
+    def close(self):
+        self._vectors.close()
+        np.save(self.tmp_path / "offsets.npy", np.array(self.offsets, dtype=np.int64))
+        np.save(self.tmp_path / "index.npy", np.array(self.index, dtype=np.int64))
+        np.save(self.tmp_path / "pdf_page.npy", np.array(self.pdf_page, dtype=np.int64))
+        (self.tmp_path / "pdf_name.json").write_text(json.dumps(self.pdf_name))
+        meta = {"n_tokens": self.offsets[-1], "dim": self.dim, "n_pages": len(self.index)}
+        (self.tmp_path / "meta.json").write_text(json.dumps(meta))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
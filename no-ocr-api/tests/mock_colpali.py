@@ -1,5 +1,8 @@
+import io
+from typing import List
+
 import numpy as np
-from fastapi import APIRouter, Depends, FastAPI, HTTPException, Security, UploadFile
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Response, Security, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer
 
@@ -43,11 +46,38 @@ async def query_model(query_text: str):
     mock_embedding = np.random.rand(3, 128).tolist()
     return {"embedding": mock_embedding}
 
+@router.post("/queries")
+async def query_model_batch(query_texts: List[str], format: str = "json", dtype: str = "float32"):
+    # Mock response: one random embedding with shape (3, 128) per query
+    if format == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, np.random.rand(3 * len(query_texts), 128).astype(dtype))
+        return Response(
+            buffer.getvalue(),
+            media_type="application/x-npy",
+            headers={"X-Embedding-Lengths": ",".join(["3"] * len(query_texts))},
+        )
+    return {"embeddings": [np.random.rand(3, 128).tolist() for _ in query_texts]}
+
 @router.post("/process_image")
 async def process_image(image: UploadFile):
     # Mock response: generate a random embedding with shape (1030, 128)
     mock_embedding = np.random.rand(1030, 128).tolist()
     return {"embedding": mock_embedding}
 
+@router.post("/process_images")
+async def process_images(images: List[UploadFile], format: str = "json", dtype: str = "float32"):
+    # Mock response: one random embedding with shape (1030, 128) per image
+    if format == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, np.random.rand(1030 * len(images), 128).astype(dtype))
+        return Response(
+            buffer.getvalue(),
+            media_type="application/x-npy",
+            headers={"X-Embedding-Lengths": ",".join(["1030"] * len(images))},
+        )
+    mock_embeddings = [np.random.rand(1030, 128).tolist() for _ in images]
+    return {"embeddings": mock_embeddings}
+
 # Add authed router to our FastAPI app
 app.include_router(router)
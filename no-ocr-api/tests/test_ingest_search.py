@@ -4,6 +4,8 @@ import sys
 import types
 from pathlib import Path
 
+import numpy as np
+import pyarrow as pa
 import pytest
 from fastapi.testclient import TestClient
 from PIL import Image
@@ -12,7 +14,7 @@ sys.path.append(str(Path(__file__).resolve().parents[1]))
 
 
 @pytest.fixture
-def client(monkeypatch):
+def client(monkeypatch, tmp_path):
     env = {
         "COLPALI_TOKEN": "test-token",
         "VLLM_URL": "http://localhost",
@@ -26,7 +28,14 @@ def client(monkeypatch):
     fake_module.connect = lambda *a, **kw: None
     sys.modules["lancedb"] = fake_module
 
-    from np_ocr.api import app
+    import np_ocr.api as api_module
+    from np_ocr.api import app, dataset_cache, page_index_cache
+    from np_ocr.cache import AnswerCache
+
+    dataset_cache.clear()
+    page_index_cache.clear()
+    # a fresh answer cache per test, so answers never leak from one test into the next
+    monkeypatch.setattr(api_module, "answer_cache", AnswerCache(str(tmp_path / "answer_cache"), "m", "1"))
 
     with TestClient(app) as c:
         yield c
@@ -45,29 +54,43 @@ class FakeDataset:
     def __len__(self):
         return len(self.data)
 
+    def cast_column(self, *_):
+        return self
+
     def __getitem__(self, idx):
+        if isinstance(idx, str):
+            return [row[idx] for row in self.data]
         return self.data[idx]
 
 
-@pytest.fixture
-def fake_dataset_class(monkeypatch):
-    import np_ocr.data as data
+def fake_search_client(results):
+    async def asearch_images_by_text(*args, **kwargs):
+        return results
 
-    def fake_from_list(lst):
-        return FakeDataset(lst)
+    async def asearch_many(query_texts, *args, **kwargs):
+        return [results for _ in query_texts]
 
-    monkeypatch.setattr(data, "Dataset", types.SimpleNamespace(from_list=staticmethod(fake_from_list)))
-    return data
+    return types.SimpleNamespace(asearch_images_by_text=asearch_images_by_text, asearch_many=asearch_many)
 
 
-def test_pdfs_to_hf_dataset(monkeypatch, tmp_path, fake_dataset_class):
-    from importlib import reload
+def fake_acall_vllm(seen):
+    from np_ocr.search import ImageAnswer
+
+    async def acall_vllm(client, image_data, *args, **kwargs):
+        seen["image"] = image_data
+        return ImageAnswer(answer="ok")
+
+    return acall_vllm
 
-    data = fake_dataset_class
-    reload(data)
 
-    def fake_convert_from_path(*args, **kwargs):
-        return [Image.new("RGB", (10, 10)), Image.new("RGB", (10, 10))]
+def test_iter_pdf_rows(monkeypatch, tmp_path):
+    import np_ocr.data as data
+
+    rendered = []
+
+    def fake_convert_from_path(*args, first_page, last_page, **kwargs):
+        rendered.append((first_page, last_page))
+        return [Image.new("RGB", (10, 10)) for _ in range(first_page, last_page + 1)]
 
     class FakePage:
         def __init__(self, text):
@@ -78,29 +101,82 @@ def test_pdfs_to_hf_dataset(monkeypatch, tmp_path, fake_dataset_class):
 
     class FakeReader:
         def __init__(self, _):
-            self.pages = [FakePage("a"), FakePage("b")]
+            self.pages = [FakePage("a"), FakePage("b"), FakePage("c")]
 
     monkeypatch.setattr(data, "convert_from_path", fake_convert_from_path)
+    monkeypatch.setattr(data, "pdfinfo_from_path", lambda *_: {"Pages": 3})
     monkeypatch.setattr(data, "PdfReader", FakeReader)
 
-    (tmp_path / "doc1.pdf").write_bytes(b"%PDF-1.4")
-    (tmp_path / "doc2.pdf").write_bytes(b"%PDF-1.4")
+    pdf_files = [tmp_path / "doc1.pdf", tmp_path / "doc2.pdf"]
+    for pdf_file in pdf_files:
+        pdf_file.write_bytes(b"%PDF-1.4")
+
+    rows = list(data.iter_pdf_rows(pdf_files, page_batch_size=2, extract_text=True))
+    assert len(rows) == 6
+    assert rows[0]["pdf_name"] == "doc1.pdf"
+    assert rows[0]["pdf_page"] == 1
+    assert rows[4]["pdf_name"] == "doc2.pdf"
+    assert rows[4]["pdf_page"] == 2
+    assert rows[4]["page_text"] == "b"
+    assert [row["index"] for row in rows] == list(range(6))
+    # pages are rendered in bounded batches, never a whole PDF at once
+    assert rendered == [(1, 2), (3, 3), (1, 2), (3, 3)]
+
+
+def test_iter_pdf_rows_skips_text_extraction_by_default(monkeypatch):
+    import np_ocr.data as data
+
+    def fail_reader(_):
+        raise AssertionError("PdfReader must not be opened when text extraction is disabled")
+
+    monkeypatch.setattr(data, "PdfReader", fail_reader)
+    monkeypatch.setattr(data, "get_pdf_page_count", lambda _: 2)
+    monkeypatch.setattr(
+        data, "convert_from_path", lambda *a, first_page, last_page, **kw: [Image.new("RGB", (10, 10))] * 2
+    )
+
+    rows = list(data.iter_pdf_rows(["doc.pdf"]))
+    assert [row["page_text"] for row in rows] == [None, None]
+
+
+def test_iter_page_ranges_splits_large_pdfs(monkeypatch):
+    import np_ocr.data as data
+
+    page_counts = {"big.pdf": 5, "small.pdf": 1}
+    monkeypatch.setattr(data, "get_pdf_page_count", lambda path: page_counts[path])
 
-    dataset = data.pdfs_to_hf_dataset(tmp_path)
-    assert len(dataset) == 4
-    assert dataset[0]["pdf_name"] == "doc1.pdf"
-    assert dataset[0]["pdf_page"] == 1
+    assert list(data.iter_page_ranges(["big.pdf", "small.pdf"], page_batch_size=2)) == [
+        ("big.pdf", 1, 2),
+        ("big.pdf", 3, 4),
+        ("big.pdf", 5, 5),
+        ("small.pdf", 1, 1),
+    ]
 
 
 def test_search_images_by_text(monkeypatch):
     from importlib import reload
 
+    import np_ocr.backends as backends
     import np_ocr.search as search
     reload(search)
 
+    table_schema = search.SearchClient(storage_dir="s", vector_size=1, base_url="b", token="t").table_schema()
+
     class FakeTable:
-        def search(self, *_):
+        schema = table_schema
+
+        def list_indices(self):
+            return []
+
+        def search(self, *_, **__):
             class Limiter:
+                def distance_type(self, metric):
+                    assert metric == "cosine"
+                    return self
+
+                def bypass_vector_index(self):
+                    return self
+
                 def limit(self, *_):
                     class Selector:
                         def select(self, *_):
@@ -117,7 +193,7 @@ def test_search_images_by_text(monkeypatch):
         def open_table(self, _):
             return FakeTable()
 
-    monkeypatch.setattr(search.lancedb, "connect", lambda *_: FakeDB())
+    monkeypatch.setattr(backends.lancedb, "connect", lambda *_: FakeDB())
 
     class FakeColPali:
         def query_text(self, _):
@@ -129,10 +205,1115 @@ def test_search_images_by_text(monkeypatch):
     assert res[0]["pdf_name"] == "x.pdf"
 
 
+class FakeLanceTable:
+    schema = pa.schema([pa.field("vector", pa.list_(pa.list_(pa.float32(), 2)))])
+
+    def __init__(self):
+        self.added = []
+        self.indexed = False
+        self.index_args = None
+
+    def add(self, rows):
+        if isinstance(rows, pa.Table):
+            rows = rows.to_pylist()
+        self.added.extend(rows)
+
+    def count_rows(self):
+        return len(self.added)
+
+    def create_index(self, **kwargs):
+        self.indexed = True
+        self.index_args = kwargs
+
+    def search(self):
+        rows = self.added
+
+        class Scan:
+            def select(self, columns):
+                self.columns = columns
+                return self
+
+            def limit(self, _):
+                return self
+
+            def to_batches(self, _):
+                selected = [{column: row[column] for column in self.columns} for row in rows]
+                return pa.Table.from_pylist(selected).to_batches()
+
+        return Scan()
+
+
+@pytest.fixture
+def real_lancedb(monkeypatch):
+    """The real lancedb module for backend tests; the client fixture swaps in a fake one."""
+    import np_ocr.backends as backends
+
+    monkeypatch.delitem(sys.modules, "lancedb", raising=False)
+    import lancedb
+
+    monkeypatch.setattr(backends, "lancedb", lancedb)
+    return lancedb
+
+
+class FakePageColPali:
+    """ColPali stand-in that embeds the page image ``str(i).encode()`` as ``pages[i]``, see page_rows."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def embed_jpeg_images(self, images):
+        chunk = [self.pages[int(image)] for image in images]
+        return np.concatenate(chunk), np.array([len(page) for page in chunk])
+
+
+def page_rows(n: int):
+    return [{"index": i, "pdf_name": "a.pdf", "pdf_page": i + 1, "image_jpeg": str(i).encode()} for i in range(n)]
+
+
+def test_ingest_embeds_pages_in_batches(monkeypatch):
+    from importlib import reload
+
+    import np_ocr.backends as backends
+    import np_ocr.search as search
+    reload(search)
+
+    table = FakeLanceTable()
+
+    class FakeDB:
+        def create_table(self, *_, **__):
+            return table
+
+    monkeypatch.setattr(backends.lancedb, "connect", lambda *_: FakeDB())
+
+    class FakeColPali:
+        def __init__(self):
+            self.batches = []
+
+        def embed_jpeg_images(self, images):
+            assert all(isinstance(image, bytes) for image in images)
+            self.batches.append(len(images))
+            return np.tile([[0.0, 1.0]], (len(images), 1)), np.ones(len(images), dtype=np.int64)
+
+    rows = [
+        {"index": i, "pdf_name": "a.pdf", "pdf_page": i + 1, "image": Image.new("RGB", (10, 10))}
+        for i in range(5)
+    ]
+    client = search.SearchClient(
+        storage_dir="s", vector_size=2, base_url="b", token="t", backend=backends.LanceBackend("s", min_index_rows=1)
+    )
+    client.colpali_client = FakeColPali()
+    tbl = client.create_table("c", "u")
+    client.ingest_rows(tbl, iter(rows), batch_size=2, embed_batch_size=2)
+    client.build_index(tbl, "c", "u")
+
+    assert sorted(client.colpali_client.batches) == [1, 2, 2]
+    assert [row["index"] for row in table.added] == [0, 1, 2, 3, 4]
+    assert table.added[0]["vector"] == [[0.0, 1.0]]
+    # the index is built in the background after ingest returns
+    client.backend.index_builder.wait()
+    assert table.index_args == {
+        "metric": "cosine", "vector_column_name": "vector", "index_type": "IVF_FLAT", "num_partitions": 2
+    }
+
+
+def test_ingest_compresses_pages_to_token_budget(monkeypatch):
+    import np_ocr.search as search
+
+    table = FakeLanceTable()
+
+    class FakeColPali:
+        def embed_jpeg_images(self, images):
+            lengths = np.array([30] * len(images))
+            return np.random.default_rng(0).standard_normal((lengths.sum(), 4)).astype(np.float32), lengths
+
+    client = search.SearchClient(
+        storage_dir="s", vector_size=4, base_url="b", token="t", token_budget=6, token_compression="norm"
+    )
+    client.colpali_client = FakeColPali()
+    rows = [{"index": i, "pdf_name": "a.pdf", "pdf_page": i + 1, "image_jpeg": b"x"} for i in range(3)]
+    client.ingest_rows(table, iter(rows), embed_batch_size=2)
+
+    assert [len(row["vector"]) for row in table.added] == [6, 6, 6]
+
+
+def test_compression_report_endpoint(client, monkeypatch, tmp_path):
+    import np_ocr.api as api
+
+    case_dir = tmp_path / "u" / "c"
+    case_dir.mkdir(parents=True)
+    (case_dir / api.settings.CASE_INFO_FILENAME).write_text("{}")
+    monkeypatch.setattr(api.settings, "STORAGE_DIR", str(tmp_path))
+
+    seen = {}
+
+    def fake_report(case_name, user_id, queries, budgets, top_k):
+        seen.update(queries=queries, budgets=budgets, top_k=top_k)
+        return [{"token_budget": budget} for budget in budgets]
+
+    monkeypatch.setattr(api.search_client, "compression_report", fake_report)
+    response = client.post(
+        "/compression_report",
+        data={"user_id": "u", "case_name": "c", "queries": ["a", "b"], "budgets": "16, 64", "top_k": 5},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"report": [{"token_budget": 16}, {"token_budget": 64}]}
+    assert seen == {"queries": ["a", "b"], "budgets": [16, 64], "top_k": 5}
+
+    response = client.post(
+        "/compression_report", data={"user_id": "u", "case_name": "c", "queries": ["a"], "budgets": "x"}
+    )
+    assert response.status_code == 400
+
+    for data in ({"budgets": "16,0"}, {"budgets": "-8"}, {"budgets": " "}, {"top_k": 0}):
+        response = client.post("/compression_report", data={"user_id": "u", "case_name": "c", "queries": ["a"], **data})
+        assert response.status_code == 400
+
+    # compressed cases have no full multivectors to measure recall against
+    monkeypatch.setattr(api.settings, "TOKEN_BUDGET", 64)
+    response = client.post("/compression_report", data={"user_id": "u", "case_name": "c", "queries": ["a"]})
+    assert response.status_code == 400
+
+
+def test_colpali_client_decodes_npy_embeddings(monkeypatch):
+    import asyncio
+    import io
+
+    import httpx
+    import np_ocr.search as search
+
+    flat = np.arange(10, dtype=np.float16).reshape(5, 2)
+    buffer = io.BytesIO()
+    np.save(buffer, flat)
+    seen = {}
+
+    class FakeResponse:
+        status_code = 200
+        content = buffer.getvalue()
+        headers = {"X-Embedding-Lengths": "3,2"}
+
+        def raise_for_status(self):
+            pass
+
+    def fake_post(url, params=None, **kwargs):
+        seen["url"] = url
+        seen["params"] = params
+        return FakeResponse()
+
+    client = search.ColPaliClient("http://x", "t")
+    monkeypatch.setattr(client.session, "post", fake_post)
+    decoded, lengths = client.embed_jpeg_images([b"a", b"b"])
+    assert seen["params"] == {"format": "npy", "dtype": "float32"}
+    assert lengths.tolist() == [3, 2]
+
+    def handler(request):
+        seen["url"] = request.url.path
+        seen["params"] = dict(request.url.params)
+        return httpx.Response(200, content=buffer.getvalue(), headers={"X-Embedding-Lengths": "3,2"})
+
+    async def embed_queries():
+        client.async_client = httpx.AsyncClient(base_url="http://x", transport=httpx.MockTransport(handler))
+        return await client.aembed_queries(["q1", "q2"])
+
+    flat_queries, query_lengths = asyncio.run(embed_queries())
+    assert seen["url"] == "/queries"
+    assert seen["params"] == {"format": "npy", "dtype": "float32"}
+    assert [len(query) for query in search.split_embeddings(flat_queries, query_lengths)] == [3, 2]
+
+    rows = [{"index": 0, "pdf_name": "a.pdf", "pdf_page": 1}, {"index": 1, "pdf_name": "a.pdf", "pdf_page": 2}]
+    search_client = search.SearchClient(storage_dir="s", vector_size=2, base_url="b", token="t")
+    table = search.embeddings_to_arrow(rows, decoded, lengths, search_client.table_schema())
+    assert table.schema == search_client.table_schema()
+    assert table.column("vector").to_pylist()[1] == [[6.0, 7.0], [8.0, 9.0]]
+
+
+def test_ingest_pdfs_pipeline(monkeypatch, tmp_path):
+    import np_ocr.pipeline as pipeline
+    from datasets import load_from_disk
+
+    def fake_iter_pdf_rows(pdf_files, page_batch_size, **kwargs):
+        for i in range(5):
+            yield {
+                "image": Image.new("RGB", (10, 10)),
+                "index": i,
+                "pdf_name": "a.pdf",
+                "pdf_page": i + 1,
+                "page_text": "",
+            }
+
+    monkeypatch.setattr(pipeline, "iter_pdf_rows", fake_iter_pdf_rows)
+
+    table = FakeLanceTable()
+
+    class FakeSearchClient:
+        def create_table(self, case_name, user_id):
+            return table
+
+        def ingest_rows(self, tbl, rows, embed_batch_size):
+            for row in rows:
+                assert row["image_jpeg"][:2] == b"\xff\xd8"
+                tbl.add([row])
+
+        def build_index(self, tbl, case_name, user_id):
+            tbl.create_index()
+
+    dataset_path = tmp_path / "hf_dataset"
+    pipeline.ingest_pdfs(
+        ["a.pdf"], dataset_path, str(tmp_path / "cache"), FakeSearchClient(), "c", "u", queue_size=2
+    )
+
+    dataset = load_from_disk(str(dataset_path))
+    assert dataset["index"] == list(range(5))
+    assert dataset[3]["image"].size == (10, 10)
+    assert [row["index"] for row in table.added] == list(range(5))
+    assert table.indexed
+
+
+def test_ingest_pdfs_pipeline_propagates_embed_errors(monkeypatch, tmp_path):
+    import np_ocr.pipeline as pipeline
+
+    rendered = []
+
+    def fake_iter_pdf_rows(pdf_files, page_batch_size, **kwargs):
+        for i in range(200):
+            rendered.append(i)
+            yield {"image": Image.new("RGB", (10, 10)), "index": i, "pdf_name": "a.pdf", "pdf_page": i + 1,
+                   "page_text": ""}
+
+    monkeypatch.setattr(pipeline, "iter_pdf_rows", fake_iter_pdf_rows)
+
+    class FailingSearchClient:
+        def create_table(self, case_name, user_id):
+            return FakeLanceTable()
+
+        def ingest_rows(self, tbl, rows, embed_batch_size):
+            next(rows)
+            raise RuntimeError("colpali is down")
+
+    with pytest.raises(RuntimeError, match="colpali is down"):
+        pipeline.ingest_pdfs(
+            ["a.pdf"], tmp_path / "hf_dataset", str(tmp_path / "cache"), FailingSearchClient(), "c", "u", queue_size=1
+        )
+    # the failure stops rendering and the dataset is never written
+    assert len(rendered) < 20
+    assert not (tmp_path / "hf_dataset").exists()
+
+
+def test_asearch_images_by_text(monkeypatch):
+    import asyncio
+
+    import np_ocr.search as search
+
+    table_schema = search.SearchClient(storage_dir="s", vector_size=1, base_url="b", token="t").table_schema()
+
+    class FakeTable:
+        schema = table_schema
+
+        def list_indices(self):
+            return []
+
+        def search(self, query, vector_column_name):
+            assert query.shape == (2, 1)
+            assert vector_column_name == "vector"
+
+            class Query:
+                def distance_type(self, metric):
+                    return self
+
+                def bypass_vector_index(self):
+                    return self
+
+                def limit(self, *_):
+                    return self
+
+                def select(self, *_):
+                    return self
+
+                def to_list(self):
+                    return [{"_distance": 0.1, "index": 0, "pdf_name": "x.pdf", "pdf_page": 1}]
+
+            return Query()
+
+    class FakeColPali:
+        async def aquery_text(self, _):
+            return {"embedding": [[0.0], [1.0]]}
+
+    client = search.SearchClient(storage_dir="s", vector_size=1, base_url="b", token="t")
+    client.colpali_client = FakeColPali()
+    client.backend.table_cache.put(("u", "c"), FakeTable())
+
+    res = asyncio.run(client.asearch_images_by_text("q", case_name="c", user_id="u", top_k=1))
+    assert res[0]["pdf_name"] == "x.pdf"
+
+
+@pytest.mark.parametrize("vector_dtype", ["float16", "int8"])
+def test_reduced_precision_tables_rank_like_float32(monkeypatch, tmp_path, vector_dtype, real_lancedb):
+    import np_ocr.search as search
+    from np_ocr.vectors import maxsim_distances
+
+    rng = np.random.default_rng(0)
+    pages = [rng.standard_normal((6, 8)).astype(np.float32) for _ in range(12)]
+    query = pages[7][:3] + 0.01 * rng.standard_normal((3, 8)).astype(np.float32)
+
+    client = search.SearchClient(
+        storage_dir=str(tmp_path), vector_size=8, base_url="b", token="t", vector_dtype=vector_dtype
+    )
+    client.colpali_client = FakePageColPali(pages)
+    tbl = client.create_table("c", "u")
+    rows = page_rows(12)
+    client.ingest_rows(tbl, iter(rows), embed_batch_size=5)
+    assert real_lancedb.connect(f"{tmp_path}/u/c").open_table("c").count_rows() == 12
+    # re-ingesting a case replaces its table
+    tbl = client.create_table("c", "u")
+    assert tbl.count_rows() == 0
+    client.ingest_rows(tbl, iter(rows), embed_batch_size=5)
+
+    results = client._search_table({"embedding": query.tolist()}, "c", "u", top_k=3)
+
+    exact = maxsim_distances(query, np.concatenate(pages), np.array([6] * 12))
+    assert [result["index"] for result in results] == np.argsort(exact)[:3].tolist()
+    assert results[0]["_distance"] == pytest.approx(exact[7], abs=0.02)
+
+    if vector_dtype == "int8":
+        # int8 codes are searched through pooled candidates, the full scan is only left for older tables
+        assert "pooled_vector" in tbl.schema.names
+        scanned = client.backend._scan_quantized(tbl, query, top_k=3, batch_size=5)
+        assert [hit["index"] for hit in scanned] == np.argsort(exact)[:3].tolist()
+
+
+def test_lance_index_is_built_in_background_and_probed_once_ready(monkeypatch, tmp_path, real_lancedb):
+    import np_ocr.backends as backends
+    import np_ocr.search as search
+
+    rng = np.random.default_rng(8)
+    pages = [rng.standard_normal((6, 8)).astype(np.float32) for _ in range(40)]
+    query = pages[17][:3]
+
+    backend = backends.LanceBackend(str(tmp_path), min_index_rows=16)
+    client = search.SearchClient(storage_dir=str(tmp_path), vector_size=8, base_url="b", token="t", backend=backend)
+    client.colpali_client = FakePageColPali(pages)
+    tbl = client.create_table("c", "u")
+    rows = page_rows(40)
+    client.ingest_rows(tbl, iter(rows), embed_batch_size=8)
+
+    # no index yet, the table is scanned through the handle searches cache
+    searched = backend.open_table("c", "u")
+    assert backend.query_index_params(searched, "c", "u") is None
+    assert client._search_table({"embedding": query.tolist()}, "c", "u", top_k=1)[0]["index"] == 17
+
+    client.build_index(tbl, "c", "u")
+    backend.index_builder.wait()
+    assert backend.stats()["pending_index_builds"] == 0
+    # the finished build drops the cached handle, which could never see the new index
+    reopened = backend.open_table("c", "u")
+    assert reopened is not searched
+    # 40 pages of 6 token vectors, partitioned by token vector
+    assert backend.query_index_params(reopened, "c", "u") == {"index_type": "IVF_FLAT", "num_partitions": 15}
+    # a restarted process derives the same parameters from the table
+    backend.invalidate("c", "u")
+    assert backend.query_index_params(backend.open_table("c", "u"), "c", "u")["num_partitions"] == 15
+    assert client._search_table({"embedding": query.tolist()}, "c", "u", top_k=1)[0]["index"] == 17
+
+
+@pytest.mark.parametrize("pooling", ["mean", "cluster"])
+def test_two_stage_search_reranks_pooled_candidates(monkeypatch, tmp_path, pooling, real_lancedb):
+    import np_ocr.search as search
+    from np_ocr.vectors import maxsim_distances
+
+    rng = np.random.default_rng(2)
+    pages = [rng.standard_normal((20, 8)).astype(np.float32) for _ in range(30)]
+    query = pages[11][:4] + 0.01 * rng.standard_normal((4, 8)).astype(np.float32)
+
+    client = search.SearchClient(
+        storage_dir=str(tmp_path),
+        vector_size=8,
+        base_url="b",
+        token="t",
+        pooling=pooling,
+        pooled_clusters=4,
+        prefilter_candidates=10,
+    )
+    client.colpali_client = FakePageColPali(pages)
+    tbl = client.create_table("c", "u")
+    rows = page_rows(30)
+    client.ingest_rows(tbl, iter(rows), embed_batch_size=8)
+
+    pooled_lengths = [len(vectors) for vectors in tbl.to_arrow().column("pooled_vector").to_pylist()]
+    assert pooled_lengths == [1 if pooling == "mean" else 4] * 30
+
+    results = client._search_table({"embedding": query.tolist()}, "c", "u", top_k=2)
+    assert results[0]["index"] == 11
+    exact = maxsim_distances(query, np.concatenate(pages), np.array([20] * 30))
+    assert results[0]["_distance"] == pytest.approx(exact[11], abs=1e-5)
+
+
+def test_numpy_backend_serves_small_cases_from_memory(monkeypatch, tmp_path, real_lancedb):
+    import np_ocr.search as search
+    from np_ocr.vectors import maxsim_distances
+
+    rng = np.random.default_rng(5)
+    pages = [rng.standard_normal((6, 8)).astype(np.float32) for _ in range(10)]
+    query = pages[4][:2]
+
+    client = search.SearchClient(
+        storage_dir=str(tmp_path), vector_size=8, base_url="b", token="t", search_backend="auto", numpy_max_pages=10
+    )
+    client.colpali_client = FakePageColPali(pages)
+    tbl = client.create_table("c", "u")
+    rows = page_rows(10)
+    client.ingest_rows(tbl, iter(rows), embed_batch_size=4)
+
+    # auto only scores in process from a memory-mapped store, never by reading the case into the heap
+    assert not client.use_numpy_backend("c", "u")
+    client.write_case_vectors("c", "u")
+    assert client.use_numpy_backend("c", "u")
+    results = client._search_table({"embedding": query.tolist()}, "c", "u", top_k=3)
+    exact = maxsim_distances(query, np.concatenate(pages), np.array([6] * 10))
+    assert [result["index"] for result in results] == np.argsort(exact)[:3].tolist()
+
+    client._search_table({"embedding": query.tolist()}, "c", "u", top_k=3)
+    assert client.case_vectors_cache.stats()["hits"] == 1
+    client.invalidate("u", "c")
+    assert client.case_vectors_cache.stats()["size"] == 0
+
+    client.numpy_max_pages = 5
+    assert not client.use_numpy_backend("c", "u")
+
+    # the page count is looked up once per case until the case is invalidated
+    counts = []
+    count = client.backend.count
+    monkeypatch.setattr(client.backend, "count", lambda *args: counts.append(args) or count(*args))
+    client.use_numpy_backend("c", "u")
+    assert counts == []
+    client.invalidate("u", "c")
+    client.use_numpy_backend("c", "u")
+    client.use_numpy_backend("c", "u")
+    assert counts == [("c", "u")]
+
+
+@pytest.mark.parametrize("pooling", [None, "mean"])
+def test_embedding_store_is_memory_mapped_for_search_and_rerank(monkeypatch, tmp_path, pooling, real_lancedb):
+    import np_ocr.search as search
+    from np_ocr.vectors import maxsim_distances
+
+    rng = np.random.default_rng(6)
+    pages = [rng.standard_normal((5, 8)).astype(np.float32) for _ in range(9)]
+    query = pages[6][:2]
+
+    client = search.SearchClient(
+        storage_dir=str(tmp_path), vector_size=8, base_url="b", token="t", vector_dtype="float16", pooling=pooling
+    )
+    client.colpali_client = FakePageColPali(pages)
+    tbl = client.create_table("c", "u")
+    rows = page_rows(9)
+    client.ingest_rows(tbl, iter(rows), embed_batch_size=4)
+    client.write_case_vectors("c", "u", batch_size=4)
+
+    store = client.stored_case_vectors("c", "u")
+    assert isinstance(store.vectors, np.memmap)
+    assert store.vectors.shape == (45, 8)
+    assert store.pdf_page.tolist() == list(range(1, 10))
+
+    exact = maxsim_distances(query, np.concatenate(pages), np.array([5] * 9))
+    results = client._search_table({"embedding": query.tolist()}, "c", "u", top_k=2)
+    assert [result["index"] for result in results] == np.argsort(exact)[:2].tolist()
+    assert results[0]["_distance"] == pytest.approx(exact[6], abs=1e-2)
+
+    client.search_backend = "numpy"
+    assert client._search_table({"embedding": query.tolist()}, "c", "u", top_k=1)[0]["index"] == 6
+
+
+def fake_qdrant_module():
+    """A qdrant_client stand-in that stores points in memory and answers MAX_SIM queries exactly."""
+    from np_ocr.vectors import maxsim_distances, normalize
+
+    def record(kind):
+        return lambda **kwargs: types.SimpleNamespace(kind=kind, **kwargs)
+
+    models = types.SimpleNamespace(
+        Distance=types.SimpleNamespace(COSINE="Cosine"),
+        MultiVectorComparator=types.SimpleNamespace(MAX_SIM="max_sim"),
+        Datatype=types.SimpleNamespace(FLOAT16="float16"),
+        ScalarType=types.SimpleNamespace(INT8="int8"),
+        **{
+            kind: record(kind)
+            for kind in [
+                "VectorParams", "MultiVectorConfig", "ScalarQuantization", "ScalarQuantizationConfig",
+                "OptimizersConfigDiff", "PointStruct", "Prefetch", "SearchParams", "QuantizationSearchParams",
+            ]
+        },
+    )
+
+    class FakeQdrantClient:
+        def __init__(self, **kwargs):
+            self.collections = {}
+            self.upserts = []
+            self.queries = []
+
+        def collection_exists(self, name):
+            return name in self.collections
+
+        def delete_collection(self, name):
+            del self.collections[name]
+
+        def create_collection(self, collection_name, vectors_config, **kwargs):
+            self.collections[collection_name] = {"vectors": vectors_config, "points": {}, **kwargs}
+
+        def update_collection(self, collection_name, optimizers_config):
+            self.collections[collection_name]["optimizers_config"] = optimizers_config
+
+        def upsert(self, collection_name, points, wait):
+            self.upserts.append(len(points))
+            self.collections[collection_name]["points"].update({point.id: point for point in points})
+
+        def count(self, name, exact):
+            return types.SimpleNamespace(count=len(self.collections[name]["points"]))
+
+        def query_points(self, collection_name, query, using, limit, **kwargs):
+            self.queries.append({"using": using, "limit": limit, **kwargs})
+            points = list(self.collections[collection_name]["points"].values())
+            vectors = [np.asarray(point.vector[using], dtype=np.float32) for point in points]
+            query = np.asarray(query, dtype=np.float32)
+            distances = maxsim_distances(
+                normalize(query), normalize(np.concatenate(vectors)), np.array([len(v) for v in vectors])
+            )
+            order = np.argsort(distances)[:limit]
+            return types.SimpleNamespace(
+                points=[
+                    types.SimpleNamespace(payload=points[i].payload, score=len(query) - distances[i]) for i in order
+                ]
+            )
+
+    module = types.ModuleType("qdrant_client")
+    module.QdrantClient = FakeQdrantClient
+    module.models = models
+    return module
+
+
+def test_qdrant_backend_stores_multivectors_for_max_sim(monkeypatch):
+    import np_ocr.search as search
+    from np_ocr.backends import QdrantBackend
+    from np_ocr.vectors import maxsim_distances
+
+    monkeypatch.setitem(sys.modules, "qdrant_client", fake_qdrant_module())
+
+    rng = np.random.default_rng(7)
+    pages = [rng.standard_normal((4, 8)).astype(np.float32) for _ in range(5)]
+    query = pages[3][:2]
+
+    backend = QdrantBackend(vector_dtype="int8", upsert_batch_size=2, prefilter_candidates=3)
+    client = search.SearchClient(
+        storage_dir="s", vector_size=8, base_url="b", token="t", vector_dtype="int8", pooling="mean", backend=backend
+    )
+    client.colpali_client = FakePageColPali(pages)
+    name = client.create_table("c", "u")
+    rows = page_rows(5)
+    client.ingest_rows(name, iter(rows), embed_batch_size=5)
+    client.build_index(name, "c", "u")
+
+    collection = backend.client.collections["u.c"]
+    assert name == "u.c"
+    assert backend.client.upserts == [2, 2, 1]
+    assert collection["vectors"]["vector"].multivector_config.comparator == "max_sim"
+    assert collection["vectors"]["vector"].quantization_config.scalar.type == "int8"
+    assert "quantization_config" not in vars(collection["vectors"]["pooled_vector"])
+    assert collection["optimizers_config"].indexing_threshold == backend.indexing_threshold
+    assert backend.count("c", "u") == 5
+
+    exact = maxsim_distances(query, np.concatenate(pages), np.array([4] * 5))
+    results = client._search_table({"embedding": query.tolist()}, "c", "u", top_k=2)
+    assert [result["index"] for result in results] == np.argsort(exact)[:2].tolist()
+    assert results[0]["_distance"] == pytest.approx(exact[3], abs=1e-4)
+    assert backend.client.queries[0]["prefetch"].using == "pooled_vector"
+    assert backend.client.queries[0]["search_params"].quantization.rescore
+
+    client.delete_case("c", "u")
+    assert "u.c" not in backend.client.collections
+
+
+def test_search_reuses_cached_query_embedding(monkeypatch):
+    import np_ocr.search as search
+    from np_ocr.cache import QueryEmbeddingCache
+
+    class FakeColPali:
+        calls = 0
+
+        def query_text(self, _):
+            FakeColPali.calls += 1
+            return {"embedding": [[0.0]]}
+
+    client = search.SearchClient(
+        storage_dir="s", vector_size=1, base_url="b", token="t", query_cache=QueryEmbeddingCache("m", max_size=4)
+    )
+    client.colpali_client = FakeColPali()
+    monkeypatch.setattr(client, "_search_table", lambda *a: [])
+
+    client.search_images_by_text("margin?", case_name="c", user_id="u", top_k=1)
+    client.search_images_by_text("margin? ", case_name="c", user_id="u", top_k=1)
+    assert FakeColPali.calls == 1
+    assert client.query_cache.stats()["hits"] == 1
+
+
+def test_search_many_embeds_once_and_scores_queries_together(monkeypatch):
+    import asyncio
+
+    import np_ocr.search as search
+    from np_ocr.cache import QueryEmbeddingCache
+    from np_ocr.vectors import CaseVectors, maxsim_distances
+
+    rng = np.random.default_rng(9)
+    pages = [rng.standard_normal((5, 8)).astype(np.float32) for _ in range(6)]
+    rows = [{"index": i, "pdf_name": "a.pdf", "pdf_page": i + 1} for i in range(6)]
+    lengths = np.array([5] * 6)
+    queries = {"q0": pages[0][:2], "q4": pages[4][1:4], "q5": pages[5][:1]}
+
+    class FakeColPali:
+        batches = []
+
+        async def aembed_queries(self, query_texts):
+            self.batches.append(query_texts)
+            chunk = [queries[text] for text in query_texts]
+            return np.concatenate(chunk), np.array([len(query) for query in chunk])
+
+    client = search.SearchClient(
+        storage_dir="s", vector_size=8, base_url="b", token="t", query_cache=QueryEmbeddingCache("m", max_size=8),
+        search_backend="numpy",
+    )
+    client.colpali_client = FakeColPali()
+    client.query_cache.put("q5", {"embedding": queries["q5"].tolist()})
+    table = search.embeddings_to_arrow(rows, np.concatenate(pages), lengths, client.table_schema())
+    monkeypatch.setattr(client, "load_case_vectors", lambda *_: CaseVectors.from_arrow(table))
+
+    results = asyncio.run(client.asearch_many(["q4", "q0", "q4", "q5"], "c", "u", top_k=2))
+
+    # cached and repeated queries are not sent again
+    assert FakeColPali.batches == [["q4", "q0"]]
+    assert [result[0]["index"] for result in results] == [4, 0, 4, 5]
+    exact = maxsim_distances(queries["q0"], np.concatenate(pages), lengths)
+    assert [result["index"] for result in results[1]] == np.argsort(exact)[:2].tolist()
+    assert asyncio.run(client.aquery_embeddings(["q0"]))[0].shape == (2, 8)
+    assert FakeColPali.batches == [["q4", "q0"]]
+
+
+def test_search_batch_returns_results_per_query(client, monkeypatch, page_image_case):
+    from np_ocr import api as api_module
+
+    monkeypatch.setattr(api_module, "search_client", fake_search_client([{"_distance": 0.5, "index": 0}]))
+
+    response = client.post(
+        "/search_batch",
+        data={"user_queries": ["first", "second"], "user_id": "user", "case_name": "case", "return_urls": "true"},
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["user_query"] for result in results] == ["first", "second"]
+    assert results[1]["search_results"][0]["pdf_name"] == "my report.pdf"
+
+    monkeypatch.setattr(api_module.settings, "SEARCH_BATCH_MAX_QUERIES", 1)
+    response = client.post(
+        "/search_batch", data={"user_queries": ["first", "second"], "user_id": "user", "case_name": "case"}
+    )
+    assert response.status_code == 400
+
+
+def test_ordered_concurrent_map_keeps_input_order():
+    import time
+
+    from np_ocr.concurrency import ordered_concurrent_map
+
+    def slow_for_first(i):
+        if i == 0:
+            time.sleep(0.05)
+        return i * 10
+
+    assert list(ordered_concurrent_map(slow_for_first, range(7), max_in_flight=3)) == [0, 10, 20, 30, 40, 50, 60]
+
+
+def test_fan_out_abandons_slow_and_failing_items():
+    import threading
+    import time
+
+    from np_ocr.concurrency import fan_out
+
+    release = threading.Event()
+
+    def work(item):
+        if item == "slow":
+            release.wait(5)
+        if item == "broken":
+            raise RuntimeError("boom")
+        return item.upper()
+
+    start = time.time()
+    results, incomplete = fan_out(work, ["a", "slow", "broken", "b"], max_workers=2, timeout=0.2)
+    release.set()
+    assert time.time() - start < 2
+    assert results == {"a": "A", "b": "B"}
+    assert sorted(incomplete) == ["broken", "slow"]
+
+
+def test_fan_out_reuses_a_bounded_pool_and_caps_concurrency():
+    import threading
+
+    from np_ocr import concurrency
+
+    release = threading.Event()
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def work(item):
+        with lock:
+            active.append(item)
+            peak.append(len(active))
+        try:
+            if item.startswith("hang"):
+                release.wait(5)
+            return item
+        finally:
+            with lock:
+                active.remove(item)
+
+    try:
+        for round_ in range(3):
+            items = [f"hang{round_}", f"x{round_}", f"y{round_}", f"z{round_}"]
+            results, incomplete = concurrency.fan_out(work, items, max_workers=2, timeout=0.2)
+            assert results == {item: item for item in items[1:]}
+            assert incomplete == [f"hang{round_}"]
+        assert max(peak) <= 2 + 2  # two calls of the current round plus hung calls from earlier rounds
+        fan_out_threads = [t for t in threading.enumerate() if t.name.startswith("fan-out")]
+        assert len(fan_out_threads) <= concurrency.FAN_OUT_POOL_SIZE
+
+        # once the deadline passes, items that never started are reported instead of being run
+        results, incomplete = concurrency.fan_out(work, ["hang-a", "hang-b", "late"], max_workers=2, timeout=0.1)
+        assert results == {}
+        assert sorted(incomplete) == ["hang-a", "hang-b", "late"]
+    finally:
+        release.set()
+
+
+def test_search_cases_merges_a_global_top_k(monkeypatch):
+    import asyncio
+
+    import np_ocr.search as search
+
+    distances = {("u", "a"): [0.3, 0.9], ("u", "b"): [0.1, 0.5], ("common_cases", "c"): [0.2, 0.4]}
+
+    def fake_search_table(query_embedding, case_name, user_id, top_k):
+        if case_name == "c":
+            raise RuntimeError("table missing")
+        return [{"index": i, "_distance": distance} for i, distance in enumerate(distances[(user_id, case_name)])]
+
+    client = search.SearchClient(storage_dir="s", vector_size=1, base_url="b", token="t")
+    async def aquery_embedding(query_text):
+        return {"embedding": [[1.0]]}
+
+    monkeypatch.setattr(client, "aquery_embedding", aquery_embedding)
+    monkeypatch.setattr(client, "_search_table", fake_search_table)
+
+    hits, incomplete = asyncio.run(client.asearch_cases("q", list(distances), top_k=3, max_workers=2, timeout=5))
+    assert [(hit["case_name"], hit["index"], hit["_distance"]) for hit in hits] == [
+        ("b", 0, 0.1), ("a", 0, 0.3), ("b", 1, 0.5)
+    ]
+    assert hits[0]["user_id"] == "u"
+    assert incomplete == [("common_cases", "c")]
+
+
+def test_search_cases_endpoint_covers_user_and_common_cases(client, monkeypatch, tmp_path):
+    import json
+
+    from np_ocr import api as api_module
+
+    storage = tmp_path / "storage"
+    for owner, case_name, status in [
+        ("user", "a", "done"), ("user", "b", "processing"), ("common_cases", "c", "done"), ("other", "d", "done")
+    ]:
+        case_dir = storage / owner / case_name
+        (case_dir / "hf_dataset").mkdir(parents=True)
+        (case_dir / "case_info.json").write_text(json.dumps({"status": status}))
+    fake_dataset = FakeDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1, "image": {"bytes": b"\xff\xd8", "path": None}, "thumbnail_jpeg": b"t"},
+    ])
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(storage))
+
+    seen = {}
+
+    async def asearch_cases(query_text, cases, top_k, max_workers, timeout):
+        seen["cases"] = cases
+        return [{"_distance": 0.2, "index": 0, "user_id": "common_cases", "case_name": "c"}], [("user", "a")]
+
+    monkeypatch.setattr(api_module, "search_client", types.SimpleNamespace(asearch_cases=asearch_cases))
+
+    response = client.post("/search_cases", data={"user_query": "q", "user_id": "user", "return_urls": "true"})
+    assert response.status_code == 200
+    assert seen["cases"] == [("user", "a"), ("common_cases", "c")]
+    body = response.json()
+    assert body["incomplete_cases"] == ["user/a"]
+    assert body["search_results"][0]["case_name"] == "c"
+    assert "/page_image/common_cases/c/" in body["search_results"][0]["image_url"]
+
+    response = client.post(
+        "/search_cases",
+        data={"user_query": "q", "user_id": "user", "case_names": ["a"], "include_common_cases": "false"},
+    )
+    assert response.status_code == 200
+    assert seen["cases"] == [("user", "a")]
+
+    response = client.post(
+        "/search_cases", data={"user_query": "q", "user_id": "nobody", "include_common_cases": "false"}
+    )
+    assert response.status_code == 404
+
+
+def fake_acall_vllm_with_confidence(answers, delays):
+    """acall_vllm_with_confidence returning ``answers[image_data]`` after ``delays[image_data]`` seconds."""
+    import asyncio
+
+    from np_ocr.search import ImageAnswer
+
+    async def acall_vllm_with_confidence(client, image_data, user_query, model):
+        await asyncio.sleep(delays[image_data])
+        if answers[image_data] is None:
+            raise RuntimeError("vLLM is down")
+        answer, confidence = answers[image_data]
+        return ImageAnswer(answer=answer), confidence
+
+    return acall_vllm_with_confidence
+
+
+def test_answer_pages_stops_on_confident_answer(monkeypatch):
+    import asyncio
+    import time
+
+    import np_ocr.search as search
+
+    answers = {b"na": ("NA", 0.99), b"unsure": ("maybe 3", 0.4), b"sure": ("42", 0.95), b"slow": ("late", 0.99)}
+    delays = {b"na": 0.0, b"unsure": 0.01, b"sure": 0.05, b"slow": 5.0}
+    monkeypatch.setattr(search, "acall_vllm_with_confidence", fake_acall_vllm_with_confidence(answers, delays))
+
+    async def collect(min_confidence):
+        pages = [(key.decode(), key) for key in answers]
+        return [item async for item in search.aanswer_pages(None, pages, "q", "m", min_confidence)]
+
+    start = time.time()
+    results = asyncio.run(collect(0.9))
+    assert time.time() - start < 2
+    assert [key for key, _ in results] == ["na", "unsure", "sure", "slow"]
+    assert results[2][1][0].answer == "42"
+    assert isinstance(results[3][1], asyncio.CancelledError)
+
+    delays[b"slow"] = 0.1
+    answers[b"sure"] = None
+    results = dict(asyncio.run(collect(0.9)))
+    assert isinstance(results["sure"], RuntimeError)
+    assert results["slow"][0].answer == "late"
+
+
+def test_answer_confidence_from_logprobs():
+    import math
+
+    from np_ocr.search import answer_confidence
+
+    logprobs = types.SimpleNamespace(
+        content=[types.SimpleNamespace(logprob=0.0), types.SimpleNamespace(logprob=math.log(0.25))]
+    )
+    assert answer_confidence(logprobs) == pytest.approx(0.5)
+    assert answer_confidence(None) is None
+
+
+def test_answer_endpoint_streams_page_answers(client, monkeypatch, tmp_path):
+    import json
+
+    import np_ocr.search as search
+    from np_ocr import api as api_module
+
+    case_dir = tmp_path / "storage/user/case"
+    (case_dir / "hf_dataset").mkdir(parents=True)
+    fake_dataset = FakeDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1, "image": {"bytes": b"\xff\xd8", "path": None}, "thumbnail_jpeg": b"t1"},
+        {"pdf_name": "a.pdf", "pdf_page": 2, "image": {"bytes": b"\xff\xd8", "path": None}, "thumbnail_jpeg": b"t2"},
+    ])
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    answers = {b"t1": ("NA", 0.9), b"t2": ("42", 0.3)}
+    delays = {b"t1": 0.0, b"t2": 0.02}
+    monkeypatch.setattr(search, "acall_vllm_with_confidence", fake_acall_vllm_with_confidence(answers, delays))
+
+    data = {"user_query": "q", "user_id": "user", "case_name": "case", "pdf_names": ["a.pdf", "a.pdf"],
+            "pdf_pages": [1, 2]}
+    response = client.post("/answer", data=data)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"pdf_name": "a.pdf", "pdf_page": 1, "status": "answered", "answer": "NA", "confidence": 0.9},
+        {"pdf_name": "a.pdf", "pdf_page": 2, "status": "answered", "answer": "42", "confidence": 0.3},
+    ]
+
+    response = client.post("/answer", data={**data, "pdf_pages": [1]})
+    assert response.status_code == 400
+
+
+def test_answers_are_cached_until_the_case_changes(client, monkeypatch, tmp_path):
+    import json
+
+    import np_ocr.search as search
+    from np_ocr import api as api_module
+
+    case_dir = tmp_path / "storage/user/case"
+    (case_dir / "hf_dataset").mkdir(parents=True)
+    fake_dataset = FakeDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1, "image": {"bytes": b"\xff\xd8", "path": None}, "thumbnail_jpeg": b"t1"},
+        {"pdf_name": "a.pdf", "pdf_page": 2, "image": {"bytes": b"\xff\xd8", "path": None}, "thumbnail_jpeg": b"t2"},
+    ])
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    calls = []
+
+    async def acall_vllm(client, image_data, *args, **kwargs):
+        calls.append(image_data)
+        return search.ImageAnswer(answer="ok")
+
+    monkeypatch.setattr(api_module, "acall_vllm", acall_vllm)
+    data = {"user_query": "foo", "user_id": "user", "case_name": "case", "pdf_name": "a.pdf", "pdf_page": 1}
+    assert client.post("/vllm_call", data=data).json() == {"answer": "ok"}
+    assert client.post("/vllm_call", data={**data, "user_query": " foo"}).json() == {"answer": "ok"}
+    assert calls == [b"t1"]
+
+    # /answer shares the cache: page 1 is served from it and is confident enough to skip page 2
+    api_module.answer_cache.put("user", "case", b"t1", "foo", "ok", 0.95)
+    response = client.post(
+        "/answer", data={**data, "pdf_names": ["a.pdf", "a.pdf"], "pdf_pages": [1, 2]}
+    )
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"pdf_name": "a.pdf", "pdf_page": 1, "status": "answered", "answer": "ok", "confidence": 0.95,
+         "cached": True},
+        {"pdf_name": "a.pdf", "pdf_page": 2, "status": "cancelled"},
+    ]
+
+    api_module.invalidate_case_caches("user", "case")
+    client.post("/vllm_call", data=data)
+    assert calls == [b"t1", b"t1"]
+
+
+def test_astream_vllm_yields_deltas_then_validated_answer():
+    import asyncio
+
+    import np_ocr.search as search
+    import pydantic
+
+    class FakeStream:
+        def __init__(self, deltas):
+            self.chunks = [
+                types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=delta))])
+                for delta in deltas
+            ]
+            self.closed = False
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            self.closed = True
+
+        async def __aiter__(self):
+            for chunk in self.chunks:
+                yield chunk
+
+    def fake_client(stream):
+        async def create(**kwargs):
+            assert kwargs["stream"] is True
+            return stream
+
+        return types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+
+    async def collect(stream):
+        return [item async for item in search.astream_vllm(fake_client(stream), b"jpeg", "q", "m")]
+
+    stream = FakeStream(['{"answer": ', '"o', 'k"}'])
+    items = asyncio.run(collect(stream))
+    assert items == ['{"answer": ', '"o', 'k"}', search.ImageAnswer(answer="ok")]
+    assert stream.closed
+
+    with pytest.raises(pydantic.ValidationError):
+        asyncio.run(collect(FakeStream(['{"answer": ', '"o'])))
+
+
+def test_vllm_call_stream_sends_tokens_then_answer(client, monkeypatch, tmp_path):
+    import np_ocr.search as search
+    from np_ocr import api as api_module
+
+    (tmp_path / "storage/user/case/hf_dataset").mkdir(parents=True)
+    fake_dataset = FakeDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1, "image": {"bytes": b"\xff\xd8", "path": None}, "thumbnail_jpeg": b"t1"},
+    ])
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    calls = []
+
+    async def astream_vllm(client, image_data, user_query, model):
+        calls.append(image_data)
+        if user_query == "bad":
+            yield '{"answer'
+            raise ValueError("truncated")
+        for delta in ['{"answer": ', '"ok"}']:
+            yield delta
+        yield search.ImageAnswer(answer="ok")
+
+    monkeypatch.setattr(api_module, "astream_vllm", astream_vllm)
+    data = {"user_query": "foo", "user_id": "user", "case_name": "case", "pdf_name": "a.pdf", "pdf_page": 1}
+
+    response = client.post("/vllm_call_stream", data=data)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == (
+        'event: token\ndata: {"delta": "{\\"answer\\": "}\n\n'
+        'event: token\ndata: {"delta": "\\"ok\\"}"}\n\n'
+        'event: answer\ndata: {"answer": "ok"}\n\n'
+    )
+
+    # the validated answer is cached and shared with /vllm_call
+    assert client.post("/vllm_call_stream", data=data).text == 'event: answer\ndata: {"answer": "ok"}\n\n'
+    assert client.post("/vllm_call", data=data).json() == {"answer": "ok"}
+    assert calls == [b"t1"]
+
+    response = client.post("/vllm_call_stream", data={**data, "user_query": "bad"})
+    assert response.text.endswith('event: error\ndata: {"detail": "Failed to generate a valid answer."}\n\n')
+    assert client.post("/vllm_call_stream", data={**data, "pdf_page": 0}).status_code == 400
+
+
+def test_colpali_client_retries_server_errors(monkeypatch):
+    import np_ocr.search as search
+
+    calls = []
+
+    class FakeResponse:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"embedding": [[1.0]]}
+
+    def fake_post(*args, **kwargs):
+        calls.append(args)
+        return FakeResponse(503 if len(calls) < 3 else 200)
+
+    monkeypatch.setattr(search.time, "sleep", lambda *_: None)
+
+    client = search.ColPaliClient("http://x", "t", max_retries=3)
+    monkeypatch.setattr(client.session, "post", fake_post)
+    assert client.query_text("q") == {"embedding": [[1.0]]}
+    assert len(calls) == 3
+
+
 def test_ai_search_dataset_missing(client, monkeypatch):
     from np_ocr import api as api_module
 
-    monkeypatch.setattr(api_module, "search_client", types.SimpleNamespace(search_images_by_text=lambda *a, **k: []))
+    monkeypatch.setattr(api_module, "search_client", fake_search_client([]))
 
     response = client.post(
         "/search",
@@ -172,12 +1353,13 @@ def test_vllm_call_image_not_found(client, monkeypatch, tmp_path):
         types.SimpleNamespace(
             STORAGE_DIR=str(tmp_path / "storage"),
             HF_DATASET_DIRNAME="hf_dataset",
+            PAGE_INDEX_FILENAME="page_index.json",
             VLLM_URL="http://x",
             VLLM_API_KEY="k",
             VLLM_MODEL="m",
         ),
     )
-    monkeypatch.setattr(api_module, "call_vllm", lambda *a, **kw: api_module.ImageAnswer(answer="ok"))
+    monkeypatch.setattr(api_module, "acall_vllm", fake_acall_vllm({}))
 
     response = client.post(
         "/vllm_call",
@@ -191,3 +1373,196 @@ def test_vllm_call_image_not_found(client, monkeypatch, tmp_path):
     )
     assert response.status_code == 404
 
+
+
+def test_build_page_index():
+    from np_ocr.data import build_page_index, lookup_page
+
+    dataset = FakeDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1},
+        {"pdf_name": "a.pdf", "pdf_page": 2},
+        {"pdf_name": "b.pdf", "pdf_page": 1},
+    ])
+    page_index = build_page_index(dataset)
+    assert lookup_page(page_index, "a.pdf", 2) == 1
+    assert lookup_page(page_index, "b.pdf", 1) == 2
+    assert lookup_page(page_index, "b.pdf", 2) is None
+
+
+def test_vllm_call_uses_page_index(client, monkeypatch, tmp_path):
+    from np_ocr import api as api_module
+    from np_ocr.data import save_page_index
+
+    case_dir = tmp_path / "storage/user/case"
+    (case_dir / "hf_dataset").mkdir(parents=True)
+    save_page_index({"b.pdf": {"3": 1}}, case_dir / "page_index.json")
+
+    class IndexOnlyDataset(FakeDataset):
+        def __iter__(self):
+            raise AssertionError("dataset must not be scanned when a page index exists")
+
+    fake_dataset = IndexOnlyDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1, "image": Image.new("RGB", (10, 10)), "thumbnail_jpeg": b"thumb-a"},
+        {"pdf_name": "b.pdf", "pdf_page": 3, "image": Image.new("RGB", (10, 10)), "thumbnail_jpeg": b"thumb-b"},
+    ])
+    seen = {}
+
+
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    monkeypatch.setattr(api_module, "acall_vllm", fake_acall_vllm(seen))
+
+    response = client.post(
+        "/vllm_call",
+        data={"user_query": "foo", "user_id": "user", "case_name": "case", "pdf_name": "b.pdf", "pdf_page": 3},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"answer": "ok"}
+    assert seen["image"] == b"thumb-b"
+
+
+def test_case_dataset_is_cached_until_invalidated(client, monkeypatch, tmp_path):
+    from np_ocr import api as api_module
+
+    (tmp_path / "storage/user/case/hf_dataset").mkdir(parents=True)
+    loads = []
+
+    def fake_load_from_disk(path):
+        loads.append(path)
+        return FakeDataset([])
+
+    monkeypatch.setattr(api_module, "load_from_disk", fake_load_from_disk)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+
+    first = api_module.load_case_dataset("user", "case")
+    assert api_module.load_case_dataset("user", "case") is first
+    assert len(loads) == 1
+
+    api_module.invalidate_case_caches("user", "case")
+    assert api_module.load_case_dataset("user", "case") is not first
+    assert len(loads) == 2
+
+    stats = client.get("/cache_stats").json()
+    assert stats["datasets"]["hits"] >= 1
+    assert stats["datasets"]["misses"] >= 2
+
+
+def test_page_jpeg_helpers_reuse_stored_bytes():
+    from io import BytesIO
+
+    from np_ocr.data import encode_page_row, get_page_jpeg, get_page_thumbnail_jpeg
+
+    row = encode_page_row({"image": Image.new("RGB", (1200, 1600))})
+    assert get_page_jpeg(row) is row["image"]["bytes"]
+    assert get_page_thumbnail_jpeg(row) is row["thumbnail_jpeg"]
+    assert Image.open(BytesIO(row["thumbnail_jpeg"])).size == (384, 512)
+
+    # rows from datasets ingested before thumbnails were stored
+    legacy_row = {"image": Image.new("RGB", (1200, 1600))}
+    assert get_page_jpeg(legacy_row)[:2] == b"\xff\xd8"
+    assert Image.open(BytesIO(get_page_thumbnail_jpeg(legacy_row))).size == (384, 512)
+
+
+def test_ai_search_returns_stored_jpeg(client, monkeypatch, tmp_path):
+    import base64
+    import json
+
+    from np_ocr import api as api_module
+
+    case_dir = tmp_path / "storage/user/case"
+    (case_dir / "hf_dataset").mkdir(parents=True)
+    (case_dir / "case_info.json").write_text(json.dumps({}))
+
+    stored = b"\xff\xd8stored-jpeg"
+    fake_dataset = FakeDataset([
+        {"pdf_name": "a.pdf", "pdf_page": 1, "image": {"bytes": stored, "path": None}, "thumbnail_jpeg": b"t"},
+    ])
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    monkeypatch.setattr(
+        api_module,
+        "search_client",
+        fake_search_client([{"_distance": 0.5, "index": 0}]),
+    )
+
+    response = client.post("/search", data={"user_query": "q", "user_id": "user", "case_name": "case"})
+    assert response.status_code == 200
+    result = response.json()["search_results"][0]
+    assert base64.b64decode(result["image_base64"]) == stored
+    assert result["pdf_name"] == "a.pdf"
+
+
+@pytest.fixture
+def page_image_case(client, monkeypatch, tmp_path):
+    import json
+
+    from np_ocr import api as api_module
+    from np_ocr.data import save_page_index
+
+    case_dir = tmp_path / "storage/user/case"
+    (case_dir / "hf_dataset").mkdir(parents=True)
+    (case_dir / "case_info.json").write_text(json.dumps({}))
+    save_page_index({"my report.pdf": {"2": 0}, "Report (1).pdf": {"1": 1}}, case_dir / "page_index.json")
+
+    content = b"\xff\xd8" + bytes(range(200))
+    fake_dataset = FakeDataset([
+        {"pdf_name": "my report.pdf", "pdf_page": 2, "image": {"bytes": content, "path": None},
+         "thumbnail_jpeg": b"thumb"},
+        {"pdf_name": "Report (1).pdf", "pdf_page": 1, "image": {"bytes": content, "path": None},
+         "thumbnail_jpeg": b"thumb"},
+    ])
+    monkeypatch.setattr(api_module, "load_from_disk", lambda *_: fake_dataset)
+    monkeypatch.setattr(api_module.settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    return content
+
+
+def test_page_image_caching_and_ranges(client, page_image_case):
+    content = page_image_case
+    url = "/page_image/user/case/my report.pdf/2"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["content-type"] == "image/jpeg"
+    assert "max-age" in response.headers["cache-control"]
+    etag = response.headers["etag"]
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": f'"stale", W/{etag}'}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": "*"}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+    partial = client.get(url, headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.content == content[10:20]
+    assert partial.headers["content-range"] == f"bytes 10-19/{len(content)}"
+
+    suffix = client.get(url, headers={"Range": "bytes=-5"})
+    assert suffix.content == content[-5:]
+
+    assert client.get(url, headers={"Range": "bytes=5000-"}).status_code == 416
+    assert client.get(url, params={"thumbnail": True}).content == b"thumb"
+    assert client.get("/page_image/user/case/my report.pdf/3").status_code == 404
+    assert client.get("/page_image/user/case/Report (1).pdf/1").content == content
+    assert client.get("/page_image/user/case/.hidden.pdf/1").status_code == 400
+
+
+def test_search_can_return_page_urls(client, monkeypatch, page_image_case):
+    from np_ocr import api as api_module
+
+    monkeypatch.setattr(
+        api_module,
+        "search_client",
+        fake_search_client([{"_distance": 0.5, "index": 0}, {"_distance": 0.4, "index": 1}]),
+    )
+
+    response = client.post(
+        "/search", data={"user_query": "q", "user_id": "user", "case_name": "case", "return_urls": "true"}
+    )
+    assert response.status_code == 200
+    results = response.json()["search_results"]
+    assert "image_base64" not in results[0]
+    assert results[0]["image_url"].endswith("/my%20report.pdf/2")
+    assert results[1]["image_url"].endswith("/Report%20%281%29.pdf/1")
+    for result in results:
+        assert client.get(result["image_url"]).content == page_image_case
@@ -74,3 +74,241 @@ def test_call_vllm_parses_response(env_setup, monkeypatch):
     result = search.call_vllm(img, "hi", base_url="http://x", api_key="y", model="m")
     assert result.answer == "ok"
 
+
+
+def test_lru_cache_evicts_least_recently_used():
+    from np_ocr.cache import LRUCache
+
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+    cache.invalidate("a")
+    assert cache.get_or_load("a", lambda: 10) == 10
+
+
+def test_acall_vllm_uses_shared_client(env_setup):
+    import asyncio
+
+    import np_ocr.search as search
+
+    calls = []
+
+    class FakeCompletions:
+        async def parse(self, **kwargs):
+            calls.append(kwargs)
+
+            class Msg:
+                parsed = search.ImageAnswer(answer="ok")
+
+            class Choice:
+                message = Msg()
+
+            class Completion:
+                choices = [Choice()]
+
+            return Completion()
+
+    class FakeAsyncOpenAI:
+        class Beta:
+            class Chat:
+                completions = FakeCompletions()
+
+            chat = Chat()
+
+        beta = Beta()
+
+    result = asyncio.run(search.acall_vllm(FakeAsyncOpenAI(), b"\xff\xd8jpeg", "hi", model="m"))
+    assert result.answer == "ok"
+    assert calls[0]["model"] == "m"
+    image_url = calls[0]["messages"][0]["content"][1]["image_url"]["url"]
+    assert image_url.startswith("data:image/jpeg;base64,")
+
+
+def test_lru_cache_ttl_expires_entries(monkeypatch):
+    import np_ocr.cache as cache
+
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+
+    lru = cache.LRUCache(max_size=4, ttl=10)
+    lru.put("a", 1)
+    now[0] += 5
+    assert lru.get("a") == 1
+    now[0] += 10
+    assert lru.get("a") is None
+    assert lru.stats()["size"] == 0
+
+
+def test_query_embedding_cache_normalizes_and_uses_disk_tier(tmp_path):
+    from np_ocr.cache import QueryEmbeddingCache
+
+    cache = QueryEmbeddingCache("model-a", max_size=8, ttl=60, disk_dir=str(tmp_path / "q"))
+    cache.put("  What is   the margin? ", {"embedding": [[1.0]]})
+    assert cache.get("What is the margin?") == {"embedding": [[1.0]]}
+
+    # a fresh process only has the disk tier
+    restarted = QueryEmbeddingCache("model-a", max_size=8, ttl=60, disk_dir=str(tmp_path / "q"))
+    assert restarted.get("What is the margin?") == {"embedding": [[1.0]]}
+    assert restarted.stats()["disk_hits"] == 1
+    assert restarted.stats()["hit_rate"] == 1.0
+
+    other_model = QueryEmbeddingCache("model-b", max_size=8, ttl=60, disk_dir=str(tmp_path / "q"))
+    assert other_model.get("What is the margin?") is None
+
+
+def test_int8_quantization_and_maxsim():
+    import numpy as np
+    from np_ocr.vectors import dequantize_int8, maxsim_distances, quantize_int8
+
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((50, 16)).astype(np.float32)
+    codes, scales = quantize_int8(vectors)
+    assert codes.dtype == np.int8 and scales.shape == (50,)
+    assert np.abs(dequantize_int8(codes, scales) - vectors).max() <= scales.max() / 2 + 1e-6
+
+    query = rng.standard_normal((3, 16)).astype(np.float32)
+    lengths = np.array([20, 0, 30])
+    distances = maxsim_distances(query, vectors, lengths)
+
+    def brute(page):
+        q = query / np.linalg.norm(query, axis=1, keepdims=True)
+        d = page / np.linalg.norm(page, axis=1, keepdims=True)
+        return len(q) - (q @ d.T).max(axis=1).sum()
+
+    assert distances[0] == pytest.approx(brute(vectors[:20]), abs=1e-5)
+    assert distances[1] == 3.0
+    assert distances[2] == pytest.approx(brute(vectors[20:]), abs=1e-5)
+
+
+def test_compress_multivectors_and_report():
+    import numpy as np
+    from np_ocr.vectors import compress_multivectors, compression_report
+
+    rng = np.random.default_rng(3)
+    lengths = np.array([40, 10, 40])
+    flat = rng.standard_normal((lengths.sum(), 8)).astype(np.float32)
+
+    for method in ("cluster", "norm"):
+        compressed, compressed_lengths = compress_multivectors(flat, lengths, method, budget=16)
+        assert compressed_lengths.tolist() == [16, 10, 16]
+        assert compressed.shape == (42, 8)
+
+    queries = [flat[:3], flat[55:58]]
+    report = compression_report(flat, lengths, queries, budgets=[4, 40], method="norm", top_k=1)
+    assert [row["token_budget"] for row in report] == [4, 40]
+    assert report[1]["size_ratio"] == 1.0
+    assert report[1]["recall_at_k"] == 1.0
+    assert report[0]["size_ratio"] == pytest.approx(12 / 90)
+
+
+def test_case_vectors_blocked_scoring_matches_maxsim():
+    import numpy as np
+    import pyarrow as pa
+    from np_ocr.vectors import CaseVectors, maxsim_distances
+
+    rng = np.random.default_rng(4)
+    lengths = np.array([5, 9, 3, 7])
+    flat = rng.standard_normal((lengths.sum(), 8)).astype(np.float32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+    vector_type = pa.list_(pa.list_(pa.float32(), 8))
+    table = pa.table(
+        {
+            "index": [0, 1, 2, 3],
+            "pdf_name": ["a.pdf", "a.pdf", "b.pdf", "b.pdf"],
+            "pdf_page": [1, 2, 1, 2],
+            "vector": pa.ListArray.from_arrays(
+                pa.array(offsets), pa.FixedSizeListArray.from_arrays(pa.array(flat.reshape(-1)), 8)
+            ).cast(vector_type),
+        }
+    )
+    case_vectors = CaseVectors.from_arrow(table)
+    query = flat[14:16]
+
+    expected = maxsim_distances(query, flat, lengths)
+    # a block smaller than any page still scores whole pages
+    assert np.allclose(case_vectors.distances(query, block_tokens=2), expected, atol=1e-2)
+    assert np.allclose(case_vectors.distances(query), expected, atol=1e-2)
+    results = case_vectors.search(query, top_k=2)
+    assert results[0] == {"index": 2, "pdf_name": "b.pdf", "pdf_page": 1, "_distance": results[0]["_distance"]}
+
+    # several queries of different lengths scored in one pass match scoring them one by one
+    queries = [query, flat[:3], flat[20:21]]
+    many = case_vectors.distances_many(queries, block_tokens=6)
+    assert many.shape == (3, 4)
+    for row, single in zip(many, queries):
+        assert np.allclose(row, maxsim_distances(single, flat, lengths), atol=1e-2)
+    assert [results[0]["index"] for results in case_vectors.search_many(queries, top_k=1)] == [2, 0, 3]
+
+
+def test_lance_index_params_scale_with_row_count():
+    from np_ocr.backends import lance_index_params, lance_nprobes
+
+    assert lance_index_params(100, 100_000, 128) is None
+    # partitions follow the token vectors, pages only pick whether and how to compress
+    assert lance_index_params(1000, 1000, 128) == {"index_type": "IVF_FLAT", "num_partitions": 31}
+    assert lance_index_params(1000, 1_000_000, 128) == {"index_type": "IVF_FLAT", "num_partitions": 1000}
+    assert lance_index_params(100_000, 100_000, 128) == {
+        "index_type": "IVF_PQ", "num_partitions": 316, "num_sub_vectors": 16
+    }
+    assert lance_index_params(100_000, 100_000, 12, "IVF_HNSW_PQ")["num_sub_vectors"] == 3
+    assert lance_index_params(100_000, 100_000, 128, "IVF_HNSW_SQ") == {
+        "index_type": "IVF_HNSW_SQ", "num_partitions": 316
+    }
+
+    assert lance_nprobes(316, 0.1) == 32
+    assert lance_nprobes(31, 0.1) == 20
+    assert lance_nprobes(6, 0.1) == 6
+
+
+def test_answer_cache_keys_and_case_invalidation(tmp_path):
+    import time
+
+    from np_ocr.cache import AnswerCache
+
+    cache = AnswerCache(str(tmp_path / "answers"), model_id="m", prompt_version="1")
+    cache.put("u", "c", b"page-1", "What is  the total?", "42", 0.9)
+    cache.put("u", "other", b"page-1", "What is the total?", "7")
+
+    assert cache.get("u", "c", b"page-1", " What is the total? ") == {"answer": "42", "confidence": 0.9}
+    # a re-rendered page, another model or prompt version are different entries
+    assert cache.get("u", "c", b"page-2", "What is the total?") is None
+    assert AnswerCache(str(tmp_path / "answers"), model_id="m2", prompt_version="1").get(
+        "u", "c", b"page-1", "What is the total?"
+    ) is None
+    assert AnswerCache(str(tmp_path / "answers"), model_id="m", prompt_version="2").get(
+        "u", "c", b"page-1", "What is the total?"
+    ) is None
+
+    cache.invalidate_case("u", "c")
+    assert cache.get("u", "c", b"page-1", "What is the total?") is None
+    assert cache.get("u", "other", b"page-1", "What is the total?")["answer"] == "7"
+    assert cache.stats()["hits"] == 2
+
+    expiring = AnswerCache(str(tmp_path / "expiring"), model_id="m", prompt_version="1", ttl=0.05)
+    expiring.put("u", "c", b"page-1", "q", "42")
+    time.sleep(0.1)
+    assert expiring.get("u", "c", b"page-1", "q") is None
+
+
+def test_incomplete_vector_backend_fails_at_construction():
+    from np_ocr.backends import VectorBackend
+
+    class NoSearch(VectorBackend):
+        def create(self, case_name, user_id, schema): ...
+        def add_batch(self, handle, table): ...
+        def build_index(self, handle, case_name, user_id): ...
+        def delete(self, case_name, user_id): ...
+        def count(self, case_name, user_id): ...
+        def iter_pages(self, case_name, user_id, batch_size=256): ...
+
+    with pytest.raises(TypeError, match="search"):
+        NoSearch()
@@ -105,6 +105,50 @@ def serve():
             image_embedding = colpali_model(**batch_image)
         return {"embedding": image_embedding[0].cpu().float().numpy().tolist()}
 
+    def embeddings_response(embeddings, attention_mask, format: str, dtype: str):
+        """Per-item embeddings without padding, as JSON lists or one stacked .npy array (see /process_images)."""
+        import io
+
+        import numpy as np
+
+        # items of different sizes are padded to the longest one, drop the padded tokens
+        embeddings = [embedding[mask] for embedding, mask in zip(embeddings, attention_mask.bool())]
+        if format == "npy":
+            if dtype not in ("float32", "float16"):
+                raise HTTPException(status_code=400, detail=f"Unsupported dtype {dtype}")
+            torch_dtype = torch.float16 if dtype == "float16" else torch.float32
+            buffer = io.BytesIO()
+            np.save(buffer, torch.cat(embeddings).to(torch_dtype).cpu().numpy())
+            return fastapi.Response(
+                buffer.getvalue(),
+                media_type="application/x-npy",
+                headers={"X-Embedding-Lengths": ",".join(str(len(embedding)) for embedding in embeddings)},
+            )
+        return {"embeddings": [embedding.cpu().float().numpy().tolist() for embedding in embeddings]}
+
+    @router.post("/queries")
+    async def query_model_batch(query_texts: list[str], format: str = "json", dtype: str = "float32"):
+        """Embed a batch of queries in one forward pass, same response formats as /process_images."""
+        with torch.no_grad():
+            batch_queries = colpali_processor.process_queries(query_texts).to(colpali_model.device)
+            query_embeddings = colpali_model(**batch_queries)
+        return embeddings_response(query_embeddings, batch_queries["attention_mask"], format, dtype)
+
+    @router.post("/process_images")
+    async def process_images(images: list[fastapi.UploadFile], format: str = "json", dtype: str = "float32"):
+        """Embed a batch of pages.
+
+        ``format=npy`` returns all page embeddings stacked into one ``(total_tokens, dim)`` .npy array of
+        ``dtype`` (float32 or float16), with tokens per page in the ``X-Embedding-Lengths`` header.
+        """
+        from PIL import Image
+
+        pil_images = [Image.open(image.file) for image in images]
+        with torch.no_grad():
+            batch_images = colpali_processor.process_images(pil_images).to(colpali_model.device)
+            image_embeddings = colpali_model(**batch_images)
+        return embeddings_response(image_embeddings, batch_images["attention_mask"], format, dtype)
+
     # add authed router to our fastAPI app
     web_app.include_router(router)
 